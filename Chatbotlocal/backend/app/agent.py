@@ -0,0 +1,160 @@
+"""
+Pętla agenta: model -> narzędzia -> model
+=========================================
+
+Zamiast doklejać surowe wyniki narzędzi do odpowiedzi, wyniki wracają do
+modelu, który odpowiada już na ich podstawie (do AGENT_MAX_STEPS kroków).
+
+- wywołanie narzędzia startuje, gdy tylko parser zobaczy zamknięty
+  [TOOL:...]...[/TOOL] - model w tym czasie generuje dalej,
+- każdy krok kontynuuje "context" Ollama z poprzedniego kroku, więc prompt-eval
+  dotyczy tylko nowych tokenów (wyników narzędzi), a nie całej rozmowy,
+- budżety na całe żądanie: AGENT_MAX_TOKENS (suma wygenerowanych tokenów)
+  i AGENT_MAX_SECONDS,
+- run() jest generatorem zdarzeń: "token", "tool_call", "tool_result",
+  "error" i na końcu "done" - /api/chat przekazuje je dalej jako SSE.
+"""
+
+import asyncio
+import os
+import time
+from contextlib import aclosing
+from typing import Dict, Any, List, Optional, AsyncIterator
+
+from mcp_tools import mcp_registry, ToolCallParser
+from prompt_builder import format_tool_results
+
+
+def format_tool_summary(tool_calls: List[dict]) -> str:
+    """Blok "🔧 Użyte narzędzia" dopisywany do odpowiedzi widocznej dla użytkownika"""
+    if not tool_calls:
+        return ""
+    return "\n\n🔧 Użyte narzędzia:\n" + "\n".join([
+        f"- {tc['tool']}: {tc['result']}" for tc in tool_calls
+    ])
+
+
+class AgentLoop:
+    """Generuje, wykonuje narzędzia i oddaje ich wyniki modelowi - krok po kroku"""
+
+    def __init__(self, max_steps: int = 3, max_total_tokens: int = 2048, max_seconds: float = 120):
+        self.max_steps = max(1, max_steps)
+        self.max_total_tokens = max_total_tokens
+        self.max_seconds = max_seconds
+
+    async def run(self, llm, prompt: str, context: Optional[list] = None, max_tokens: int = 512,
+                  temperature: float = 0.8, top_p: float = 0.9, use_tools: bool = True,
+                  estimator=None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Zdarzenia (dict z kluczem "event"):
+        - token: {"text", "step"}
+        - tool_call: {"tool", "args", "step"}; tool_result: {"tool", "args", "result", "step"}
+        - error: {"detail"} - koniec bez "done"
+        - done: {"text", "tool_calls", "result" (ostatnia pełna odpowiedź Ollama - także gdy
+          AGENT_MAX_SECONDS przerwał krok w trakcie), "agent"}; agent.stopped: "done",
+          "max_steps", "token_budget" albo "time_budget"
+        """
+        started = time.perf_counter()
+        deadline = started + self.max_seconds
+        text = ""
+        tool_calls: List[dict] = []
+        generated = 0
+        steps = 0
+        stopped = "done"
+        final: Dict[str, Any] = {}
+
+        while True:
+            steps += 1
+            parts = []
+            step_final: Dict[str, Any] = {}
+            parser = ToolCallParser()
+            calls, pending = [], []
+            budget = max(1, min(max_tokens, self.max_total_tokens - generated))
+            try:
+                async with aclosing(llm.generate_stream(prompt, max_tokens=budget, temperature=temperature,
+                                                        top_p=top_p, context=context)) as chunks:
+                    async for chunk in chunks:
+                        if chunk.get("error"):
+                            yield {"event": "error", "detail": chunk["response"]}
+                            return
+                        token = chunk.get("response", "")
+                        if token:
+                            parts.append(token)
+                            yield {"event": "token", "text": token, "step": steps}
+                            for call in (parser.feed(token) if use_tools else []):
+                                calls.append(call)
+                                pending.append(asyncio.create_task(
+                                    mcp_registry.execute_tool_async(call["tool"], **call["args"])
+                                ))
+                                yield {"event": "tool_call", "tool": call["tool"], "args": call["args"],
+                                       "step": steps}
+                        if chunk.get("done"):
+                            step_final = chunk
+                        if time.perf_counter() > deadline:
+                            stopped = "time_budget"
+                            break
+                results = await asyncio.gather(*pending)
+            finally:
+                # Błąd albo klient się rozłączył - nie zostawiaj osieroconych narzędzi
+                for task in pending:
+                    task.cancel()
+
+            step_text = "".join(parts)
+            # Krok przerwany budżetem czasu nie ma końcowego fragmentu - liczymy
+            # fragmenty strumienia (Ollama wysyła ~1 token na fragment), a "result"
+            # zostaje z ostatniego zakończonego kroku (context, statystyki)
+            generated += step_final.get("eval_count") or len(parts)
+            if step_final:
+                final = step_final
+            if steps == 1 and estimator is not None and step_final.get("context"):
+                # Kalibracja estymatora: tylko pierwszy krok ma pełny, znany prompt
+                prompt_tokens = len(step_final["context"]) - len(context or []) - (step_final.get("eval_count") or 0)
+                estimator.observe(llm.model_name, len(prompt), prompt_tokens)
+
+            step_calls = []
+            for call, result in zip(calls, results):
+                step_call = {"tool": call["tool"], "args": call["args"], "result": result, "step": steps}
+                step_calls.append(step_call)
+                yield dict(step_call, event="tool_result")
+            tool_calls.extend(step_calls)
+
+            text = "\n\n".join(p for p in (text, step_text + format_tool_summary(step_calls)) if p)
+
+            if not step_calls or stopped != "done":
+                break
+            if steps >= self.max_steps:
+                stopped = "max_steps"
+                break
+            if generated >= self.max_total_tokens:
+                stopped = "token_budget"
+                break
+            if time.perf_counter() > deadline:
+                stopped = "time_budget"
+                break
+
+            # Kolejny krok: tylko wyniki narzędzi na contextcie poprzedniego kroku
+            if step_final.get("context"):
+                context = step_final["context"]
+                prompt = format_tool_results(step_calls)
+            else:
+                prompt = prompt + step_text + "\n\n" + format_tool_results(step_calls)
+
+        yield {
+            "event": "done",
+            "text": text,
+            "tool_calls": tool_calls,
+            "result": final,
+            "agent": {
+                "steps": steps,
+                "eval_count": generated,
+                "stopped": stopped,
+                "total_ms": round((time.perf_counter() - started) * 1000, 1)
+            }
+        }
+
+
+agent_loop = AgentLoop(
+    max_steps=int(os.getenv("AGENT_MAX_STEPS", 3)),
+    max_total_tokens=int(os.getenv("AGENT_MAX_TOKENS", 2048)),
+    max_seconds=float(os.getenv("AGENT_MAX_SECONDS", 120))
+)
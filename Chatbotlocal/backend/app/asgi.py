@@ -0,0 +1,121 @@
+"""
+Punkt wejścia ASGI z szybką sondą liveness (uvicorn asgi:app)
+=============================================================
+
+`uvicorn main:app` przyjmuje połączenia dopiero po imporcie całego main.py:
+fastapi z budową tras (~0.6 s), SQLAlchemy z modelami (~0.35 s), httpx,
+narzędzia MCP, RAG, paczki - razem ~1 s na szybkiej maszynie, więcej na
+słabszej replice. asgi:app importuje tylko bibliotekę standardową i metrics.py:
+
+- /api/health/live odpowiada od razu (200; 503, gdy import main.py się nie powiódł),
+- main.py importowany jest w wątku zaraz po starcie serwera, potem wchodzimy
+  w jego lifespan (start w tle z startup.py - baza, Ollama, rozgrzanie),
+- do tego czasu /api/health/ready zwraca 503 ("loading"), a pozostałe żądania
+  czekają na import (max STARTUP_IMPORT_WAIT_SECONDS, potem 503),
+- po imporcie wszystko, łącznie z sondami, obsługuje aplikacja z main.py.
+
+`uvicorn main:app` nadal działa - tylko bez szybkiej sondy.
+"""
+
+import asyncio
+import importlib
+import json
+import os
+import time
+from typing import Optional
+
+from metrics import log_event
+
+LIVE_PATH = "/api/health/live"
+READY_PATH = "/api/health/ready"
+
+
+async def send_json(send, status: int, body: dict, headers: Optional[list] = None):
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(data)).encode())] + (headers or [])})
+    await send({"type": "http.response.body", "body": data})
+
+
+class LazyApp:
+    """Aplikacja ASGI, która ładuje `module`.app w tle i do tego czasu obsługuje sondy sama"""
+
+    def __init__(self, module: str = "main", wait: float = 30):
+        self.module = module
+        self.wait = wait
+        self.app = None
+        self.error: Optional[str] = None
+        self.import_seconds: Optional[float] = None
+        self._loaded: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lifespan = None
+
+    async def _load(self):
+        started = time.perf_counter()
+        try:
+            module = await asyncio.to_thread(importlib.import_module, self.module)
+            self.import_seconds = round(time.perf_counter() - started, 3)
+            log_event("startup_import", f"📦 {self.module}.py zaimportowany", seconds=self.import_seconds)
+            lifespan = module.app.router.lifespan_context(module.app)
+            await lifespan.__aenter__()
+            self._lifespan = lifespan
+            self.app = module.app
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            log_event("startup_import_failed", f"❌ Import {self.module}.py nie powiódł się", level="error",
+                      error=self.error)
+        finally:
+            self._loaded.set()
+
+    async def _run_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._loaded = asyncio.Event()
+                self._task = asyncio.create_task(self._load())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._task is not None:
+                    # Importu w wątku nie da się przerwać - zamykamy po nim
+                    await self._task
+                if self._lifespan is not None:
+                    await self._lifespan.__aexit__(None, None, None)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._run_lifespan(receive, send)
+            return
+        if self.app is None:
+            path = scope.get("path")
+            if scope["type"] == "http" and path == LIVE_PATH:
+                if self.error:
+                    await send_json(send, 503, {"status": "failed", "error": self.error})
+                else:
+                    await send_json(send, 200, {"status": "alive"})
+                return
+            if scope["type"] == "http" and path == READY_PATH:
+                await send_json(send, 503, {"status": "failed" if self.error else "loading",
+                                            "checks": {"import": False}})
+                return
+            if self._loaded is not None:
+                try:
+                    await asyncio.wait_for(self._loaded.wait(), self.wait)
+                except asyncio.TimeoutError:
+                    pass
+            if self.app is None:
+                if scope["type"] == "http":
+                    await send_json(send, 503, {"detail": self.error or "Backend jeszcze się uruchamia"},
+                                    headers=[(b"retry-after", b"1")])
+                return
+        await self.app(scope, receive, send)
+
+
+app = LazyApp("main", wait=float(os.getenv("STARTUP_IMPORT_WAIT_SECONDS", 30)))
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("asgi:app", host="0.0.0.0", port=8000, reload=False)
@@ -0,0 +1,474 @@
+"""
+Paczki zadań czatu - /api/batch
+===============================
+
+Zestawy regresyjne promptów i masowe przeglądy CV idą jednym żądaniem zamiast
+tysięcy osobnych /api/chat:
+
+- wejście: JSONL, jedno zadanie na linię - {"id", "messages", "max_tokens",
+  "temperature", "top_p", "model_name", "use_tools", "custom_system_prompt",
+  "cache"} (pola jak w /api/chat; brak "id" = "line-<numer linii>"),
+- wyjście: NDJSON w kolejności kończenia zadań - "batch" (nagłówek z batch_id),
+  "result" / "error" dla każdego zadania i "summary" na końcu (tokeny/s,
+  zadania/s),
+- ten sam potok co /api/chat: routing modelu, RAG workspace, cache odpowiedzi,
+  budżet historii, cache prefiksu i pętla agenta; zadania czekają na slot
+  schedulera z niższym priorytetem niż czat interaktywny (BATCH_PRIORITY),
+  najwyżej `parallelism` naraz (BATCH_PARALLELISM, limit BATCH_MAX_PARALLELISM),
+- zapis paczkami: rozmowy, wiadomości i wiersze batch_jobs wielu zadań w jednej
+  transakcji (co BATCH_FLUSH_JOBS zadań albo BATCH_FLUSH_SECONDS); wynik trafia
+  do strumienia dopiero po zapisie, więc odebrana linia = zadanie zakończone
+  trwale,
+- wznowienie: ?batch_id=<id> albo nagłówek X-Batch-ID z odpowiedzi poprzedniej
+  próby - zadania zakończone w tej paczce nie są generowane ponownie, wynik
+  wraca z bazy ("resumed": true); zadania z błędem są ponawiane.
+
+Zadania startują już w trakcie odbierania wejścia, ale strumień wyników rusza
+po odebraniu całego ciała żądania (uvicorn mówi ASGI 2.3 - czytanie ciała
+w trakcie odpowiedzi koliduje z nasłuchem rozłączenia klienta w Starlette).
+Rozłączenie klienta przerywa paczkę; zakończone zadania są zapisane.
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from sqlalchemy import delete, func, insert, select
+
+from agent import agent_loop
+from config import parse_size
+from db import AsyncSessionLocal, BatchJob, Conversation, Message
+from metrics import log_event, BATCH_JOBS
+from mcp_tools import mcp_registry
+from model import ollama_stats
+from model_pool import UnknownModel
+from prompt_builder import prompt_builder
+from rag import retriever, format_retrieved
+from response_cache import response_cache, cache_key
+from scheduler import scheduler, SchedulerRejected
+from token_budget import token_estimator, history_budget
+
+
+class BatchConflict(Exception):
+    """Paczka o tym batch_id właśnie trwa"""
+
+
+class BatchTooLarge(Exception):
+    """Wejście paczki przekracza BATCH_MAX_BYTES"""
+
+
+def parse_job(line: bytes, number: int) -> Dict[str, Any]:
+    """Linia JSONL -> zadanie z uzupełnionymi domyślnymi; ValueError z opisem dla klienta"""
+    try:
+        job = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"Linia {number}: nieprawidłowy JSON ({e})")
+    if not isinstance(job, dict):
+        raise ValueError(f"Linia {number}: oczekiwano obiektu JSON")
+    messages = job.get("messages")
+    if not isinstance(messages, list) or not messages or \
+            not all(isinstance(m, dict) and isinstance(m.get("role"), str) and isinstance(m.get("text"), str)
+                    for m in messages):
+        raise ValueError(f"Linia {number}: \"messages\" musi być niepustą listą {{role, text}}")
+    try:
+        job["max_tokens"] = int(job.get("max_tokens", 512))
+        job["temperature"] = float(job.get("temperature", 0.8))
+        job["top_p"] = float(job.get("top_p", 0.9))
+    except (TypeError, ValueError):
+        raise ValueError(f"Linia {number}: max_tokens, temperature i top_p muszą być liczbami")
+    job["use_tools"] = bool(job.get("use_tools", True))
+    job["id"] = str(job.get("id") or f"line-{number}")[:128]
+    return job
+
+
+def ndjson(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+
+class BatchRun:
+    """Jedna paczka: kolejka zadań, workery, bufor zapisów i liczniki przepustowości"""
+
+    def __init__(self, runner: "BatchRunner", batch_id: str, parallelism: int, finished: Dict[str, str]):
+        self.runner = runner
+        self.batch_id = batch_id
+        self.parallelism = parallelism
+        self.finished = finished  # job_id -> zapisana linia wyniku (wznowienie)
+        self.jobs = 0
+        self.done = 0
+        self.failed = 0
+        self.resumed = 0
+        self.prompt_tokens = 0
+        self.eval_tokens = 0
+        self.started = time.perf_counter()
+        self.ended: Optional[float] = None
+
+        self._seen: set = set()
+        self._jobs: asyncio.Queue = asyncio.Queue()
+        self._results: asyncio.Queue = asyncio.Queue()
+        self._pending: List[Dict[str, Any]] = []
+        self._flush_lock = asyncio.Lock()
+        self._closed = False
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(parallelism)]
+        self._flusher = asyncio.create_task(self._flush_loop())
+        self._drain = asyncio.create_task(self._drain_workers())
+
+    # ---------- wejście ----------
+
+    async def feed(self, chunks: AsyncIterator[bytes]):
+        """Czyta JSONL i kolejkuje zadania na bieżąco - generacja rusza przed końcem wejścia"""
+        buffer, number, received = b"", 0, 0
+        async for chunk in chunks:
+            received += len(chunk)
+            if received > self.runner.max_bytes:
+                raise BatchTooLarge(f"Wejście paczki przekracza {self.runner.max_bytes} bajtów (BATCH_MAX_BYTES)")
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                number += 1
+                self._add(line, number)
+        if buffer.strip():
+            self._add(buffer, number + 1)
+        for _ in self._workers:
+            self._jobs.put_nowait(None)
+
+    def _add(self, line: bytes, number: int):
+        if not line.strip():
+            return
+        self.jobs += 1
+        try:
+            job = parse_job(line, number)
+            if job["id"] in self._seen:
+                raise ValueError(f"Linia {number}: powtórzone id {job['id']!r}")
+        except ValueError as e:
+            self.failed += 1
+            BATCH_JOBS.inc(status="invalid")
+            self._results.put_nowait({"type": "error", "id": f"line-{number}", "line": number, "detail": str(e)})
+            return
+        self._seen.add(job["id"])
+
+        stored = self.finished.get(job["id"])
+        if stored is not None:
+            self.resumed += 1
+            BATCH_JOBS.inc(status="resumed")
+            self._results.put_nowait(dict(json.loads(stored), resumed=True))
+            return
+        self._jobs.put_nowait(job)
+
+    # ---------- wykonanie ----------
+
+    async def _worker(self):
+        while True:
+            job = await self._jobs.get()
+            if job is None:
+                return
+            try:
+                outcome = await self.runner.run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                outcome = {"error": f"❌ Błąd zadania: {e}"}
+            await self._finish(job, outcome)
+
+    async def _finish(self, job: Dict[str, Any], outcome: Dict[str, Any]):
+        if outcome.get("error"):
+            self.failed += 1
+            BATCH_JOBS.inc(status="error")
+            line = {"type": "error", "id": job["id"], "detail": outcome["error"]}
+            item = {"job": job, "status": "error", "line": line}
+        else:
+            self.done += 1
+            BATCH_JOBS.inc(status="done")
+            self.prompt_tokens += outcome["prompt_eval_count"] or 0
+            self.eval_tokens += outcome["eval_count"] or 0
+            line = {"type": "result", "id": job["id"], "conversation_id": None, "text": outcome["text"],
+                    "tool_calls": outcome["tool_calls"], "model": outcome["model"], "stats": outcome["stats"],
+                    "resumed": False}
+            item = {"job": job, "status": "done", "line": line, "prompt_eval_count": outcome["prompt_eval_count"],
+                    "eval_count": outcome["eval_count"]}
+        self._pending.append(item)
+        if len(self._pending) >= self.runner.flush_jobs:
+            await self._flush()
+
+    async def _flush(self):
+        async with self._flush_lock:
+            items, self._pending = self._pending, []
+            if not items:
+                return
+            try:
+                await self.runner.write(self.batch_id, items)
+            except Exception as e:
+                # Wyniki i tak idą do klienta; przy wznowieniu te zadania wykonają się ponownie
+                log_event("batch_write_failed", f"❌ Batch: zapis {len(items)} zadań nie powiódł się", level="error",
+                          batch_id=self.batch_id, error=str(e))
+            for item in items:
+                self._results.put_nowait(item["line"])
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.runner.flush_seconds)
+            await self._flush()
+
+    async def _drain_workers(self):
+        await asyncio.gather(*self._workers)
+        self._flusher.cancel()
+        await self._flush()
+        self.ended = time.perf_counter()
+        self._results.put_nowait(None)
+
+    # ---------- wyjście ----------
+
+    async def results(self) -> AsyncIterator[str]:
+        """NDJSON: nagłówek, wyniki w kolejności zapisu, podsumowanie"""
+        try:
+            yield ndjson({"type": "batch", "batch_id": self.batch_id, "jobs": self.jobs, "resumed": self.resumed,
+                          "parallelism": self.parallelism})
+            while True:
+                line = await self._results.get()
+                if line is None:
+                    break
+                yield ndjson(line)
+            yield ndjson(dict(self.summary(), type="summary"))
+        finally:
+            # Rozłączenie klienta: Starlette anuluje strumień przez anyio, które ponawia
+            # anulowanie przy każdym await - zamknięcie idzie w osobnym zadaniu
+            self.runner.close_later(self)
+
+    async def close(self):
+        """Kończy paczkę (także przerwaną) - zakończone zadania trafiają do bazy"""
+        if self._closed:
+            return
+        self._closed = True
+        for task in self._workers + [self._flusher, self._drain]:
+            task.cancel()
+        await asyncio.gather(*self._workers, self._flusher, self._drain, return_exceptions=True)
+        await self._flush()
+        if self.ended is None:
+            self.ended = time.perf_counter()
+        self.runner.active.pop(self.batch_id, None)
+        log_event("batch_done", "📦 Batch zakończony", **self.summary())
+
+    def summary(self) -> Dict[str, Any]:
+        seconds = (self.ended or time.perf_counter()) - self.started
+        completed = self.done + self.failed
+        return {
+            "batch_id": self.batch_id,
+            "jobs": self.jobs,
+            "done": self.done,
+            "failed": self.failed,
+            "resumed": self.resumed,
+            "parallelism": self.parallelism,
+            "prompt_tokens": self.prompt_tokens,
+            "eval_tokens": self.eval_tokens,
+            "seconds": round(seconds, 3),
+            "jobs_per_second": round(completed / seconds, 3) if seconds else 0.0,
+            "tokens_per_second": round(self.eval_tokens / seconds, 2) if seconds else 0.0
+        }
+
+
+class BatchRunner:
+    """Uruchamia paczki zadań na puli modeli i zapisuje ich wyniki w bazie"""
+
+    def __init__(self, pool, parallelism: int = 2, max_parallelism: int = 4, priority: int = 1,
+                 flush_jobs: int = 50, flush_seconds: float = 1.0, max_bytes: int = 64 * 1024 * 1024):
+        self.pool = pool
+        self.parallelism = max(1, parallelism)
+        self.max_parallelism = max(self.parallelism, max_parallelism)
+        self.priority = priority
+        self.flush_jobs = max(1, flush_jobs)
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+
+        self.active: Dict[str, BatchRun] = {}
+        self._closing: set = set()
+        self.batches = 0
+        self.scheduler_retries = 0
+
+    async def open(self, batch_id: Optional[str] = None, parallelism: Optional[int] = None) -> BatchRun:
+        """Nowa paczka albo wznowienie istniejącej (batch_id); rzuca BatchConflict"""
+        batch_id = batch_id or uuid.uuid4().hex[:16]
+        if batch_id in self.active:
+            raise BatchConflict(f"Paczka {batch_id} już trwa")
+        async with AsyncSessionLocal() as session:
+            finished = dict((await session.execute(
+                select(BatchJob.job_id, BatchJob.result)
+                .where(BatchJob.batch_id == batch_id, BatchJob.status == "done")
+            )).all())
+        if batch_id in self.active:
+            raise BatchConflict(f"Paczka {batch_id} już trwa")
+
+        parallelism = max(1, min(parallelism or self.parallelism, self.max_parallelism))
+        run = BatchRun(self, batch_id, parallelism, finished)
+        self.active[batch_id] = run
+        self.batches += 1
+        log_event("batch_start", "📦 Batch start", batch_id=batch_id, parallelism=parallelism,
+                  finished=len(finished))
+        return run
+
+    def close_later(self, run: BatchRun):
+        task = asyncio.get_running_loop().create_task(run.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def stop(self):
+        for run in list(self.active.values()):
+            await run.close()
+        await asyncio.gather(*self._closing, return_exceptions=True)
+
+    # ---------- jedno zadanie ----------
+
+    async def _acquire(self):
+        """Slot schedulera z niższym priorytetem niż czat; pełna kolejka = odczekaj i ponów"""
+        while True:
+            try:
+                return await scheduler.acquire(self.priority)
+            except SchedulerRejected as e:
+                self.scheduler_retries += 1
+                await asyncio.sleep(e.retry_after)
+
+    async def run_job(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """Potok /api/chat dla jednego zadania (bez zapisu) - wynik albo {"error"}"""
+        messages = job["messages"]
+        use_tools, max_tokens = job["use_tools"], job["max_tokens"]
+        temperature, top_p = job["temperature"], job["top_p"]
+        custom_system_prompt = job.get("custom_system_prompt")
+        last = messages[-1]["text"]
+
+        try:
+            llm = await self.pool.route(job.get("model_name"), last, max_tokens, estimator=token_estimator)
+        except UnknownModel as e:
+            return {"error": str(e)}
+
+        attachments = ""
+        if retriever.enabled:
+            try:
+                retrieved = await retriever.retrieve(self.pool.default, last, retriever.scope_docs([]),
+                                                     estimator=token_estimator, model_name=llm.model_name)
+                attachments = format_retrieved(retrieved)
+            except Exception as e:
+                log_event("rag_retrieve_failed", "⚠️ RAG: wyszukiwanie nie powiodło się", level="warning",
+                          error=str(e))
+
+        cache_key_value = None
+        if response_cache.should_use(temperature, job.get("cache")):
+            full_prompt = prompt_builder.build(messages, use_tools=use_tools,
+                                               custom_system_prompt=custom_system_prompt,
+                                               attachments=attachments)["prompt"]
+            cache_key_value = cache_key(llm.model_name, full_prompt, temperature, top_p, max_tokens)
+            cached = await response_cache.get(cache_key_value)
+            if cached is not None:
+                return {"text": cached["response"], "tool_calls": cached.get("tool_calls", []),
+                        "model": llm.model_name, "prompt_eval_count": 0, "eval_count": 0,
+                        "stats": dict(cached.get("stats", {}), prefix_cache="off", response_cache="hit")}
+
+        fixed_text = (prompt_builder.system_prompt(custom_system_prompt) if use_tools else "") + attachments
+        folded, history = history_budget.fit(fixed_text, "", messages, max_tokens, llm.model_name)
+
+        await self._acquire()
+        slot_started = time.perf_counter()
+        try:
+            summary = await history_budget.summarize("", folded, llm.model_name, model=llm) if folded else ""
+            built = prompt_builder.build(history, use_tools=use_tools, custom_system_prompt=custom_system_prompt,
+                                         attachments=attachments, summary=summary)
+
+            done = None
+            async for event in agent_loop.run(llm, built["prompt"], max_tokens=max_tokens,
+                                              temperature=temperature, top_p=top_p, use_tools=use_tools,
+                                              estimator=token_estimator):
+                if event["event"] == "error":
+                    return {"error": event["detail"]}
+                if event["event"] == "done":
+                    done = event
+        finally:
+            scheduler.release(time.perf_counter() - slot_started)
+
+        stats = dict(ollama_stats(done["result"]), agent=done["agent"])
+        replay_ttl = mcp_registry.replay_ttl(done["tool_calls"])
+        if cache_key_value and not done["result"].get("error") and replay_ttl != 0:
+            await response_cache.put(cache_key_value,
+                                     {"response": done["text"], "tool_calls": done["tool_calls"], "stats": stats},
+                                     ttl=replay_ttl)
+        return {"text": done["text"], "tool_calls": done["tool_calls"], "model": llm.model_name,
+                "prompt_eval_count": stats["prompt_eval_count"], "eval_count": done["agent"]["eval_count"],
+                "stats": dict(stats, prefix_cache="off", response_cache="miss" if cache_key_value else "off")}
+
+    # ---------- baza ----------
+
+    async def write(self, batch_id: str, items: List[Dict[str, Any]]):
+        """Rozmowy, wiadomości i wiersze batch_jobs wielu zadań - jedna transakcja"""
+        done = [item for item in items if item["status"] == "done"]
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                if done:
+                    conversation_ids = (await session.scalars(
+                        insert(Conversation).returning(Conversation.id, sort_by_parameter_order=True),
+                        [{"context_model": item["line"]["model"]} for item in done]
+                    )).all()
+                    rows = []
+                    for item, conversation_id in zip(done, conversation_ids):
+                        item["line"]["conversation_id"] = conversation_id
+                        rows += [{"conversation_id": conversation_id, "role": m.get("role", "user"),
+                                  "content": m["text"]} for m in item["job"]["messages"]]
+                        rows.append({"conversation_id": conversation_id, "role": "assistant",
+                                     "content": item["line"]["text"]})
+                    await session.execute(insert(Message), rows)
+                # Zadania ponawiane po błędzie mają już wiersz - zastępujemy go
+                await session.execute(delete(BatchJob).where(
+                    BatchJob.batch_id == batch_id, BatchJob.job_id.in_([item["job"]["id"] for item in items])
+                ))
+                await session.execute(insert(BatchJob), [{
+                    "batch_id": batch_id,
+                    "job_id": item["job"]["id"],
+                    "status": item["status"],
+                    "conversation_id": item["line"].get("conversation_id"),
+                    "prompt_eval_count": item.get("prompt_eval_count"),
+                    "eval_count": item.get("eval_count"),
+                    "result": json.dumps(item["line"], ensure_ascii=False)
+                } for item in items])
+
+    async def status(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """Stan paczki: trwającej z liczników w pamięci, zakończonej z batch_jobs"""
+        run = self.active.get(batch_id)
+        if run is not None:
+            return dict(run.summary(), running=True)
+        async with AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                select(BatchJob.status, func.count(), func.sum(BatchJob.prompt_eval_count),
+                       func.sum(BatchJob.eval_count))
+                .where(BatchJob.batch_id == batch_id).group_by(BatchJob.status)
+            )).all()
+        if not rows:
+            return None
+        by_status = {status: (count, prompt or 0, generated or 0) for status, count, prompt, generated in rows}
+        return {
+            "batch_id": batch_id,
+            "running": False,
+            "done": by_status.get("done", (0, 0, 0))[0],
+            "failed": by_status.get("error", (0, 0, 0))[0],
+            "prompt_tokens": sum(v[1] for v in by_status.values()),
+            "eval_tokens": sum(v[2] for v in by_status.values())
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "parallelism": self.parallelism,
+            "max_parallelism": self.max_parallelism,
+            "priority": self.priority,
+            "batches": self.batches,
+            "scheduler_retries": self.scheduler_retries,
+            "active": [run.summary() for run in self.active.values()]
+        }
+
+
+def create_batch_runner(pool) -> BatchRunner:
+    return BatchRunner(
+        pool,
+        parallelism=int(os.getenv("BATCH_PARALLELISM", 2)),
+        max_parallelism=int(os.getenv("BATCH_MAX_PARALLELISM", 4)),
+        priority=int(os.getenv("BATCH_PRIORITY", 1)),
+        flush_jobs=int(os.getenv("BATCH_FLUSH_JOBS", 50)),
+        flush_seconds=float(os.getenv("BATCH_FLUSH_SECONDS", 1)),
+        max_bytes=parse_size(os.getenv("BATCH_MAX_BYTES"), 64 * 1024 * 1024)
+    )
@@ -0,0 +1,44 @@
+# Wczytywanie mcp_config.json (raz na proces)
+import json
+import os
+import re
+from functools import lru_cache
+
+from metrics import log_event
+
+CONFIG_PATH = os.getenv("MCP_CONFIG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_config.json"))
+
+
+@lru_cache(maxsize=1)
+def load_mcp_config() -> dict:
+    """Zwraca konfigurację z mcp_config.json (pusty dict, gdy pliku brak)"""
+    try:
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        log_event("config_missing", "⚠️ Brak pliku konfiguracji - używam wartości domyślnych", level="warning",
+                  path=CONFIG_PATH)
+        return {}
+
+
+def tools_config() -> dict:
+    """Sekcja "mcp_tools_config" - ustawienia wspólne dla narzędzi"""
+    return load_mcp_config().get("mcp_tools_config", {})
+
+
+def tool_config(name: str) -> dict:
+    """Ustawienia pojedynczego narzędzia z sekcji "tools" """
+    return load_mcp_config().get("tools", {}).get(name, {})
+
+
+def parse_size(value, default: int = 0) -> int:
+    """Rozmiar z konfiguracji: liczba bajtów albo tekst "10MB", "512KB", "1GB" """
+    if value is None or value == "":
+        return default
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*", str(value).upper())
+    if not match:
+        raise ValueError(f"Nieprawidłowy rozmiar: {value!r}")
+    number, unit = float(match.group(1)), match.group(2).rstrip("B")
+    return int(number * {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[unit])
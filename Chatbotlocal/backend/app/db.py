@@ -1,27 +1,417 @@
 # Minimalna integracja DB (SQLite + SQLAlchemy).
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, DateTime
+#
+# - silnik async (aiosqlite) z pulą połączeń dla endpointów, synchroniczny
+#   tylko do migracji i zadań w tle,
+# - SQLite: WAL + pragmy dobrane pod lokalne wdrożenie (DB_* w .env),
+# - migracje numerowane, wersja w PRAGMA user_version (starsze chat.db
+#   aktualizują się same przy starcie),
+# - MessageWriter: zapisy wiadomości zbierane w paczki - jedna transakcja
+#   (jeden fsync) zamiast commitu po każdym wierszu.
+import asyncio
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import (create_engine, event, inspect, text, update, Column, Integer, String, Text,
+                        ForeignKey, DateTime, Index)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.sql import func
-import os
+
+from metrics import DB_BATCH_SECONDS, log_event
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./chat.db")
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
+
+def _async_url(url: str) -> str:
+    """sqlite:// -> sqlite+aiosqlite://, postgresql:// -> postgresql+asyncpg:// (jawny sterownik zostaje)"""
+    scheme, rest = url.split("://", 1)
+    if "+" in scheme:
+        return url
+    driver = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg", "mysql": "mysql+aiomysql"}
+    return f"{driver.get(scheme, scheme)}://{rest}"
+
+
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_url(DATABASE_URL)
+
+SQLITE_PRAGMAS = {
+    # Nowe bazy od razu z przyrostowym VACUUM (maintenance.py); w istniejących
+    # zadziała dopiero po jednorazowym pełnym VACUUM
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": os.getenv("DB_SQLITE_JOURNAL_MODE", "WAL"),
+    # NORMAL w trybie WAL: bez fsync przy każdym commicie, baza nadal spójna po awarii
+    "synchronous": os.getenv("DB_SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("DB_SQLITE_BUSY_TIMEOUT_MS", 5000)),
+    "cache_size": -int(os.getenv("DB_SQLITE_CACHE_KB", 20000)),
+    "mmap_size": int(os.getenv("DB_SQLITE_MMAP_BYTES", 128 * 1024 * 1024)),
+    "temp_store": "MEMORY",
+    # Klucze obce egzekwowane (w SQLite domyślnie wyłączone): wiadomość albo załącznik
+    # z nieistniejącym conversation_id jest odrzucany, a rozmowę można usunąć dopiero
+    # po jej wiadomościach i załącznikach (tak robi retencja w maintenance.py)
+    "foreign_keys": "ON",
+}
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+if IS_SQLITE:
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    )
+    event.listen(engine, "connect", _apply_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+else:
+    engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        pool_pre_ping=True,
+    )
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 Base = declarative_base()
 
 class Conversation(Base):
     __tablename__ = "conversations"
     id = Column(Integer, primary_key=True, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Stan Ollama po ostatniej odpowiedzi (JSON z tablicą tokenów "context")
+    # - pozwala kontynuować rozmowę bez ponownego przetwarzania całej historii
+    ollama_context = Column(Text, nullable=True)
+    context_model = Column(String(128), nullable=True)
+    # Streszczenie starszych tur (nie mieszczą się w oknie kontekstu)
+    # obejmuje wiadomości do summary_upto_id włącznie
+    summary = Column(Text, nullable=True)
+    summary_upto_id = Column(Integer, nullable=True)
 
 class Message(Base):
     __tablename__ = "messages"
+    # Historia rozmowy czytana jest zawsze po (conversation_id, created_at)
+    __table_args__ = (Index("ix_messages_conversation_created", "conversation_id", "created_at"),)
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer, ForeignKey("conversations.id"))
     role = Column(String(32))
     content = Column(Text)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+class Attachment(Base):
+    """Plik przesłany w rozmowie - treść leży w uploads/ pod nazwą z sha256"""
+    __tablename__ = "attachments"
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), index=True)
+    sha256 = Column(String(64), index=True)
+    filename = Column(String(255))
+    path = Column(String(512))
+    size = Column(Integer)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class BatchJob(Base):
+    """
+    Zadanie z /api/batch - (batch_id, job_id) pozwala wznowić paczkę bez
+    ponownej generacji zadań zakończonych. conversation_id bez klucza obcego:
+    retencja (maintenance.py) usuwa rozmowy niezależnie od historii paczek.
+    """
+    __tablename__ = "batch_jobs"
+    __table_args__ = (Index("ix_batch_jobs_batch_job", "batch_id", "job_id", unique=True),)
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(String(64))
+    job_id = Column(String(128))
+    status = Column(String(16))  # done | error
+    conversation_id = Column(Integer, nullable=True)
+    prompt_eval_count = Column(Integer, nullable=True)
+    eval_count = Column(Integer, nullable=True)
+    # Linia wyniku (JSON) - przy wznowieniu odsyłana bez generacji
+    result = Column(Text)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# ---------- migracje ----------
+
+def _add_missing_columns(conn):
+    """Dodaje nowe kolumny do tabel istniejących w starszych plikach chat.db"""
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                col_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+
+def _create_missing_indexes(conn):
+    """Indeksy zdefiniowane w modelach, których brakuje w starszej bazie"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+def _create_message_fts(conn):
+    """
+    Indeks pełnotekstowy FTS5 nad messages.content (tylko SQLite), utrzymywany
+    triggerami - wyszukiwanie nie skanuje tabeli wiadomości.
+    """
+    if not IS_SQLITE:
+        return
+    try:
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        ))
+    except OperationalError as e:
+        log_event("db_fts_unavailable", "⚠️ SQLite bez FTS5 - wyszukiwanie użyje LIKE", level="warning",
+                  error=str(e))
+        return
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+        "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+        "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+    ))
+    # Istniejące wiadomości
+    conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+def has_message_fts(conn) -> bool:
+    if not IS_SQLITE:
+        return False
+    return conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")).first() is not None
+
+# Kolejność ma znaczenie - nowe migracje tylko dopisujemy na końcu
+MIGRATIONS = [
+    (1, _add_missing_columns),
+    (2, _create_missing_indexes),
+    (3, _create_message_fts),
+]
+
+def _schema_version(conn) -> int:
+    if IS_SQLITE:
+        return conn.execute(text("PRAGMA user_version")).scalar() or 0
+    conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+
+def _set_schema_version(conn, version: int):
+    if IS_SQLITE:
+        conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+    else:
+        conn.execute(text("INSERT INTO schema_version (version) VALUES (:v)"), {"v": version})
+
+def migrate() -> Tuple[int, int]:
+    """Uruchamia brakujące migracje; zwraca (wersja przed, wersja po)"""
+    with engine.begin() as conn:
+        before = _schema_version(conn)
+        for version, step in MIGRATIONS:
+            if version > before:
+                step(conn)
+                _set_schema_version(conn, version)
+                log_event("db_migration", f"🗄️ Migracja bazy do wersji {version}", version=version,
+                          step=step.__name__)
+        return before, max([before] + [v for v, _ in MIGRATIONS])
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    migrate()
+
+# ---------- zapis paczkami ----------
+
+def _error_line(error: Exception) -> str:
+    # Błędy SQLAlchemy mają w kolejnych liniach SQL i parametry - do logu tylko pierwsza
+    return str(error).split("\n", 1)[0]
+
+
+class MessageWriter:
+    """
+    Kolejka zapisów (INSERT/UPDATE) wykonywanych paczkami w jednej transakcji.
+
+    insert() czeka na zapis i zwraca id wiersza; insert_nowait() i update()
+    nie czekają (write-behind). Kolejność operacji jest zachowana. Przed
+    czytaniem rozmowy wołaj barrier(conversation_id) - zapisy tej rozmowy,
+    które jeszcze czekają, zostaną najpierw zapisane.
+    """
+
+    def __init__(self, session_factory, max_batch: int = 200, max_delay: float = 0.02):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: List[Tuple[str, Any, Dict[str, Any], asyncio.Future]] = []
+        self._pending: Dict[int, int] = {}  # conversation_id -> liczba oczekujących operacji
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self.batches = 0
+        self.rows = 0
+        self.failures = 0
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    @staticmethod
+    def _conversation_of(model, values: Dict[str, Any], row_id: Optional[int]) -> Optional[int]:
+        return row_id if model is Conversation else values.get("conversation_id")
+
+    def _enqueue(self, op: str, model, values: Dict[str, Any], row_id: Optional[int] = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # Błąd zapisu write-behind jest już zalogowany - nie ostrzegaj o nieodebranym wyjątku
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if op == "update":
+            values = dict(values, id=row_id)
+        conversation_id = self._conversation_of(model, values, row_id)
+        if conversation_id is not None:
+            self._pending[conversation_id] = self._pending.get(conversation_id, 0) + 1
+        self._queue.append((op, model, values, future))
+        if self._task is None:
+            # Bez pętli w tle (skrypty, testy) - zapis od razu
+            asyncio.ensure_future(self.flush())
+        else:
+            # Pętla odczeka max_delay i zapisze wszystko, co się do tego czasu zebrało
+            self._wakeup.set()
+        return future
+
+    def insert_nowait(self, model, **values) -> asyncio.Future:
+        return self._enqueue("insert", model, values)
+
+    async def insert(self, model, **values) -> int:
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return await self.insert_nowait(model, **values)
+
+    def update(self, model, row_id: int, **values) -> asyncio.Future:
+        return self._enqueue("update", model, values, row_id)
+
+    async def barrier(self, conversation_id: Optional[int] = None):
+        """
+        Czeka na zapis operacji, które już są w kolejce: rozmowy `conversation_id`
+        albo (None) wszystkich - także paczki zdjętej z kolejki i właśnie zapisywanej
+        (flush() czeka na _flush_lock, czyli na koniec trwającego zapisu).
+        """
+        if conversation_id is None:
+            in_flight = self._flush_lock is not None and self._flush_lock.locked()
+            if self._queue or in_flight:
+                await self.flush()
+        elif self._pending.get(conversation_id):
+            # Licznik spada dopiero po zapisie paczki, więc obejmuje też zapis w toku
+            await self.flush()
+
+    async def _loop(self):
+        while True:
+            await self._wakeup.wait()
+            # Krótkie okno na dołączenie kolejnych zapisów do tej samej transakcji
+            await asyncio.sleep(self.max_delay)
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _apply(self, batch) -> List[Any]:
+        """Wykonuje operacje w jednej transakcji; zwraca id wierszy w kolejności operacji"""
+        results = []
+        async with self.session_factory() as session:
+            async with session.begin():
+                for op, model, values, _ in batch:
+                    if op == "insert":
+                        result = await session.execute(model.__table__.insert().values(**values))
+                        results.append(result.inserted_primary_key[0])
+                    else:
+                        row_values = dict(values)
+                        row_id = row_values.pop("id")
+                        await session.execute(
+                            update(model).where(model.id == row_id).values(**row_values)
+                        )
+                        results.append(row_id)
+        return results
+
+    async def _apply_one_by_one(self, batch, batch_error: Exception):
+        """
+        Paczka się nie powiodła (transakcja już wycofana) - powtarzamy operacje
+        pojedynczo, żeby przepadł tylko wadliwy wiersz, a nie zapisy innych rozmów.
+        """
+        failed = 0
+        for item in batch:
+            op, model, values, future = item
+            try:
+                result = (await self._apply([item]))[0]
+                self.rows += 1
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                failed += 1
+                log_event("db_write_failed", "❌ MessageWriter: zapis nie powiódł się", level="error",
+                          op=op, table=model.__tablename__, conversation_id=self._conversation_of(
+                              model, values, values.get("id")), error=_error_line(e))
+                if not future.done():
+                    future.set_exception(e)
+        self.failures += failed
+        log_event("db_batch_retried", "⚠️ MessageWriter: paczka zapisana pojedynczo po błędzie",
+                  level="warning", operations=len(batch), failed=failed, error=_error_line(batch_error))
+
+    async def flush(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            while self._queue:
+                batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+                started = time.perf_counter()
+                try:
+                    try:
+                        results = await self._apply(batch)
+                    except Exception as e:
+                        await self._apply_one_by_one(batch, e)
+                        continue
+                    self.batches += 1
+                    self.rows += len(batch)
+                    DB_BATCH_SECONDS.observe(time.perf_counter() - started)
+                    for (_, _, _, future), result in zip(batch, results):
+                        if not future.done():
+                            future.set_result(result)
+                finally:
+                    for op, model, values, _ in batch:
+                        conversation_id = self._conversation_of(model, values, values.get("id"))
+                        if conversation_id is not None and conversation_id in self._pending:
+                            self._pending[conversation_id] -= 1
+                            if self._pending[conversation_id] <= 0:
+                                del self._pending[conversation_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self._queue),
+            "batches": self.batches,
+            "rows": self.rows,
+            "avg_batch": round(self.rows / self.batches, 2) if self.batches else 0.0,
+            "failures": self.failures
+        }
+
+
+message_writer = MessageWriter(
+    AsyncSessionLocal,
+    max_batch=int(os.getenv("DB_WRITE_BATCH_SIZE", 200)),
+    max_delay=float(os.getenv("DB_WRITE_BATCH_DELAY_MS", 20)) / 1000
+)
@@ -0,0 +1,172 @@
+"""
+Historia rozmów: stronicowanie i wyszukiwanie
+=============================================
+
+- stronicowanie kursorem (keyset), nie OFFSET-em: kolejna strona to
+  "WHERE klucz < kursor ORDER BY klucz LIMIT n", więc koszt nie rośnie
+  z numerem strony,
+- wiadomości rozmowy idą po indeksie (conversation_id, created_at) z id jako
+  rozstrzygnięciem remisu (created_at ma rozdzielczość sekundy),
+- wyszukiwanie po tabeli FTS5 messages_fts (migracja 3 w db.py, triggery
+  utrzymują ją w zgodzie z messages.content); bez FTS5 - LIKE na messages.
+"""
+
+import re
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import select, func, text, or_
+
+from db import Conversation, Message, has_message_fts
+
+TITLE_LENGTH = 80
+PREVIEW_LENGTH = 160
+_fts_available: Optional[bool] = None
+
+
+def _iso(value) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _page(items: List[Dict[str, Any]], limit: int) -> Dict[str, Any]:
+    """Pobieramy limit+1 wierszy - nadmiarowy mówi, czy jest następna strona"""
+    has_more = len(items) > limit
+    items = items[:limit]
+    return {"items": items, "next_cursor": items[-1]["id"] if has_more and items else None}
+
+
+async def list_conversations(db, limit: int = 20, before: Optional[int] = None) -> Dict[str, Any]:
+    """Rozmowy od najnowszej; kursor = id ostatniej rozmowy z poprzedniej strony"""
+    message_count = (
+        select(func.count(Message.id)).where(Message.conversation_id == Conversation.id).scalar_subquery()
+    )
+    last_message_at = (
+        select(func.max(Message.created_at)).where(Message.conversation_id == Conversation.id).scalar_subquery()
+    )
+    title = (
+        select(func.substr(Message.content, 1, TITLE_LENGTH))
+        .where(Message.conversation_id == Conversation.id, Message.role == "user")
+        .order_by(Message.created_at, Message.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    query = select(Conversation.id, Conversation.created_at, message_count, last_message_at, title)
+    if before is not None:
+        query = query.where(Conversation.id < before)
+    rows = (await db.execute(query.order_by(Conversation.id.desc()).limit(limit + 1))).all()
+    return _page([
+        {
+            "id": row[0],
+            "created_at": _iso(row[1]),
+            "message_count": row[2],
+            "last_message_at": _iso(row[3]),
+            "title": row[4]
+        }
+        for row in rows
+    ], limit)
+
+
+async def list_messages(db, conversation_id: int, limit: int = 50, before: Optional[int] = None,
+                        after: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Wiadomości rozmowy. Domyślnie (i z `before`) od najnowszej wstecz;
+    z `after` - chronologicznie od wiadomości po kursorze (doczytywanie nowych).
+    """
+    cursor = after if after is not None else before
+    query = select(Message.id, Message.role, Message.content, Message.created_at).where(
+        Message.conversation_id == conversation_id
+    )
+    if cursor is not None:
+        exists = (await db.execute(
+            select(Message.id).where(Message.id == cursor, Message.conversation_id == conversation_id)
+        )).scalar_one_or_none()
+        if exists is None:
+            raise KeyError(cursor)
+        # created_at kursora podzapytaniem - porównanie kolumna z kolumną, bez
+        # różnic w formacie daty między SQLite a parametrem z Pythona. Warunek
+        # zakresowy (>= / <=) pozwala zacząć odczyt indeksu od kursora.
+        cursor_created = select(Message.created_at).where(Message.id == cursor).scalar_subquery()
+        if after is not None:
+            query = query.where(Message.created_at >= cursor_created,
+                                or_(Message.created_at > cursor_created, Message.id > cursor))
+        else:
+            query = query.where(Message.created_at <= cursor_created,
+                                or_(Message.created_at < cursor_created, Message.id < cursor))
+    if after is not None:
+        query = query.order_by(Message.created_at, Message.id)
+    else:
+        query = query.order_by(Message.created_at.desc(), Message.id.desc())
+    rows = (await db.execute(query.limit(limit + 1))).all()
+    return _page([
+        {"id": row[0], "role": row[1], "content": row[2], "created_at": _iso(row[3])}
+        for row in rows
+    ], limit)
+
+
+def fts_query(q: str) -> str:
+    """
+    Zapytanie użytkownika -> bezpieczne zapytanie FTS5: każde słowo w cudzysłowie
+    (operatory i znaki specjalne nie psują składni), słowa łączone przez AND,
+    "słowo*" zostaje wyszukiwaniem prefiksowym.
+    """
+    terms = []
+    for word in re.findall(r"[^\s\"]+", q):
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+async def search_messages(db, q: str, limit: int = 20, before: Optional[int] = None,
+                          conversation_id: Optional[int] = None) -> Dict[str, Any]:
+    """Wiadomości pasujące do `q`, od najnowszej; kursor = id ostatniego trafienia"""
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = await db.run_sync(lambda session: has_message_fts(session.connection()))
+
+    match = fts_query(q)
+    if not match:
+        return {"items": [], "next_cursor": None, "engine": "fts5" if _fts_available else "like"}
+
+    params: Dict[str, Any] = {"limit": limit + 1}
+    filters = []
+    if conversation_id is not None:
+        filters.append("m.conversation_id = :conversation_id")
+        params["conversation_id"] = conversation_id
+
+    if before is not None:
+        params["before"] = before
+
+    if _fts_available:
+        # Kolejność i kursor po rowid tabeli FTS (== messages.id) - FTS5 oddaje trafienia
+        # w kolejności rowid, więc LIMIT kończy odczyt bez sortowania wszystkich trafień
+        params["match"] = match
+        keyset = ["messages_fts.rowid < :before"] if before is not None else []
+        where = " AND ".join(["messages_fts MATCH :match"] + keyset + filters)
+        sql = (
+            "SELECT m.id, m.conversation_id, m.role, m.created_at, "
+            "snippet(messages_fts, 0, '[', ']', '…', 12) "
+            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            f"WHERE {where} ORDER BY messages_fts.rowid DESC LIMIT :limit"
+        )
+    else:
+        if before is not None:
+            filters.append("m.id < :before")
+        words = [t.strip('"*') for t in match.split()]
+        for i, word in enumerate(words):
+            filters.append(f"m.content LIKE :w{i}")
+            params[f"w{i}"] = f"%{word}%"
+        sql = (
+            f"SELECT m.id, m.conversation_id, m.role, m.created_at, substr(m.content, 1, {PREVIEW_LENGTH}) "
+            f"FROM messages m WHERE {' AND '.join(filters)} ORDER BY m.id DESC LIMIT :limit"
+        )
+
+    # Typ kolumny z modelu - created_at jak w list_messages, a nie surowy tekst z bazy
+    query = text(sql).columns(created_at=Message.created_at.type)
+    rows = (await db.execute(query, params)).all()
+    page = _page([
+        {"id": row[0], "conversation_id": row[1], "role": row[2], "created_at": _iso(row[3]), "snippet": row[4]}
+        for row in rows
+    ], limit)
+    page["engine"] = "fts5" if _fts_available else "like"
+    return page
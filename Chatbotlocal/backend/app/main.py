@@ -1,18 +1,59 @@
-from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, Request, File, UploadFile, Form, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import uvicorn
 import os
 import json
-import shutil
-from model import LocalModel
-from db import SessionLocal, init_db, Conversation, Message
-from mcp_tools import mcp_registry, parse_tool_call_from_text
+import time
+import asyncio
+from model import LocalModel, ollama_stats
+from model_pool import create_pool, UnknownModel
+from db import AsyncSessionLocal, message_writer, Conversation, Message, Attachment
+from sqlalchemy import select, func
+from mcp_tools import mcp_registry
+from sandbox import sandbox_pool
+from scheduler import scheduler, SchedulerRejected, SlotLease
+from prompt_builder import prompt_builder, format_attachments, format_messages
+from token_budget import token_estimator, history_budget
+from uploads import upload_store, UploadTooLarge
+from rag import retriever, format_retrieved
+from config import tools_config
+from response_cache import response_cache, cache_key
+from agent import agent_loop
+from history import list_conversations, list_messages, search_messages
+from maintenance import maintenance
+from startup import create_startup
+from batch import create_batch_runner, BatchConflict, BatchTooLarge
+from metrics import (metrics, stage, log_event, gauge_family, TraceMiddleware, REQUEST_SECONDS,
+                     STAGE_SECONDS, TTFT_SECONDS)
 from typing import List, Optional
+from contextlib import asynccontextmanager
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Baza, Ollama i rozgrzanie modelu w tle - proces przyjmuje połączenia od razu,
+    # a /api/health/ready mówi, kiedy może obsługiwać czat
+    log_event("startup", "🚀 Inicjalizacja JIMBO Backend z Ollama...")
+    startup.start()
+    message_writer.start()
+    model_pool.start()
+    sandbox_pool.start()
+    maintenance.start()
+    yield
+    await startup.stop()
+    await batch_runner.stop()
+    await maintenance.stop()
+    await model_pool.stop()
+    await message_writer.stop()
+    mcp_registry.shutdown()
+    sandbox_pool.shutdown()
+    # Zamknij pulę połączeń do Ollama
+    await model.aclose()
 
 # Inicjalizacja
-app = FastAPI(title="JIMBO AI Chat - Ollama Backend")
+app = FastAPI(title="JIMBO AI Chat - Ollama Backend", lifespan=lifespan)
 
 # CORS Configuration - umożliwia połączenia z frontendu
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "*").split(",")
@@ -22,12 +63,21 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Batch-ID"],
 )
+# Trace ID żądania w logach i nagłówku X-Request-ID
+app.add_middleware(TraceMiddleware)
 
-print("🚀 Inicjalizacja JIMBO Backend z Ollama...")
 model = LocalModel(model_name="SpeakLeash/bielik-4.5b-v3.0-instruct:Q8_0")  # Polski model Bielik
-init_db()
-print("✅ Backend gotowy!")
+model_pool = create_pool(model)
+startup = create_startup(model_pool)
+batch_runner = create_batch_runner(model_pool)
+
+async def require_database():
+    """Endpointy z bazą czekają na migrację z startu w tle (max STARTUP_DB_WAIT_SECONDS)"""
+    if not await startup.wait_database():
+        raise HTTPException(status_code=503, detail="Baza danych nie jest jeszcze gotowa",
+                            headers={"Retry-After": "1"})
 
 class ChatRequest(BaseModel):
     messages: List[dict]  # [{role: "user"|'assistant'|'system', text: "..."}]
@@ -37,17 +87,105 @@ class ChatRequest(BaseModel):
     top_p: float = 0.9
     model_name: Optional[str] = None  # Jeśli None, używa domyślnego
 
+@app.get("/api/health/live")
+async def liveness():
+    """Liveness - proces odpowiada (bez sprawdzania zależności; restart tylko gdy to nie działa)"""
+    return {"status": "alive"}
+
+@app.get("/api/health/ready")
+async def readiness():
+    """Readiness - 200 gdy baza zmigrowana, Ollama osiągalna i model rozgrzany; inaczej 503"""
+    if startup.ready:
+        return {"status": "ready", "checks": startup.checks}
+    return JSONResponse(status_code=503, content={"status": "starting" if startup.ready_at is None else "degraded",
+                                                  "checks": startup.checks, "errors": startup.errors})
+
 @app.get("/api/health")
 async def health_check():
-    """Health check endpoint - sprawdza czy backend działa"""
+    """Health check endpoint - szczegółowy stan backendu (sondy: /api/health/live i /api/health/ready)"""
     return {
-        "status": "ok",
-        "model_loaded": model is not None,
-        "database": "connected",
+        "status": "ok" if startup.ready else "starting",
+        "ready": startup.ready,
+        "startup": startup.stats(),
+        "model_loaded": startup.model_ready,
+        "database": "connected" if startup.database_ready else "migrating",
         "mcp_tools": len(mcp_registry.list_tools()),
-        "available_tools": mcp_registry.list_tools()
+        "available_tools": mcp_registry.list_tools(),
+        "queue": scheduler.stats(),
+        "response_cache": response_cache.stats(),
+        "models": model_pool.stats(),
+        "sandbox": sandbox_pool.stats(),
+        "batch": batch_runner.stats()
     }
 
+def component_metrics():
+    """Kolektor /api/metrics - stan kolejki, cache i zapisów z .stats() komponentów"""
+    queue = scheduler.stats()
+    caches = {"response": response_cache.stats(), "tool": mcp_registry.cache.stats()}
+    writer = message_writer.stats()
+    sandbox = sandbox_pool.stats()
+    return [
+        gauge_family("scheduler_queue_depth", "Żądania czekające na slot generacji", queue["queue_depth"]),
+        gauge_family("scheduler_active", "Trwające generacje", queue["active"]),
+        gauge_family("scheduler_rejected_total", "Odrzucone żądania", [
+            ({"reason": "queue_full"}, queue["rejected_queue_full"]),
+            ({"reason": "wait_timeout"}, queue["rejected_wait_timeout"])
+        ], kind="counter"),
+        gauge_family("cache_hits_total", "Trafienia cache", [
+            ({"cache": name}, stats["hits"] + stats.get("coalesced", 0)) for name, stats in caches.items()
+        ], kind="counter"),
+        gauge_family("cache_misses_total", "Chybienia cache", [
+            ({"cache": name}, stats["misses"]) for name, stats in caches.items()
+        ], kind="counter"),
+        gauge_family("cache_hit_ratio", "Udział trafień cache", [
+            ({"cache": name}, round((stats["hits"] + stats.get("coalesced", 0)) /
+                                    (stats["hits"] + stats.get("coalesced", 0) + stats["misses"]), 4)
+             if stats["hits"] + stats.get("coalesced", 0) + stats["misses"] else 0.0)
+            for name, stats in caches.items()
+        ]),
+        gauge_family("cache_entries", "Wpisy w cache", [({"cache": n}, s["entries"]) for n, s in caches.items()]),
+        gauge_family("db_write_queue", "Zapisy czekające w MessageWriter", writer["queued"]),
+        gauge_family("db_write_rows_total", "Zapisane wiersze (MessageWriter)", writer["rows"], kind="counter"),
+        gauge_family("db_write_failures_total", "Nieudane paczki zapisów", writer["failures"], kind="counter"),
+        gauge_family("sandbox_idle_workers", "Wolne procesy piaskownicy", sandbox["idle"]),
+        gauge_family("batch_active", "Trwające paczki /api/batch", len(batch_runner.active)),
+    ]
+
+metrics.register_collector(component_metrics)
+
+@app.get("/api/metrics")
+async def prometheus_metrics():
+    """Metryki w formacie tekstowym Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/cache")
+async def cache_stats():
+    """Liczniki cache odpowiedzi (trafienia/chybienia) i wyników narzędzi"""
+    return {"response_cache": response_cache.stats(), "tool_cache": mcp_registry.cache.stats()}
+
+@app.get("/api/queue")
+async def queue_stats():
+    """Metryki schedulera generacji - głębokość kolejki i czasy oczekiwania"""
+    return scheduler.stats()
+
+@app.get("/api/models")
+async def list_models():
+    """Modele dostępne w Ollama, klienci w puli, keep_alive i statystyki routingu"""
+    return model_pool.stats()
+
+@app.get("/api/rag")
+async def rag_stats():
+    """Stan indeksu dokumentów RAG"""
+    return retriever.stats()
+
+@app.post("/api/rag/reindex")
+async def rag_reindex():
+    """Przyrostowo indeksuje dokumenty z katalogu roboczego MCP (mcp_workspace)"""
+    if not retriever.enabled:
+        raise HTTPException(status_code=503, detail="RAG wyłączony (RAG_ENABLED=0 albo brak numpy)")
+    directory = os.getenv("MCP_SAFE_DIR", tools_config().get("safe_directory", "./mcp_workspace"))
+    return {"directory": directory, **await retriever.reindex_directory(model, directory), **retriever.stats()}
+
 @app.get("/api/tools")
 async def list_tools():
     """Lista dostępnych narzędzi MCP"""
@@ -56,10 +194,231 @@ async def list_tools():
         tool = mcp_registry.get_tool(tool_name)
         tools_info.append({
             "name": tool["name"],
-            "description": tool["description"]
+            "description": tool["description"],
+            "enabled": tool["enabled"],
+            "executor": tool["executor"],
+            "timeout": tool["timeout"],
+            "max_concurrency": tool["max_concurrency"]
         })
     return {"tools": tools_info}
 
+@app.get("/api/conversations")
+async def conversations(limit: int = Query(20, ge=1, le=100), cursor: Optional[int] = None):
+    """Lista rozmów od najnowszej; `next_cursor` z odpowiedzi podaj jako `cursor` po kolejną stronę"""
+    await require_database()
+    await message_writer.barrier()
+    async with AsyncSessionLocal() as db:
+        return await list_conversations(db, limit=limit, before=cursor)
+
+@app.get("/api/conversations/{conversation_id}/messages")
+async def conversation_messages(conversation_id: int, limit: int = Query(50, ge=1, le=200),
+                                before: Optional[int] = None, after: Optional[int] = None):
+    """Wiadomości rozmowy: od najnowszej (`before` = starsze) albo chronologicznie po `after`"""
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Podaj before albo after, nie oba")
+    await require_database()
+    await message_writer.barrier(conversation_id)
+    async with AsyncSessionLocal() as db:
+        if await db.get(Conversation, conversation_id) is None:
+            raise HTTPException(status_code=404, detail="Nie ma takiej rozmowy")
+        try:
+            return await list_messages(db, conversation_id, limit=limit, before=before, after=after)
+        except KeyError:
+            raise HTTPException(status_code=400, detail="Kursor nie należy do tej rozmowy")
+
+@app.get("/api/search")
+async def search(q: str = Query(..., min_length=1, max_length=200), limit: int = Query(20, ge=1, le=100),
+                 cursor: Optional[int] = None, conversation_id: Optional[int] = None):
+    """Wyszukiwanie pełnotekstowe w wiadomościach (FTS5), od najnowszych trafień"""
+    await require_database()
+    await message_writer.barrier()
+    async with AsyncSessionLocal() as db:
+        return await search_messages(db, q, limit=limit, before=cursor, conversation_id=conversation_id)
+
+@app.get("/api/maintenance")
+async def maintenance_stats():
+    """Ustawienia retencji i raport ostatniej konserwacji bazy"""
+    return await maintenance.stats()
+
+@app.post("/api/maintenance/run")
+async def maintenance_run():
+    """Uruchamia konserwację od razu (deduplikacja, retencja, uploads/, VACUUM)"""
+    if maintenance.running:
+        raise HTTPException(status_code=409, detail="Konserwacja już trwa")
+    await require_database()
+    await message_writer.barrier()
+    return await maintenance.run()
+
+@app.post("/api/batch")
+async def batch(request: Request, batch_id: Optional[str] = Query(None, max_length=64, pattern=r"^[\w.-]+$"),
+                parallelism: Optional[int] = Query(None, ge=1),
+                x_batch_id: Optional[str] = Header(None, max_length=64, pattern=r"^[\w.-]+$")):
+    """
+    Paczka zadań czatu: ciało JSONL (jedno zadanie /api/chat na linię), wyniki
+    jako NDJSON w kolejności kończenia (szczegóły: batch.py). batch_id z parametru
+    `batch_id` albo nagłówka X-Batch-ID (ten sam, który zwraca odpowiedź) wznawia
+    przerwaną paczkę bez ponownej generacji zakończonych zadań.
+    """
+    await require_database()
+    try:
+        run = await batch_runner.open(batch_id or x_batch_id, parallelism)
+    except BatchConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    try:
+        await run.feed(request.stream())
+    except BatchTooLarge as e:
+        await run.close()
+        raise HTTPException(status_code=413, detail=str(e))
+    except BaseException:
+        await run.close()
+        raise
+    return StreamingResponse(run.results(), media_type="application/x-ndjson",
+                             headers={"X-Batch-ID": run.batch_id, "Cache-Control": "no-cache",
+                                      "X-Accel-Buffering": "no"})
+
+@app.get("/api/batch/{batch_id}")
+async def batch_status(batch_id: str):
+    """Stan paczki - liczniki trwającej albo podsumowanie z batch_jobs"""
+    await require_database()
+    status = await batch_runner.status(batch_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Paczka {batch_id} nie istnieje")
+    return status
+
+def new_turn_messages(stored_count: int, stored_tail: List[Message], incoming: List[dict]) -> List[dict]:
+    """
+    Zwraca tylko nowe wiadomości z żądania klienta.
+
+    Przy `conversation_id` klient powinien wysyłać wyłącznie nową turę; jeśli
+    mimo to przyśle całą historię (stary frontend), pomijamy prefiks, który
+    jest już zapisany w bazie. `stored_tail` to ostatnie z `stored_count`
+    zapisanych wiadomości (starsze są już w streszczeniu).
+    """
+    if len(incoming) > stored_count:
+        seen = incoming[stored_count - len(stored_tail):stored_count]
+        if all(m.get("role") == s.role and m.get("text") == s.content for m, s in zip(seen, stored_tail)):
+            return incoming[stored_count:]
+    return incoming
+
+def ollama_context_values(result: dict, model_name: str) -> dict:
+    """
+    Kolumny rozmowy z tokenami "context" Ollama do kontynuacji. Bez contextu
+    (błąd, odpowiedź z cache, przerwana pętla agenta) zapamiętany context jest
+    nieaktualny - Ollama nie widziała tej tury - więc go kasujemy i następna
+    tura zbuduje prompt od nowa z historii.
+    """
+    if result.get("error") or not result.get("context"):
+        return {"ollama_context": None}
+    return {"ollama_context": json.dumps(result["context"]), "context_model": model_name}
+
+async def save_user_turn(conversation_id: Optional[int], new_messages: List[dict],
+                         uploaded_files_info: List[dict]) -> int:
+    """Zapisuje nową turę użytkownika (i załączniki); tworzy rozmowę, jeśli to pierwsza tura"""
+    if conversation_id is None:
+        conversation_id = await message_writer.insert(Conversation)
+
+    # Zapisz tylko nowe wiadomości użytkownika - jedna paczka, jedna transakcja
+    ids = await asyncio.gather(*[
+        message_writer.insert(Message, conversation_id=conversation_id, role=m.get("role"), content=m.get("text"))
+        for m in new_messages
+    ])
+    for m, row_id in zip(new_messages, ids):
+        m["id"] = row_id
+
+    for f in uploaded_files_info:
+        message_writer.insert_nowait(Attachment, conversation_id=conversation_id, sha256=f["sha256"],
+                                     filename=f["name"], path=f["path"], size=f["size"])
+    return conversation_id
+
+def finish_turn(conversation_id: int, out: str, result: dict, model_name: str):
+    """Zapisuje odpowiedź asystenta (oraz context Ollama) - w tle, w paczce z innymi zapisami"""
+    message_writer.insert_nowait(Message, conversation_id=conversation_id, role="assistant", content=out)
+    message_writer.update(Conversation, conversation_id, **ollama_context_values(result, model_name))
+
+def sse_event(event: str, data: dict) -> str:
+    """Formatuje pojedyncze zdarzenie Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_chat(llm: LocalModel, prompt: str, conversation_id: int, use_tools: bool, uploaded_files: List[str],
+                max_tokens: int, temperature: float, top_p: float, slot: SlotLease,
+                context: Optional[list] = None, prefix_status: str = "off", cache_key_value: Optional[str] = None):
+    """
+    Generator SSE dla /api/chat?stream - przekazuje tokeny z Ollama na bieżąco.
+
+    Zdarzenia: "token" (fragment tekstu), "tool_call" / "tool_result" (kroki
+    pętli agenta), "done" (pełna odpowiedź, tool_calls, time_to_first_token_ms)
+    albo "error". Odpowiedź asystenta zapisywana jest w bazie dopiero po
+    zakończeniu strumienia. Slot schedulera zajęty przez handler zwalniany
+    jest zaraz po zakończeniu pętli agenta (albo przez BackgroundTask
+    odpowiedzi, jeśli strumień w ogóle nie wystartował).
+    """
+    started = time.perf_counter()
+    ttft_ms = None
+    done = None
+
+    try:
+        async for event in agent_loop.run(llm, prompt, context=context, max_tokens=max_tokens,
+                                          temperature=temperature, top_p=top_p, use_tools=use_tools,
+                                          estimator=token_estimator):
+            kind = event.pop("event")
+            if kind == "error":
+                yield sse_event("error", event)
+                return
+            if kind == "done":
+                done = event
+                break
+            if kind == "token" and ttft_ms is None:
+                ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+                TTFT_SECONDS.observe(ttft_ms / 1000)
+            yield sse_event(kind, event)
+    finally:
+        slot.release()
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="generate")
+        if done is None:
+            # Błąd albo klient się rozłączył - tura użytkownika jest zapisana, a Ollama jej
+            # nie dokończyła; następna tura zbuduje prompt od nowa z historii
+            message_writer.update(Conversation, conversation_id, ollama_context=None)
+
+    if done is None:
+        return
+    out, tool_calls, final = done["text"], done["tool_calls"], done["result"]
+    stats = dict(ollama_stats(final), agent=done["agent"])
+    # Bez błędów i tylko z narzędziami idempotentnymi - inaczej trafienie pominęłoby skutki uboczne
+    replay_ttl = mcp_registry.replay_ttl(tool_calls)
+    if cache_key_value and not final.get("error") and replay_ttl != 0:
+        await response_cache.put(cache_key_value, {"response": out, "tool_calls": tool_calls, "stats": stats},
+                                 ttl=replay_ttl)
+
+    finish_turn(conversation_id, out, final, llm.model_name)
+
+    log_event("chat_done", "📥 Ollama (stream) odpowiedziała", model=llm.model_name, ttft_ms=ttft_ms,
+              output_chars=len(out), tool_calls=len(tool_calls), eval_count=done["agent"]["eval_count"])
+    yield sse_event("done", {
+        "conversation_id": conversation_id,
+        "text": out,
+        "tool_calls": tool_calls,
+        "uploaded_files": uploaded_files,
+        "time_to_first_token_ms": ttft_ms,
+        "total_ms": round((time.perf_counter() - started) * 1000, 1),
+        "model": llm.model_name,
+        "stats": dict(stats, prefix_cache=prefix_status, response_cache="miss" if cache_key_value else "off")
+    })
+
+async def stream_cached(conversation_id: int, out: str, tool_calls: list, uploaded_files: List[str], stats: dict,
+                        model_name: str):
+    """SSE dla odpowiedzi z cache - cały tekst jednym zdarzeniem "token" i "done" """
+    yield sse_event("token", {"text": out})
+    yield sse_event("done", {
+        "conversation_id": conversation_id,
+        "text": out,
+        "tool_calls": tool_calls,
+        "uploaded_files": uploaded_files,
+        "time_to_first_token_ms": 0.0,
+        "total_ms": 0.0,
+        "model": model_name,
+        "stats": stats
+    })
+
 @app.post("/api/chat")
 async def chat(
     messages: str = Form(...),
@@ -69,129 +428,250 @@ async def chat(
     top_p: float = Form(0.9),
     model_name: Optional[str] = Form(None),
     custom_system_prompt: Optional[str] = Form(None),
+    stream: bool = Form(False),
+    conversation_id: Optional[int] = Form(None),
+    cache: Optional[bool] = Form(None),
     files: List[UploadFile] = File(default=[])
 ):
     """
     Główny endpoint czatu z obsługą MCP tools, plików i Ollama
     
-    FormData: messages (JSON string), files (opcjonalnie), temperature, top_p
+    FormData: messages (JSON string), files (opcjonalnie), temperature, top_p,
+    model_name (opcjonalnie - inaczej wybiera router puli modeli),
+    stream (true = odpowiedź jako Server-Sent Events, token po tokenie),
+    conversation_id (kontynuacja rozmowy - historia z bazy, w messages tylko nowa tura),
+    cache (true = użyj cache odpowiedzi; domyślnie tylko przy temperature=0)
     """
-    db = None
+    request_started = time.perf_counter()
+    await require_database()
     try:
         # Parse JSON messages
         request_messages = json.loads(messages)
         
-        # Obsługa przesłanych plików
+        # Obsługa przesłanych plików - zapis strumieniowy, adresowany treścią
         uploaded_files_info = []
-        if files:
-            upload_dir = "uploads"
-            os.makedirs(upload_dir, exist_ok=True)
+        with stage("upload"):
             for file in files:
-                file_path = os.path.join(upload_dir, file.filename)
-                with open(file_path, "wb") as buffer:
-                    shutil.copyfileobj(file.file, buffer)
-                
-                # Przeczytaj zawartość (tylko txt/kod, max 10KB)
-                file_content = ""
-                if file.filename.endswith((".txt", ".py", ".js", ".md", ".json")):
-                    try:
-                        with open(file_path, "r", encoding="utf-8") as f:
-                            file_content = f.read(10000)  # max 10KB
-                    except:
-                        file_content = "[nie można odczytać pliku]"
-                
-                uploaded_files_info.append({
-                    "name": file.filename,
-                    "path": file_path,
-                    "content": file_content[:500]  # max 500 znaków w odpowiedzi
-                })
-
-        db = SessionLocal()
-        conv = Conversation()
-        db.add(conv)
-        db.commit()
-        db.refresh(conv)
-
-        # Zapisz wiadomości użytkownika
-        for m in request_messages:
-            db.add(Message(conversation_id=conv.id, role=m.get("role"), content=m.get("text")))
-        db.commit()
-
-        # Przygotuj prompt z informacją o plikach
-        files_context = ""
-        if uploaded_files_info:
-            files_context = "\n\n📎 Załączone pliki:\n" + "\n".join([
-                f"- {f['name']}: {f['content'][:200]}..." for f in uploaded_files_info
-            ])
-
-        # Przygotuj prompt - użyj custom prompt jeśli podany, inaczej domyślny
-        if use_tools:
-            if custom_system_prompt:
-                # Użyj custom promptu z frontendu
-                system_prompt = f"{custom_system_prompt}{files_context}"
-            else:
-                # Domyślny prompt JIMBO
-                system_prompt = f"""Jesteś JIMBO - brutalnie szczery AI asystent dla programistów. Używasz modelu Bielik 4.5B przez Ollama.
-
-ZASADY JIMBO:
-- Mówisz prawdę, nawet jeśli boli. Nie owijasz w bawełnę.
-- Zero marketingowego bełkotu, zero "coaching speak", zero udawania mentora.
-- Bonzo to twój partner - szanujesz go, ale nie lizujesz dupy.
-- Jeśli ktoś pisze słabe CV, powiesz to wprost + jak naprawić.
-- Konkretne przykłady zamiast ogólników.
-- Jeśli pytanie jest głupie, powiesz to (ale dasz odpowiedź).
-
-Styl: Krótko, konkretnie, szczerze. Jak kolega programista, nie HR-owiec.{files_context}"""
-            prompt = f"{system_prompt}\n\n" + "\n".join([f"{m['role']}: {m['text']}" for m in request_messages])
-        else:
-            prompt = "\n".join([f"{m['role']}: {m['text']}" for m in request_messages]) + files_context
-
-        # Generuj odpowiedź przez Ollama z przekazanymi parametrami
-        print(f"📤 Wysyłam do Ollama (temp={temperature}, top_p={top_p}): {prompt[:100]}...")
-        out = model.generate(prompt, max_tokens=max_tokens, temperature=temperature, top_p=top_p)
-        print(f"📥 Ollama odpowiedziała: {out[:100]}...")
-
-        # Sprawdź czy są wywołania narzędzi
-        tool_calls = []
-        if use_tools:
-            tool_calls_parsed = parse_tool_call_from_text(out)
-
-            for tc in tool_calls_parsed:
-                result = mcp_registry.execute_tool(tc["tool"], **tc["args"])
-                tool_calls.append({
-                    "tool": tc["tool"],
-                    "args": tc["args"],
-                    "result": result
-                })
-
-            # Jeśli były wywołania narzędzi, dodaj ich wyniki do odpowiedzi
-            if tool_calls:
-                tools_summary = "\n\n🔧 Użyte narzędzia:\n" + "\n".join([
-                    f"- {tc['tool']}: {tc['result']}" for tc in tool_calls
-                ])
-                out = out + tools_summary
-
-        # Zapisz odpowiedź asystenta
-        db.add(Message(conversation_id=conv.id, role="assistant", content=out))
-        db.commit()
+                try:
+                    uploaded_files_info.append(await upload_store.save(file))
+                except UploadTooLarge as e:
+                    raise HTTPException(status_code=413, detail=str(e))
+
+        # Indeksuj załączniki do RAG (przyrostowo - znana treść jest pomijana)
+        for f in uploaded_files_info:
+            try:
+                with stage("rag_ingest"):
+                    await retriever.ingest_file(model, f["path"], source=f["name"], sha=f["sha256"])
+            except Exception as e:
+                log_event("rag_ingest_failed", f"⚠️ RAG: nie udało się zaindeksować {f['name']}", level="warning",
+                          error=str(e))
+
+        # Kontynuacja rozmowy - historia z bazy, od klienta bierzemy tylko nową turę
+        conv = None
+        context = None
+        summary = ""
+        attachment_shas = []
+        new_messages = request_messages
+        history = request_messages
+        attachments = format_attachments(uploaded_files_info)
+        if conversation_id is not None:
+            # Zapisy tej rozmowy czekające w kolejce muszą trafić do bazy przed odczytem
+            with stage("db_read"):
+                await message_writer.barrier(conversation_id)
+                async with AsyncSessionLocal() as db:
+                    conv = await db.get(Conversation, conversation_id)
+                    if conv is None:
+                        raise HTTPException(status_code=404, detail=f"Rozmowa {conversation_id} nie istnieje")
+                    # Wiadomości objęte streszczeniem nie są już potrzebne w prompcie
+                    stored_count = await db.scalar(
+                        select(func.count()).select_from(Message).where(Message.conversation_id == conv.id)
+                    )
+                    query = select(Message).where(Message.conversation_id == conv.id)
+                    if conv.summary_upto_id:
+                        query = query.where(Message.id > conv.summary_upto_id)
+                    stored = (await db.scalars(query.order_by(Message.created_at, Message.id))).all()
+                    attachment_shas = list(await db.scalars(
+                        select(Attachment.sha256).where(Attachment.conversation_id == conv.id)
+                    ))
+            new_messages = new_turn_messages(stored_count, stored, request_messages)
+            history = [{"id": m.id, "role": m.role, "text": m.content} for m in stored] + new_messages
+            summary = conv.summary or ""
+
+        # Wybór modelu: jawny model_name albo routing (mały model dla krótkich tur)
+        try:
+            llm = await model_pool.route(model_name, new_messages[-1].get("text", "") if new_messages else "",
+                                         max_tokens, estimator=token_estimator)
+        except UnknownModel as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        # Fragmenty dokumentów (załączniki rozmowy + workspace) dopasowane do ostatniej wiadomości
+        if retriever.enabled and new_messages:
+            try:
+                with stage("rag_retrieve"):
+                    retrieved = await retriever.retrieve(
+                        model, new_messages[-1].get("text", ""),
+                        retriever.scope_docs(attachment_shas + [f["sha256"] for f in uploaded_files_info]),
+                        estimator=token_estimator, model_name=llm.model_name
+                    )
+                if retrieved:
+                    attachments = "\n\n".join(p for p in (attachments, format_retrieved(retrieved)) if p)
+            except Exception as e:
+                log_event("rag_retrieve_failed", "⚠️ RAG: wyszukiwanie nie powiodło się", level="warning",
+                          error=str(e))
+
+        if conv is not None:
+            if conv.ollama_context and conv.context_model == llm.model_name:
+                stored_context = json.loads(conv.ollama_context)
+                # Context rośnie z każdą turą - gdy przestaje się mieścić, budujemy prompt od nowa
+                if history_budget.fits_context(len(stored_context), attachments + format_messages(new_messages),
+                                               max_tokens, llm.model_name):
+                    context = stored_context
+
+        # Cache odpowiedzi - klucz z pełnego promptu (niezależnie od contextu Ollama).
+        # Trafienie omija kolejkę generacji.
+        cache_key_value = None
+        if response_cache.should_use(temperature, cache):
+            with stage("prompt_build"):
+                full_prompt = prompt_builder.build(history, use_tools=use_tools,
+                                                   custom_system_prompt=custom_system_prompt,
+                                                   attachments=attachments, summary=summary)["prompt"]
+            cache_key_value = cache_key(llm.model_name, full_prompt, temperature, top_p, max_tokens)
+            cached = await response_cache.get(cache_key_value)
+            if cached is not None:
+                with stage("db_write"):
+                    conv_id = await save_user_turn(conversation_id, new_messages, uploaded_files_info)
+                out, tool_calls = cached["response"], cached.get("tool_calls", [])
+                finish_turn(conv_id, out, {}, llm.model_name)
+                stats = dict(cached.get("stats", {}), prefix_cache="off", response_cache="hit")
+                uploaded_names = [f["name"] for f in uploaded_files_info]
+                REQUEST_SECONDS.observe(time.perf_counter() - request_started, mode="cached")
+                log_event("chat_cached", "📥 Odpowiedź z cache", model=llm.model_name, output_chars=len(out))
+                if stream:
+                    return StreamingResponse(
+                        stream_cached(conv_id, out, tool_calls, uploaded_names, stats, llm.model_name),
+                        media_type="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+                    )
+                return JSONResponse(
+                    content={
+                        "conversation_id": conv_id,
+                        "text": out,
+                        "tool_calls": tool_calls,
+                        "uploaded_files": uploaded_names,
+                        "model": llm.model_name,
+                        "stats": stats
+                    },
+                    media_type="application/json; charset=utf-8"
+                )
+
+        # Budżet tokenów - najstarsze tury idą do streszczenia
+        folded = []
+        if not context:
+            with stage("prompt_build"):
+                fixed_text = (prompt_builder.system_prompt(custom_system_prompt) if use_tools else "") + attachments
+                folded, history = history_budget.fit(fixed_text, summary, history, max_tokens, llm.model_name)
+
+        # Kontrola przyjęć - czekaj na wolny slot generacji (429/503 gdy kolejka pełna)
+        try:
+            with stage("queue_wait"):
+                await scheduler.acquire()
+        except SchedulerRejected as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail,
+                                headers={"Retry-After": str(e.retry_after)})
+        slot_started = time.perf_counter()
+        slot_owned = True
+        try:
+            if folded:
+                with stage("summarize"):
+                    summary = await history_budget.summarize(summary, folded, llm.model_name, model=llm)
+
+            # Prompt: stały system prompt jako prefiks, streszczenie, załączniki i rozmowa po nim.
+            # Gdy Ollama ma już context rozmowy - wysyłamy tylko nową turę.
+            with stage("prompt_build"):
+                built = prompt_builder.build(
+                    history,
+                    use_tools=use_tools,
+                    custom_system_prompt=custom_system_prompt,
+                    attachments=attachments,
+                    continuation=new_messages if context else None,
+                    summary=summary
+                )
+            prompt = built["prompt"]
+            prefix_status = "conversation" if context else "off"
+
+            with stage("db_write"):
+                conv_id = await save_user_turn(conversation_id, new_messages, uploaded_files_info)
+
+            # Zapamiętaj streszczenie - złożone wiadomości nie będą już czytane
+            if folded:
+                message_writer.update(Conversation, conv_id, summary=summary, summary_upto_id=folded[-1]["id"])
+
+            # Tryb strumieniowy - tokeny lecą do klienta jako SSE
+            if stream:
+                log_event("chat_request", "📤 Wysyłam do Ollama (stream)", model=llm.model_name, stream=True,
+                          temperature=temperature, top_p=top_p, prompt_chars=len(prompt), prefix_cache=prefix_status)
+                # Slot zwolni generator strumienia albo - gdy klient rozłączy się, zanim
+                # strumień ruszy - BackgroundTask odpowiedzi
+                slot_owned = False
+                slot = SlotLease(scheduler, slot_started)
+                REQUEST_SECONDS.observe(time.perf_counter() - request_started, mode="stream")
+                return StreamingResponse(
+                    stream_chat(llm, prompt, conv_id, use_tools, [f["name"] for f in uploaded_files_info],
+                                max_tokens, temperature, top_p, slot, context, prefix_status,
+                                cache_key_value),
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                    background=BackgroundTask(slot.release)
+                )
+
+            # Generuj odpowiedź przez Ollama z przekazanymi parametrami (pętla agenta: model -> narzędzia -> model)
+            log_event("chat_request", "📤 Wysyłam do Ollama", model=llm.model_name, stream=False,
+                      temperature=temperature, top_p=top_p, prompt_chars=len(prompt), prefix_cache=prefix_status)
+            out, tool_calls, result, agent_stats = "", [], {}, {}
+            with stage("generate"):
+                async for event in agent_loop.run(llm, prompt, context=context, max_tokens=max_tokens,
+                                                  temperature=temperature, top_p=top_p, use_tools=use_tools,
+                                                  estimator=token_estimator):
+                    if event["event"] == "error":
+                        out, result = event["detail"], {"error": True}
+                    elif event["event"] == "done":
+                        out, tool_calls, result, agent_stats = (event["text"], event["tool_calls"],
+                                                                event["result"], event["agent"])
+            log_event("chat_done", "📥 Ollama odpowiedziała", model=llm.model_name, output_chars=len(out),
+                      tool_calls=len(tool_calls), eval_count=agent_stats.get("eval_count"), error=bool(result.get("error")))
+        finally:
+            if slot_owned:
+                scheduler.release(time.perf_counter() - slot_started)
+
+        stats = dict(ollama_stats(result), agent=agent_stats)
+        replay_ttl = mcp_registry.replay_ttl(tool_calls)
+        if cache_key_value and not result.get("error") and replay_ttl != 0:
+            await response_cache.put(cache_key_value, {"response": out, "tool_calls": tool_calls, "stats": stats},
+                                     ttl=replay_ttl)
+
+        # Zapis odpowiedzi asystenta
+        finish_turn(conv_id, out, result, llm.model_name)
+        REQUEST_SECONDS.observe(time.perf_counter() - request_started, mode="json")
 
         return JSONResponse(
             content={
+                "conversation_id": conv_id,
                 "text": out,
                 "tool_calls": tool_calls if tool_calls else [],
-                "uploaded_files": [f["name"] for f in uploaded_files_info]
+                "uploaded_files": [f["name"] for f in uploaded_files_info],
+                "model": llm.model_name,
+                "stats": dict(stats, prefix_cache=prefix_status,
+                              response_cache="miss" if cache_key_value else "off")
             },
             media_type="application/json; charset=utf-8"
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
-        print(f"❌ Błąd /api/chat: {e}")
-        print(traceback.format_exc())
+        log_event("chat_failed", f"❌ Błąd /api/chat: {e}", level="error", traceback=traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if db:
-            db.close()
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file
+    uvicorn.run("asgi:app", host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file
@@ -0,0 +1,444 @@
+"""
+Konserwacja chat.db i uploads/
+==============================
+
+Zadanie w tle (co MAINTENANCE_INTERVAL_MINUTES) albo ręcznie:
+POST /api/maintenance/run lub `python maintenance.py`.
+
+1. deduplikacja (MAINTENANCE_DEDUP=1, domyślnie wyłączona) - starsze wersje
+   backendu przy każdym żądaniu zakładały nową rozmowę z całą historią;
+   rozmowa, której wiadomości są w całości początkiem późniejszej rozmowy,
+   trafia do archiwum i jest usuwana (załączniki przechodzą do tej
+   późniejszej). Rozmów wskazywanych przez batch_jobs nie ruszamy. Nowe
+   wersje takich kopii nie tworzą, a pasują do siebie też niezależne rozmowy
+   (te same pytania z presetów, powtórzone paczki) - stąd tylko na życzenie,
+2. retencja - wiek (RETENTION_DAYS), liczba rozmów (RETENTION_MAX_CONVERSATIONS)
+   albo rozmiar bazy (RETENTION_MAX_DB_MB); najstarsze rozmowy trafiają
+   najpierw do archiwum archive/conversations-<czas>.jsonl.gz (jedna rozmowa
+   na linię), potem są usuwane z bazy,
+3. osierocone pliki w uploads/ (brak wiersza w attachments),
+4. VACUUM przyrostowy - zwolnione strony oddawane są systemowi po kawałku.
+
+Rozmowy aktywne w ostatnich RETENTION_IDLE_HOURS nie są ruszane. Wszystko idzie
+małymi transakcjami (MAINTENANCE_BATCH_SIZE rozmów) z przerwą między nimi,
+więc zapisy czatu nie czekają na blokadę dłużej niż jedną paczkę.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional
+
+from sqlalchemy import delete, func, select, text, update
+
+from db import IS_SQLITE, engine, init_db, Attachment, BatchJob, Conversation, Message
+from metrics import log_event
+from uploads import upload_store
+
+# Ostatnia aktywność rozmowy - najnowsza wiadomość albo moment założenia
+LAST_ACTIVITY = (
+    "COALESCE((SELECT MAX(m.created_at) FROM messages m WHERE m.conversation_id = c.id), c.created_at)"
+)
+
+
+def _db_time(hours_ago: float) -> str:
+    """Moment sprzed `hours_ago` godzin w formacie CURRENT_TIMESTAMP (UTC) z SQLite"""
+    return (datetime.now(timezone.utc) - timedelta(hours=hours_ago)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _chunks(items: List[int], size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Maintenance:
+    """Deduplikacja, retencja z archiwizacją, sprzątanie uploads/ i VACUUM przyrostowy"""
+
+    def __init__(self, engine, uploads=None, interval: float = 3600, retention_days: float = 0,
+                 max_conversations: int = 0, max_db_mb: float = 0, idle_hours: float = 24,
+                 archive_dir: str = "archive", dedup: bool = False, dedup_min_messages: int = 2,
+                 batch_size: int = 50, batch_pause: float = 0.05, vacuum_pages: int = 1000,
+                 upload_grace_hours: float = 1):
+        self.engine = engine
+        self.uploads = uploads
+        self.interval = interval
+        self.retention_days = retention_days
+        self.max_conversations = max_conversations
+        self.max_db_bytes = int(max_db_mb * 1024 * 1024)
+        self.idle_hours = idle_hours
+        self.archive_dir = archive_dir
+        self.dedup_enabled = dedup
+        self.dedup_min_messages = max(1, dedup_min_messages)
+        self.batch_size = max(1, batch_size)
+        self.batch_pause = batch_pause
+        self.vacuum_pages = vacuum_pages
+        self.upload_grace_hours = upload_grace_hours
+
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._segment = None
+        self.runs = 0
+        self.last_run_at: Optional[float] = None
+        self.last_report: Dict[str, Any] = {}
+
+    # ---------- uruchamianie ----------
+
+    async def _background(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_event("maintenance_failed", "⚠️ Konserwacja bazy nie powiodła się", level="error", error=str(e))
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._background())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    async def run(self) -> Dict[str, Any]:
+        """Jeden przebieg wszystkich kroków (w wątku - pętla zdarzeń obsługuje czat dalej)"""
+        async with self._lock:
+            return await asyncio.to_thread(self.run_sync)
+
+    def run_sync(self) -> Dict[str, Any]:
+        started = time.perf_counter()
+        report: Dict[str, Any] = {}
+        try:
+            if self.dedup_enabled:
+                report["deduplicated"] = self.deduplicate()
+            report.update(self.apply_retention())
+            report.update(self.clean_uploads())
+            report["vacuumed_pages"] = self.incremental_vacuum()
+        finally:
+            if self._segment is not None:
+                report["archive_segment"] = self._segment.name
+                self._segment.close()
+                self._segment = None
+        report["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self.runs += 1
+        self.last_run_at = time.time()
+        self.last_report = report
+        log_event("maintenance_done", "🧹 Konserwacja bazy", **report)
+        return report
+
+    def _pause(self):
+        # Oddaj blokadę zapisu czatowi między paczkami
+        if self.batch_pause > 0:
+            time.sleep(self.batch_pause)
+
+    # ---------- usuwanie ----------
+
+    def _delete_conversations(self, ids: List[int], moved_to: Optional[Dict[int, int]] = None) -> int:
+        """Usuwa rozmowy z wiadomościami w jednej krótkiej transakcji; zwraca liczbę wiadomości"""
+        with self.engine.begin() as conn:
+            if moved_to:
+                for old_id in ids:
+                    conn.execute(update(Attachment).where(Attachment.conversation_id == old_id)
+                                 .values(conversation_id=moved_to[old_id]))
+            else:
+                conn.execute(delete(Attachment).where(Attachment.conversation_id.in_(ids)))
+            deleted = conn.execute(delete(Message).where(Message.conversation_id.in_(ids))).rowcount
+            conn.execute(delete(Conversation).where(Conversation.id.in_(ids)))
+        return deleted
+
+    def _idle(self, ids: List[int]) -> List[int]:
+        """Te z `ids`, które nie były aktywne od RETENTION_IDLE_HOURS"""
+        idle = []
+        with self.engine.connect() as conn:
+            for chunk in _chunks(ids, 500):
+                params = {f"id{i}": cid for i, cid in enumerate(chunk)}
+                placeholders = ", ".join(f":{name}" for name in params)
+                rows = conn.execute(text(
+                    f"SELECT c.id FROM conversations c WHERE c.id IN ({placeholders}) AND {LAST_ACTIVITY} < :cutoff"
+                ), dict(params, cutoff=_db_time(self.idle_hours)))
+                idle.extend(row[0] for row in rows)
+        return idle
+
+    # ---------- 1. deduplikacja ----------
+
+    def deduplicate(self) -> int:
+        """
+        Jednym przebiegiem po messages (kolejność rozmowy) liczy skrót każdego
+        prefiksu rozmowy. Jeśli prefiks rozmowy B ma ten sam skrót co cała
+        wcześniejsza rozmowa A - A jest kopią początku B.
+        """
+        complete: Dict[bytes, int] = {}   # skrót całej rozmowy -> id
+        redundant: Dict[int, int] = {}    # rozmowa-kopia -> rozmowa, która ją zawiera
+        current, digest, count = None, b"", 0
+
+        def close():
+            if current is not None and count >= self.dedup_min_messages:
+                complete[digest] = current
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT conversation_id, role, content FROM messages ORDER BY conversation_id, created_at, id"
+            ))
+            for conversation_id, role, content in rows:
+                if conversation_id != current:
+                    close()
+                    current, digest, count = conversation_id, b"", 0
+                digest = hashlib.blake2b(
+                    digest + f"{role}\x00{content or ''}".encode("utf-8"), digest_size=16
+                ).digest()
+                count += 1
+                earlier = complete.get(digest)
+                if earlier is not None and earlier != current:
+                    redundant[earlier] = current
+            close()
+
+        if not redundant:
+            return 0
+
+        def final_target(cid: int) -> int:
+            # A ⊂ B ⊂ C - załączniki A trafiają do C
+            while cid in redundant:
+                cid = redundant[cid]
+            return cid
+
+        # Wynik paczki wskazuje na rozmowę - ta musi zostać
+        with self.engine.connect() as conn:
+            in_batches = {row[0] for row in conn.execute(
+                select(BatchJob.conversation_id).where(BatchJob.conversation_id.is_not(None)).distinct()
+            )}
+        ids = self._idle(sorted(cid for cid in redundant if cid not in in_batches))
+        moved_to = {cid: final_target(cid) for cid in ids}
+        for chunk in _chunks(ids, self.batch_size):
+            if self.archive_dir:
+                self._archive(chunk, duplicate_of=moved_to)
+            self._delete_conversations(chunk, moved_to)
+            self._pause()
+        return len(ids)
+
+    # ---------- 2. retencja ----------
+
+    def _archive(self, ids: List[int], duplicate_of: Optional[Dict[int, int]] = None):
+        """
+        Dopisuje rozmowy do segmentu archiwum (przed usunięciem z bazy);
+        duplicate_of - przy deduplikacji rozmowa, która zawiera archiwizowaną.
+        """
+        if self._segment is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+            self._segment = gzip.open(os.path.join(self.archive_dir, f"conversations-{stamp}.jsonl.gz"),
+                                      "at", encoding="utf-8")
+
+        with self.engine.connect() as conn:
+            conversations = {
+                c.id: {"id": c.id, "created_at": str(c.created_at), "summary": c.summary,
+                       "messages": [], "attachments": []}
+                for c in conn.execute(select(Conversation.id, Conversation.created_at, Conversation.summary)
+                                      .where(Conversation.id.in_(ids)))
+            }
+            for m in conn.execute(select(Message.conversation_id, Message.role, Message.content, Message.created_at)
+                                  .where(Message.conversation_id.in_(ids))
+                                  .order_by(Message.conversation_id, Message.created_at, Message.id)):
+                conversations[m.conversation_id]["messages"].append(
+                    {"role": m.role, "content": m.content, "created_at": str(m.created_at)}
+                )
+            for a in conn.execute(select(Attachment.conversation_id, Attachment.sha256, Attachment.filename,
+                                         Attachment.size).where(Attachment.conversation_id.in_(ids))):
+                conversations[a.conversation_id]["attachments"].append(
+                    {"sha256": a.sha256, "filename": a.filename, "size": a.size}
+                )
+
+        for conversation in conversations.values():
+            if duplicate_of:
+                conversation["duplicate_of"] = duplicate_of.get(conversation["id"])
+            self._segment.write(json.dumps(conversation, ensure_ascii=False) + "\n")
+        self._segment.flush()
+
+    def _retire(self, ids: List[int]) -> int:
+        if self.archive_dir:
+            self._archive(ids)
+        deleted = self._delete_conversations(ids)
+        self._pause()
+        return deleted
+
+    def _oldest_idle(self, after_id: int, limit: int, cutoff: str) -> List[int]:
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(
+                f"SELECT c.id FROM conversations c WHERE c.id > :after AND {LAST_ACTIVITY} < :cutoff "
+                "ORDER BY c.id LIMIT :limit"
+            ), {"after": after_id, "cutoff": cutoff, "limit": limit})
+            return [row[0] for row in rows]
+
+    def db_bytes(self) -> Optional[int]:
+        """Rozmiar danych w bazie SQLite (bez wolnych stron); None dla innych baz"""
+        if not IS_SQLITE:
+            return None
+        with self.engine.connect() as conn:
+            page_size = conn.exec_driver_sql("PRAGMA page_size").scalar()
+            pages = conn.exec_driver_sql("PRAGMA page_count").scalar()
+            free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        return (pages - free) * page_size
+
+    def apply_retention(self) -> Dict[str, int]:
+        archived = deleted_messages = 0
+        policies = []
+        if self.retention_days > 0:
+            policies.append(("age", _db_time(self.retention_days * 24)))
+        if self.max_conversations > 0 or (self.max_db_bytes > 0 and IS_SQLITE):
+            policies.append(("size", _db_time(self.idle_hours)))
+
+        for policy, cutoff in policies:
+            after_id = 0
+            while True:
+                if policy == "age":
+                    limit = self.batch_size
+                else:
+                    limit = 0
+                    if self.max_conversations > 0:
+                        with self.engine.connect() as conn:
+                            total = conn.execute(select(func.count()).select_from(Conversation)).scalar()
+                        limit = max(0, total - self.max_conversations)
+                    if not limit and self.max_db_bytes > 0 and (self.db_bytes() or 0) > self.max_db_bytes:
+                        limit = self.batch_size
+                    limit = min(limit, self.batch_size)
+                    if not limit:
+                        break
+                ids = self._oldest_idle(after_id, limit, cutoff)
+                if not ids:
+                    break
+                deleted_messages += self._retire(ids)
+                archived += len(ids)
+                after_id = ids[-1]
+
+        return {"archived": archived, "deleted_messages": deleted_messages}
+
+    # ---------- 3. osierocone pliki ----------
+
+    def clean_uploads(self) -> Dict[str, int]:
+        if self.uploads is None or not os.path.isdir(self.uploads.root):
+            return {"orphan_uploads": 0, "freed_upload_bytes": 0}
+        with self.engine.connect() as conn:
+            referenced = {row[0] for row in conn.execute(select(Attachment.sha256).distinct())}
+
+        # Plik zapisuje się przed wierszem w attachments - świeżych nie ruszamy
+        cutoff = time.time() - self.upload_grace_hours * 3600
+        removed = freed = 0
+        for root, _, files in os.walk(self.uploads.root):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if st.st_mtime > cutoff:
+                    continue
+                leftover = name.endswith(".part") or os.path.basename(root) == ".tmp"
+                if not leftover and name.split(".")[0] in referenced:
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                self.uploads.forget(path)
+                removed += 1
+                freed += st.st_size
+        return {"orphan_uploads": removed, "freed_upload_bytes": freed}
+
+    # ---------- 4. VACUUM ----------
+
+    def incremental_vacuum(self) -> int:
+        """
+        Oddaje wolne strony po `vacuum_pages` na transakcję. Wymaga
+        auto_vacuum=INCREMENTAL (nowe bazy mają go od startu, starsze - po
+        jednorazowym `python maintenance.py --full-vacuum`).
+        """
+        if not IS_SQLITE or self.vacuum_pages <= 0:
+            return 0
+        with self.engine.connect() as conn:
+            if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+                return 0
+        freed = 0
+        while True:
+            with self.engine.begin() as conn:
+                free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+                if not free:
+                    break
+                conn.exec_driver_sql(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})")
+                left = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            freed += free - left
+            if left >= free:
+                break
+            self._pause()
+        if freed:
+            with self.engine.connect() as conn:
+                conn.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)")
+        return freed
+
+    def full_vacuum(self):
+        """Jednorazowo: włącza auto_vacuum=INCREMENTAL i przepisuje całą bazę (blokuje ją na czas VACUUM)"""
+        if not IS_SQLITE:
+            return
+        with self.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+
+    async def stats(self) -> Dict[str, Any]:
+        """Ustawienia i ostatni raport; rozmiar bazy (PRAGMA) w wątku - jak run()"""
+        db_bytes = await asyncio.to_thread(self.db_bytes)
+        return {
+            "enabled": self.interval > 0,
+            "interval_seconds": self.interval,
+            "running": self.running,
+            "runs": self.runs,
+            "last_run_at": self.last_run_at,
+            "last_report": self.last_report,
+            "retention": {
+                "days": self.retention_days,
+                "max_conversations": self.max_conversations,
+                "max_db_mb": round(self.max_db_bytes / (1024 * 1024), 1),
+                "idle_hours": self.idle_hours,
+                "archive_dir": self.archive_dir or None
+            },
+            "db_bytes": db_bytes
+        }
+
+
+maintenance = Maintenance(
+    engine,
+    uploads=upload_store,
+    interval=float(os.getenv("MAINTENANCE_INTERVAL_MINUTES", 60)) * 60,
+    retention_days=float(os.getenv("RETENTION_DAYS", 0)),
+    max_conversations=int(os.getenv("RETENTION_MAX_CONVERSATIONS", 0)),
+    max_db_mb=float(os.getenv("RETENTION_MAX_DB_MB", 0)),
+    idle_hours=float(os.getenv("RETENTION_IDLE_HOURS", 24)),
+    archive_dir=os.getenv("ARCHIVE_DIR", "archive"),
+    dedup=os.getenv("MAINTENANCE_DEDUP", "0") == "1",
+    dedup_min_messages=int(os.getenv("MAINTENANCE_DEDUP_MIN_MESSAGES", 2)),
+    batch_size=int(os.getenv("MAINTENANCE_BATCH_SIZE", 50)),
+    batch_pause=float(os.getenv("MAINTENANCE_BATCH_PAUSE_MS", 50)) / 1000,
+    vacuum_pages=int(os.getenv("MAINTENANCE_VACUUM_PAGES", 1000)),
+    upload_grace_hours=float(os.getenv("UPLOAD_ORPHAN_GRACE_HOURS", 1))
+)
+
+
+if __name__ == "__main__":
+    import sys
+    init_db()
+    if "--full-vacuum" in sys.argv:
+        print("🗄️ VACUUM całej bazy (auto_vacuum=INCREMENTAL)...")
+        maintenance.full_vacuum()
+    print(json.dumps(maintenance.run_sync(), indent=2, ensure_ascii=False))
@@ -3,7 +3,8 @@ MCP (Model Context Protocol) Tools for Local AI Chatbot
 ========================================================
 
 Implementacja narzędzi MCP umożliwiających lokalnym modelom AI dostęp do:
-- Operacji na plikach (czytanie, pisanie, listowanie)
+- Operacji na plikach (czytanie zakresami, pisanie, listowanie stronami,
+  wyszukiwanie pełnotekstowe - search_workspace, workspace_index.py)
 - Wyszukiwania w internecie
 - Kalkulatora matematycznego
 - Wykonywania kodu Python
@@ -13,17 +14,93 @@ Każde narzędzie ma:
 - Nazwę (name)
 - Opis (description)
 - Funkcję wykonującą (function)
+- Opcjonalnie TTL cache wyniku (cache_ttl) - tylko dla narzędzi idempotentnych
+- Sposób wykonania (executor): "inline" (szybkie, w pętli zdarzeń),
+  "thread" (blokujące I/O), "process" (CPU) albo funkcja async
+
+Wywołania z jednej tury modelu wykonywane są równolegle (execute_many),
+z limitem czasu i współbieżności per narzędzie z mcp_config.json
+("timeout", "max_concurrency"; pule: mcp_tools_config.executor).
 """
 
+import asyncio
 import os
 import json
 import subprocess
 import requests
 import inspect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Any, List, Callable
+from typing import Dict, Any, List, Callable, Optional
 import math
 import re
+import time
+
+from config import load_mcp_config, tools_config, tool_config, parse_size
+from workspace_index import workspace_index, read_range
+from tool_cache import ToolResultCache
+from sandbox import sandbox_pool, SandboxTimeout, SandboxCrashed
+from metrics import TOOL_SECONDS, TOOL_CALLS
+
+EXECUTORS = ("inline", "thread", "process")
+
+
+def calculate(expression: str) -> str:
+    """Kalkulator matematyczny (funkcja modułu - musi dać się wysłać do puli procesów)"""
+    try:
+        # Bezpieczne parsowanie - tylko matematyka
+        allowed_chars = set("0123456789+-*/().^ ")
+        if not all(c in allowed_chars or c.isspace() for c in expression):
+            return "❌ Niedozwolone znaki w wyrażeniu"
+
+        # Zamień ^ na **
+        expression = expression.replace("^", "**")
+
+        # Bezpieczna ewaluacja
+        result = eval(expression, {"__builtins__": {}}, {
+            "sin": math.sin, "cos": math.cos, "tan": math.tan,
+            "sqrt": math.sqrt, "pi": math.pi, "e": math.e,
+            "log": math.log, "abs": abs, "pow": pow
+        })
+
+        return f"🔢 {expression} = {result}"
+    except Exception as e:
+        return f"❌ Błąd obliczeń: {str(e)}"
+
+
+def _file_stamp(path: str):
+    """(mtime, rozmiar) pliku - zmiana pliku unieważnia wpis cache read_file"""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _resolve_path(path: str, roots: List[str]) -> str:
+    """
+    Ścieżka wewnątrz jednego z dozwolonych katalogów (allowed_paths). realpath -
+    ani "../", ani dowiązanie symboliczne nie wyprowadzą poza nie. Ścieżka
+    względna szukana jest od katalogu roboczego, a potem w każdym z katalogów.
+    """
+    roots = [os.path.realpath(root) for root in roots]
+    candidates = [path] if os.path.isabs(path) else [path] + [os.path.join(root, path) for root in roots]
+    inside = None
+    for candidate in candidates:
+        real = os.path.realpath(candidate)
+        if any(real == root or real.startswith(root + os.sep) for root in roots):
+            if os.path.exists(real):
+                return real
+            inside = inside or real
+    if inside is None:
+        raise PermissionError(f"Ścieżka '{path}' jest poza dozwolonymi katalogami")
+    return inside
+
+
+def _human_size(size: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
 
 
 class MCPToolRegistry:
@@ -31,20 +108,88 @@ class MCPToolRegistry:
 
     def __init__(self):
         self.tools: Dict[str, Dict[str, Any]] = {}
+        executor_cfg = tools_config().get("executor", {})
+        self.default_timeout = float(executor_cfg.get("default_timeout_seconds", 30))
+        self.thread_workers = int(executor_cfg.get("thread_pool_workers", 8))
+        self.process_workers = int(executor_cfg.get("process_pool_workers", 2))
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._process_calls: Dict[ProcessPoolExecutor, set] = {}  # pula -> trwające wywołania
+        self._retiring: Dict[ProcessPoolExecutor, asyncio.Task] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.cache = ToolResultCache(max_entries=int(tools_config().get("tool_cache_max_entries", 512)))
+
+        # Limity narzędzi plikowych z mcp_config.json
+        read_cfg, list_cfg = tool_config("read_file"), tool_config("list_directory")
+        self.allowed_paths = read_cfg.get("allowed_paths") or [tools_config().get("safe_directory", "./mcp_workspace")]
+        self.max_file_size = parse_size(read_cfg.get("max_file_size"),
+                                        int(tools_config().get("max_file_size_mb", 10)) * 1024 * 1024)
+        self.max_read_bytes = int(read_cfg.get("max_read_bytes", 8000))
+        self.mmap_threshold = parse_size(read_cfg.get("mmap_threshold"), 1024 * 1024)
+        self.list_allowed_paths = list_cfg.get("allowed_paths") or self.allowed_paths
+        self.max_depth = int(list_cfg.get("max_depth", 3))
+        self.list_page_size = int(list_cfg.get("page_size", 50))
+        self.search_max_results = int(tool_config("search_workspace").get("max_results", 20))
+
+        # Jedna pula połączeń HTTP dla narzędzi sieciowych
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.thread_workers)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
         self._register_default_tools()
 
-    def register_tool(self, name: str, description: str, function: Callable):
-        """Rejestruje nowe narzędzie"""
+    def register_tool(self, name: str, description: str, function: Callable, executor: str = "thread",
+                      timeout: Optional[float] = None, max_concurrency: Optional[int] = None,
+                      cache_ttl: Optional[float] = None, cache_key: Optional[Callable[[dict], Any]] = None):
+        """
+        Rejestruje nowe narzędzie. Limity z mcp_config.json ("tools" -> nazwa)
+        mają pierwszeństwo przed podanymi tutaj.
+
+        cache_ttl - wynik można zapamiętać na tyle sekund (narzędzie idempotentne);
+        cache_key(args) - dodatkowy składnik klucza, np. mtime czytanego pliku.
+        """
+        cfg = tool_config(name)
+        if inspect.iscoroutinefunction(function):
+            executor = "async"
+        elif executor not in EXECUTORS:
+            raise ValueError(f"Nieznany executor '{executor}' (dostępne: {EXECUTORS})")
         self.tools[name] = {
             "name": name,
             "description": description,
-            "function": function
+            "function": function,
+            "executor": executor,
+            "enabled": cfg.get("enabled", True),
+            "timeout": float(cfg.get("timeout", timeout or self.default_timeout)),
+            "max_concurrency": int(cfg.get("max_concurrency", max_concurrency or 4)),
+            "cache_ttl": float(cfg.get("cache_ttl_seconds", cache_ttl or 0)),
+            "cache_key": cache_key,
+            # Schemat argumentów liczony raz - parser nie używa refleksji przy każdym wywołaniu
+            "params": [
+                p.name for p in inspect.signature(function).parameters.values()
+                if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)
+            ]
         }
+        self._semaphores.pop(name, None)
 
     def get_tool(self, name: str) -> Dict[str, Any]:
         """Pobiera narzędzie po nazwie"""
         return self.tools.get(name)
 
+    def replay_ttl(self, tool_calls: List[Dict[str, Any]]) -> Optional[float]:
+        """
+        Jak długo odpowiedź z tymi wywołaniami narzędzi może być podawana z cache:
+        0 - wcale (narzędzie bez cache_ttl, np. zapis pliku), None - bez ograniczeń
+        (brak narzędzi), inaczej najkrótszy cache_ttl użytych narzędzi.
+        """
+        ttl = None
+        for call in tool_calls:
+            tool = self.get_tool(call.get("tool"))
+            if not tool or tool["cache_ttl"] <= 0:
+                return 0
+            ttl = tool["cache_ttl"] if ttl is None else min(ttl, tool["cache_ttl"])
+        return ttl
+
     def list_tools(self) -> List[str]:
         """Lista wszystkich dostępnych narzędzi"""
         return list(self.tools.keys())
@@ -55,86 +200,273 @@ class MCPToolRegistry:
         if not tool:
             return f"❌ Narzędzie '{name}' nie istnieje"
 
+        if not tool["enabled"]:
+            return f"❌ Narzędzie '{name}' jest wyłączone"
+
         try:
+            if tool["executor"] == "async":
+                return str(asyncio.run(tool["function"](**kwargs)))
             result = tool["function"](**kwargs)
             return str(result)
         except Exception as e:
             return f"❌ Błąd wykonania narzędzia '{name}': {str(e)}"
 
+    # ========== WYKONANIE ASYNCHRONICZNE ==========
+
+    def _pool(self, executor: str):
+        if executor == "process":
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+            return self._process_pool
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.thread_workers, thread_name_prefix="mcp-tool")
+        return self._thread_pool
+
+    async def _run(self, tool: Dict[str, Any], kwargs: Dict[str, Any], state: Dict[str, Any]):
+        if tool["executor"] == "async":
+            return await tool["function"](**kwargs)
+        if tool["executor"] == "inline":
+            return tool["function"](**kwargs)
+        call = partial(tool["function"], **kwargs)
+        if tool["executor"] == "process":
+            # Zapamiętaj pulę i wywołanie - timeout wycofuje tylko tę pulę (_retire_process_pool)
+            pool = state["pool"] = self._pool("process")
+            future = state["future"] = pool.submit(call)
+            calls = self._process_calls.setdefault(pool, set())
+            calls.add(future)
+            future.add_done_callback(calls.discard)
+            return await asyncio.wrap_future(future)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool(tool["executor"]), call)
+
+    async def execute_tool_async(self, name: str, **kwargs) -> str:
+        """
+        Jak execute_tool, ale nie blokuje pętli zdarzeń; pilnuje timeoutu i limitu
+        współbieżności, a dla narzędzi z cache_ttl korzysta z cache wyników.
+        """
+        tool = self.get_tool(name)
+        if not tool:
+            return f"❌ Narzędzie '{name}' nie istnieje"
+        if not tool["enabled"]:
+            return f"❌ Narzędzie '{name}' jest wyłączone"
+
+        if tool["cache_ttl"] > 0:
+            try:
+                extra = tool["cache_key"](kwargs) if tool["cache_key"] else None
+                key = (name, json.dumps(kwargs, sort_keys=True, ensure_ascii=False), extra)
+            except Exception:
+                key = None
+            if key is not None:
+                return await self.cache.get_or_run(key, tool["cache_ttl"],
+                                                   lambda: self._execute_uncached(tool, kwargs))
+        return await self._execute_uncached(tool, kwargs)
+
+    async def _execute_uncached(self, tool: Dict[str, Any], kwargs: Dict[str, Any]) -> str:
+        name = tool["name"]
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            semaphore = self._semaphores[name] = asyncio.Semaphore(tool["max_concurrency"])
+
+        started = time.perf_counter()
+        status = "ok"
+        state: Dict[str, Any] = {}
+        try:
+            async with semaphore:
+                result = await asyncio.wait_for(self._run(tool, kwargs, state), timeout=tool["timeout"])
+            result = str(result)
+            if result.startswith("❌"):
+                status = "error"
+            return result
+        except asyncio.TimeoutError:
+            status = "timeout"
+            if state.get("pool") is not None:
+                # Proces nadal liczy (np. 9**9**9) - zatrzyma go tylko zabicie puli
+                self._retire_process_pool(state["pool"], state.get("future"))
+            return f"❌ Narzędzie '{name}' przekroczyło limit czasu ({tool['timeout']:g}s)"
+        except Exception as e:
+            status = "error"
+            return f"❌ Błąd wykonania narzędzia '{name}': {str(e)}"
+        finally:
+            TOOL_SECONDS.observe(time.perf_counter() - started, tool=name)
+            TOOL_CALLS.inc(tool=name, status=status)
+
+    async def execute_many(self, calls: List[Dict[str, Any]]) -> List[str]:
+        """Wykonuje niezależne wywołania ({"tool", "args"}) równolegle; wyniki w kolejności wywołań"""
+        return list(await asyncio.gather(*[
+            self.execute_tool_async(call["tool"], **call["args"]) for call in calls
+        ]))
+
+    def _retire_process_pool(self, pool: ProcessPoolExecutor, stuck=None):
+        """
+        Pula z zawieszonym wywołaniem przestaje przyjmować nowe (kolejne idą do
+        nowej puli). Wywołania innych użytkowników, które już w niej trwają,
+        kończą się normalnie - dopiero potem (najwyżej po najdłuższym timeoucie
+        narzędzi "process") procesy starej puli są zabijane.
+        """
+        if self._process_pool is pool:
+            self._process_pool = None
+        if pool in self._retiring:
+            return
+        task = asyncio.get_running_loop().create_task(self._drain_process_pool(pool, stuck))
+        self._retiring[pool] = task
+        task.add_done_callback(lambda _: self._retiring.pop(pool, None))
+
+    async def _drain_process_pool(self, pool: ProcessPoolExecutor, stuck=None):
+        timeout = max([t["timeout"] for t in self.tools.values() if t["executor"] == "process"],
+                      default=self.default_timeout)
+        calls = [f for f in self._process_calls.get(pool, ()) if f is not stuck]
+        if calls:
+            await asyncio.to_thread(wait_futures, calls, timeout)
+        self._kill_process_pool(pool)
+
+    def _kill_process_pool(self, pool: ProcessPoolExecutor):
+        """Zabija procesy puli (zawieszone wywołania nie dają się przerwać inaczej)"""
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+        self._process_calls.pop(pool, None)
+
+    def shutdown(self):
+        """Zamyka pule wątków i procesów oraz sesję HTTP (przy wyłączaniu backendu)"""
+        self.http.close()
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False, cancel_futures=True)
+            self._thread_pool = None
+        for task in list(self._retiring.values()):
+            task.cancel()
+        pools = list(self._retiring) + ([self._process_pool] if self._process_pool else [])
+        self._process_pool = None
+        self._retiring.clear()
+        for pool in pools:
+            self._kill_process_pool(pool)
+
     def _register_default_tools(self):
         """Rejestruje domyślny zestaw narzędzi"""
 
         # 1. FILE OPERATIONS
         self.register_tool(
             name="read_file",
-            description="Czyta zawartość pliku. Args: path (str)",
-            function=self._read_file
+            description="Czyta fragment pliku. Args: path (str), offset (int, bajty, default=0), "
+                        "length (int, default=2000) - z offset/length także pliki ponad max_file_size",
+            function=self._read_file,
+            executor="thread",
+            cache_ttl=300,
+            cache_key=lambda args: _file_stamp(_resolve_path(args.get("path", ""), self.allowed_paths))
         )
 
         self.register_tool(
             name="write_file",
             description="Zapisuje tekst do pliku. Args: path (str), content (str)",
-            function=self._write_file
+            function=self._write_file,
+            executor="thread"
         )
 
         self.register_tool(
             name="list_directory",
-            description="Listuje pliki w katalogu. Args: path (str, default='.')",
-            function=self._list_directory
+            description="Listuje pliki w katalogu (stronami). Args: path (str, default='.' = katalogi główne), "
+                        "depth (int, default=1), offset (int, default=0)",
+            function=self._list_directory,
+            executor="thread"
+        )
+
+        self.register_tool(
+            name="search_workspace",
+            description="Wyszukuje tekst w plikach (mcp_workspace, data, uploads). Args: query (str), "
+                        "limit (int, default=10)",
+            function=self._search_workspace,
+            executor="thread"
         )
 
         # 2. WEB SEARCH
         self.register_tool(
             name="web_search",
             description="Wyszukuje informacje w internecie. Args: query (str)",
-            function=self._web_search
+            function=self._web_search,
+            executor="thread",
+            cache_ttl=900
         )
 
         # 3. CALCULATOR
         self.register_tool(
             name="calculator",
             description="Wykonuje obliczenia matematyczne. Args: expression (str)",
-            function=self._calculator
+            function=calculate,
+            executor="process",
+            cache_ttl=3600
         )
 
         # 4. CODE EXECUTION (SANDBOXED)
         self.register_tool(
             name="execute_python",
             description="Wykonuje kod Python (bezpiecznie). Args: code (str)",
-            function=self._execute_python
+            function=self._execute_python,
+            executor="thread"
         )
 
         # 5. SYSTEM INFO
         self.register_tool(
             name="system_info",
             description="Zwraca informacje systemowe",
-            function=self._system_info
+            function=self._system_info,
+            executor="thread",
+            cache_ttl=3600
         )
 
         # 6. DATE/TIME
         self.register_tool(
             name="get_datetime",
             description="Zwraca aktualną datę i czas",
-            function=self._get_datetime
+            function=self._get_datetime,
+            executor="inline"
         )
 
         # 7. TEXT PROCESSING
         self.register_tool(
             name="count_words",
             description="Liczy słowa w tekście. Args: text (str)",
-            function=self._count_words
+            function=self._count_words,
+            executor="inline"
         )
 
+        # Globalne wyłączniki z mcp_tools_config
+        cfg = tools_config()
+        if not cfg.get("web_search_enabled", True):
+            self.tools["web_search"]["enabled"] = False
+        if not cfg.get("code_execution_enabled", True):
+            self.tools["execute_python"]["enabled"] = False
+        if not workspace_index.enabled:
+            self.tools["search_workspace"]["enabled"] = False
+
     # ========== IMPLEMENTACJE NARZĘDZI ==========
 
-    def _read_file(self, path: str) -> str:
-        """Czyta plik"""
+    def _read_file(self, path: str, offset: int = 0, length: Optional[int] = None) -> str:
+        """
+        Czyta zakres bajtów pliku (bez wczytywania całości; duże pliki przez mmap).
+        Limit max_file_size dotyczy tylko czytania bez zakresu (sama ścieżka) -
+        okno offset/length działa dla pliku dowolnej wielkości.
+        """
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            return f"📄 Zawartość pliku '{path}':\n{content[:500]}..." if len(content) > 500 else f"📄 Zawartość pliku '{path}':\n{content}"
+            ranged = bool(offset) or length is not None
+            offset = max(0, int(offset or 0))
+            length = min(max(1, int(length or 2000)), self.max_read_bytes)
+            real = _resolve_path(path, self.allowed_paths)
+            size = os.path.getsize(real)
+            if not ranged and size > self.max_file_size:
+                return (f"❌ Plik '{path}' ma {_human_size(size)} - bez zakresu limit read_file to "
+                        f"{_human_size(self.max_file_size)} (podaj offset/length albo użyj search_workspace)")
+            data, size = read_range(real, offset, length, self.mmap_threshold)
+            end = offset + len(data)
+            content = data.decode("utf-8", errors="ignore")
+            if offset == 0 and end >= size:
+                return f"📄 Zawartość pliku '{path}':\n{content}"
+            more = f"\n... (dalej: offset={end})" if end < size else ""
+            return f"📄 Zawartość pliku '{path}' (bajty {offset}-{end} z {size}):\n{content}{more}"
         except FileNotFoundError:
             return f"❌ Plik '{path}' nie istnieje"
+        except PermissionError as e:
+            return f"❌ {e}"
+        except ValueError:
+            return "❌ offset i length muszą być liczbami"
         except Exception as e:
             return f"❌ Błąd czytania pliku: {str(e)}"
 
@@ -152,21 +484,91 @@ class MCPToolRegistry:
         except Exception as e:
             return f"❌ Błąd zapisu: {str(e)}"
 
-    def _list_directory(self, path: str = ".") -> str:
-        """Listuje zawartość katalogu"""
+    def _scan(self, directory: str, depth: int, level: int = 0):
+        """(poziom, os.DirEntry) - os.scandir bez stat; rekurencja do `depth` poziomów"""
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                yield level, entry
+                if level + 1 < depth and entry.is_dir(follow_symlinks=False):
+                    yield from self._scan(entry.path, depth, level + 1)
+
+    def _scan_roots(self, roots: List[str], depth: int):
+        """Katalogi główne (poziom 0, sama ścieżka) i ich zawartość"""
+        for root in roots:
+            yield 0, root
+            for level, entry in self._scan(root, depth):
+                yield level + 1, entry
+
+    def _list_directory(self, path: str = ".", depth: int = 1, offset: int = 0) -> str:
+        """Listuje katalog stronami (list_directory.page_size pozycji, max_depth poziomów)"""
         try:
-            items = os.listdir(path)
-            files = [f"📄 {item}" if os.path.isfile(os.path.join(path, item)) else f"📁 {item}" for item in items]
-            return f"📂 Zawartość '{path}':\n" + "\n".join(files[:20])
+            depth = min(max(1, int(depth or 1)), self.max_depth)
+            offset = max(0, int(offset or 0))
+            if path in ("", ".", "./"):
+                # Katalogi główne = allowed_paths (tylko istniejące)
+                entries = self._scan_roots([root for root in self.list_allowed_paths if os.path.isdir(root)], depth)
+            else:
+                real = _resolve_path(path, self.list_allowed_paths)
+                if not os.path.isdir(real):
+                    return f"❌ '{path}' nie jest katalogiem"
+                entries = self._scan(real, depth)
+
+            # Tylko strona trafia do pamięci; stat (rozmiar) wyłącznie dla jej pozycji
+            page = list(islice(entries, offset, offset + self.list_page_size + 1))
+            has_more = len(page) > self.list_page_size
+            lines = []
+            for level, entry in page[:self.list_page_size]:
+                indent = "  " * level
+                if isinstance(entry, str):
+                    lines.append(f"{indent}📁 {entry}/")
+                elif entry.is_dir(follow_symlinks=False):
+                    lines.append(f"{indent}📁 {entry.name}/")
+                else:
+                    try:
+                        size = _human_size(entry.stat(follow_symlinks=False).st_size)
+                    except OSError:
+                        size = "?"
+                    lines.append(f"{indent}📄 {entry.name} ({size})")
+            if not lines:
+                return f"📂 Katalog '{path}' jest pusty" if not offset else f"📂 Brak pozycji od offset={offset}"
+            header = f"📂 Zawartość '{path}' (pozycje {offset + 1}-{offset + len(lines)}, głębokość {depth}):\n"
+            more = f"\n... (więcej: offset={offset + len(lines)})" if has_more else ""
+            return header + "\n".join(lines) + more
+        except PermissionError as e:
+            return f"❌ {e}"
+        except ValueError:
+            return "❌ depth i offset muszą być liczbami"
         except Exception as e:
             return f"❌ Błąd listowania: {str(e)}"
 
+    def _search_workspace(self, query: str, limit: int = 10) -> str:
+        """Wyszukiwanie pełnotekstowe w plikach workspace (indeks przyrostowy)"""
+        try:
+            limit = min(max(1, int(limit or 10)), self.search_max_results)
+            hits = workspace_index.search(query, limit)
+        except ValueError:
+            return "❌ limit musi być liczbą"
+        except Exception as e:
+            return f"❌ Błąd wyszukiwania w plikach: {str(e)}"
+        if not hits:
+            return f"🔎 Brak wyników dla '{query}' w plikach"
+        return f"🔎 Wyniki dla '{query}' w plikach:\n" + "\n".join(
+            f"- {hit['path']}:{hit['line']}: {hit['snippet']}" for hit in hits
+        )
+
     def _web_search(self, query: str) -> str:
         """Wyszukuje w internecie (używa DuckDuckGo HTML)"""
         try:
-            # Prosty search przez DuckDuckGo Instant Answer API
-            url = f"https://api.duckduckgo.com/?q={requests.utils.quote(query)}&format=json&pretty=1"
-            response = requests.get(url, timeout=5)
+            # Prosty search przez DuckDuckGo Instant Answer API (WEB_SEARCH_URL - np. lokalny stub)
+            cfg = tool_config("web_search")
+            url = os.getenv("WEB_SEARCH_URL") or cfg.get("url", "https://api.duckduckgo.com/")
+            response = self.http.get(url, params={"q": query, "format": "json"}, timeout=cfg.get("timeout", 5))
             data = response.json()
 
             if data.get("AbstractText"):
@@ -182,25 +584,7 @@ class MCPToolRegistry:
 
     def _calculator(self, expression: str) -> str:
         """Kalkulator matematyczny"""
-        try:
-            # Bezpieczne parsowanie - tylko matematyka
-            allowed_chars = set("0123456789+-*/().^ ")
-            if not all(c in allowed_chars or c.isspace() for c in expression):
-                return "❌ Niedozwolone znaki w wyrażeniu"
-
-            # Zamień ^ na **
-            expression = expression.replace("^", "**")
-
-            # Bezpieczna ewaluacja
-            result = eval(expression, {"__builtins__": {}}, {
-                "sin": math.sin, "cos": math.cos, "tan": math.tan,
-                "sqrt": math.sqrt, "pi": math.pi, "e": math.e,
-                "log": math.log, "abs": abs, "pow": pow
-            })
-
-            return f"🔢 {expression} = {result}"
-        except Exception as e:
-            return f"❌ Błąd obliczeń: {str(e)}"
+        return calculate(expression)
 
     def _execute_python(self, code: str) -> str:
         """Wykonuje kod Python w sandboxie"""
@@ -209,18 +593,26 @@ class MCPToolRegistry:
             if any(dangerous in code for dangerous in ["import os", "import sys", "exec", "eval", "__"]):
                 return "❌ Niebezpieczny kod - zabronione importy"
 
+            # Rozgrzany proces z puli (limity pamięci/CPU, bez sieci)
+            if sandbox_pool.enabled:
+                result = sandbox_pool.run(code)
+                output = result["stdout"] or result["stderr"]
+                return f"🐍 Wynik:\n{output[:500]}"
+
             # Wykonaj z timeoutem
             result = subprocess.run(
                 ["python3", "-c", code],
                 capture_output=True,
                 text=True,
-                timeout=5
+                timeout=tools_config().get("code_execution_timeout_seconds", 5)
             )
 
             output = result.stdout or result.stderr
             return f"🐍 Wynik:\n{output[:500]}"
-        except subprocess.TimeoutExpired:
+        except (subprocess.TimeoutExpired, SandboxTimeout):
             return "❌ Timeout - kod wykonywał się za długo"
+        except SandboxCrashed:
+            return "❌ Kod przekroczył limit pamięci lub CPU (uruchomienie zostało przerwane)"
         except Exception as e:
             return f"❌ Błąd wykonania: {str(e)}"
 
@@ -250,48 +642,115 @@ class MCPToolRegistry:
         return f"📊 Statystyki tekstu:\n- Słowa: {words}\n- Znaki: {chars}\n- Linie: {lines}"
 
 
-def parse_tool_call_from_text(text: str) -> List[Dict[str, Any]]:
+TOOL_OPEN = "[TOOL:"
+TOOL_CLOSE = "[/TOOL]"
+MAX_TOOL_ARGS_LENGTH = int(
+    load_mcp_config().get("security", {}).get("input_validation", {}).get("max_tool_args_length", 5000)
+)
+
+
+def parse_tool_args(tool_name: str, args_text: str, params: Optional[List[str]] = None) -> Dict[str, Any]:
     """
-    Parsuje wywołania narzędzi z tekstu generowanego przez model.
+    Argumenty wywołania według schematu narzędzia (lista nazw parametrów).
 
-    Format: [TOOL:nazwa_narzędzia]argument1|argument2[/TOOL]
-    Przykład: [TOOL:calculator]2+2[/TOOL]
+    - key=value|key2=value2, gdy pierwszy klucz jest parametrem narzędzia,
+    - inaczej pozycyjnie: kolejne parametry rozdzielone "|", ostatni dostaje resztę
+      (np. write_file: ścieżka|treść, w której może być "|").
     """
-    pattern = r'\[TOOL:(\w+)\](.*?)\[/TOOL\]'
-    matches = re.findall(pattern, text, re.DOTALL)
+    if params is None:
+        tool = mcp_registry.get_tool(tool_name)
+        params = tool["params"] if tool else None
 
-    tool_calls = []
-    for tool_name, args_text in matches:
-        # Parse arguments (simple key=value or positional)
+    first_key = args_text.split("|", 1)[0].split("=", 1)[0].strip()
+    if "=" in args_text and (params is None or first_key in params):
         kwargs = {}
+        for pair in args_text.split("|"):
+            if "=" in pair:
+                key, value = pair.split("=", 1)
+                kwargs[key.strip()] = value.strip()
+        return kwargs
+
+    if params is None:
+        # Nieznane narzędzie - execute_tool i tak zwróci błąd
+        return {"query": args_text.strip()}
+    if not params:
+        return {}
+    parts = args_text.split("|", len(params) - 1)
+    return {name: value.strip() for name, value in zip(params, parts)}
+
+
+class ToolCallParser:
+    """
+    Przyrostowy parser [TOOL:nazwa]argumenty[/TOOL] dla strumienia tokenów.
+
+    feed(fragment) zwraca wywołania zamknięte w tym fragmencie - narzędzie może
+    ruszyć, zanim model skończy generować. Znaczniki mogą być pocięte między
+    fragmentami dowolnie.
+    """
+
+    TEXT, NAME, ARGS = range(3)
+
+    def __init__(self, max_args_length: int = MAX_TOOL_ARGS_LENGTH):
+        self.max_args_length = max_args_length
+        self.state = self.TEXT
+        self.buffer = ""
+        self.tool_name = ""
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.buffer += chunk
+        calls = []
+        while True:
+            if self.state == self.TEXT:
+                start = self.buffer.find(TOOL_OPEN)
+                if start < 0:
+                    # Zostaw tylko ogon, który może być początkiem znacznika
+                    keep = next((n for n in range(len(TOOL_OPEN) - 1, 0, -1)
+                                 if self.buffer.endswith(TOOL_OPEN[:n])), 0)
+                    self.buffer = self.buffer[len(self.buffer) - keep:] if keep else ""
+                    return calls
+                self.buffer = self.buffer[start + len(TOOL_OPEN):]
+                self.state = self.NAME
+
+            elif self.state == self.NAME:
+                end = self.buffer.find("]")
+                name = self.buffer if end < 0 else self.buffer[:end]
+                if not re.fullmatch(r"\w*", name):
+                    # To nie był znacznik narzędzia - szukaj dalej
+                    self.state = self.TEXT
+                    continue
+                if end < 0:
+                    return calls
+                if not name:
+                    self.state = self.TEXT
+                    continue
+                self.tool_name = name
+                self.buffer = self.buffer[end + 1:]
+                self.state = self.ARGS
 
-        # Sprawdź czy to key=value format
-        if "=" in args_text:
-            for pair in args_text.split("|"):
-                if "=" in pair:
-                    key, value = pair.split("=", 1)
-                    kwargs[key.strip()] = value.strip()
-        else:
-            # Pozycyjny argument (domyślnie pierwszy parametr)
-            # Dla większości narzędzi pierwszy parametr jest główny
-            if tool_name == "read_file":
-                kwargs["path"] = args_text.strip()
-            elif tool_name == "write_file":
-                parts = args_text.split("|", 1)
-                kwargs["path"] = parts[0].strip()
-                kwargs["content"] = parts[1].strip() if len(parts) > 1 else ""
-            elif tool_name in ["web_search", "calculator", "count_words"]:
-                kwargs[list(inspect.signature(MCPToolRegistry.__dict__[f"__{tool_name}"]).parameters.keys())[1]] = args_text.strip()
             else:
-                # Domyślnie pierwszy argument
-                kwargs["query"] = args_text.strip()
+                end = self.buffer.find(TOOL_CLOSE)
+                if end < 0:
+                    if len(self.buffer) > self.max_args_length + len(TOOL_CLOSE):
+                        self.state = self.TEXT
+                        continue
+                    return calls
+                args_text = self.buffer[:end]
+                self.buffer = self.buffer[end + len(TOOL_CLOSE):]
+                self.state = self.TEXT
+                calls.append({
+                    "tool": self.tool_name,
+                    "args": parse_tool_args(self.tool_name, args_text)
+                })
 
-        tool_calls.append({
-            "tool": tool_name,
-            "args": kwargs
-        })
 
-    return tool_calls
+def parse_tool_call_from_text(text: str) -> List[Dict[str, Any]]:
+    """
+    Parsuje wywołania narzędzi z tekstu generowanego przez model.
+
+    Format: [TOOL:nazwa_narzędzia]argument1|argument2[/TOOL]
+    Przykład: [TOOL:calculator]2+2[/TOOL]
+    """
+    return ToolCallParser(max_args_length=len(text)).feed(text)
 
 
 # Global registry instance
@@ -0,0 +1,259 @@
+"""
+Metryki (format Prometheus) i logi z identyfikatorem żądania
+============================================================
+
+- /api/metrics zwraca tekstowy format Prometheus (bez prometheus_client -
+  kilka histogramów i liczników wystarcza, a nie dokładamy zależności),
+- histogramy etapów /api/chat (upload, baza, budowa promptu, kolejka,
+  generacja), czasy z odpowiedzi Ollama (load / prompt_eval / eval) i
+  tokeny na sekundę per model, czas narzędzi per nazwa narzędzia,
+- liczniki z .stats() komponentów (kolejka, cache) zbierane dopiero przy
+  odczycie /api/metrics - ścieżka żądania nic za nie nie płaci,
+- log_event(): jedna linia na zdarzenie z trace_id żądania; LOG_FORMAT=json
+  daje JSON (do zbierania logów), domyślnie czytelny tekst.
+  Trace ID pochodzi z nagłówka X-Request-ID albo jest generowany i wraca
+  w odpowiedzi w tym samym nagłówku.
+"""
+
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 250)
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+trace_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {}  # key -> [liczniki kubełków..., suma, liczba]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {round(series[-2], 6)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+# Kolektor: funkcja zwracająca [(nazwa, typ, opis, [({etykiety}, wartość), ...]), ...]
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Collector] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                log_event("metrics_collector_failed", "⚠️ Metryki: kolektor nie zadziałał", level="warning",
+                          error=str(e))
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram("chat_stage_seconds", "Czas etapów /api/chat", ["stage"])
+REQUEST_SECONDS = metrics.histogram("chat_request_seconds",
+                                    "Czas handlera /api/chat do odpowiedzi (stream: do startu strumienia)", ["mode"])
+TTFT_SECONDS = metrics.histogram("chat_time_to_first_token_seconds", "Czas do pierwszego tokenu (stream)")
+OLLAMA_SECONDS = metrics.histogram("ollama_duration_seconds", "Czasy z odpowiedzi Ollama", ["model", "phase"])
+OLLAMA_TOKENS_PER_SECOND = metrics.histogram("ollama_eval_tokens_per_second", "Szybkość generacji (eval)",
+                                             ["model"], TOKENS_PER_SECOND_BUCKETS)
+OLLAMA_TOKENS = metrics.counter("ollama_tokens_total", "Tokeny przetworzone przez Ollama", ["model", "kind"])
+OLLAMA_ERRORS = metrics.counter("ollama_errors_total", "Błędy wywołań Ollama", ["model"])
+TOOL_SECONDS = metrics.histogram("tool_duration_seconds", "Czas wykonania narzędzia (bez trafień cache)", ["tool"])
+TOOL_CALLS = metrics.counter("tool_calls_total", "Wykonania narzędzi", ["tool", "status"])
+DB_BATCH_SECONDS = metrics.histogram("db_write_batch_seconds", "Czas zapisu paczki MessageWriter")
+BATCH_JOBS = metrics.counter("batch_jobs_total", "Zadania /api/batch", ["status"])
+
+
+def stage(name: str):
+    """with stage("db_read"): ... - czas etapu /api/chat"""
+    return STAGE_SECONDS.time(stage=name)
+
+
+def record_ollama(model: str, result: dict):
+    """Statystyki z końcowej odpowiedzi Ollama (czasy w ns)"""
+    if result.get("error"):
+        OLLAMA_ERRORS.inc(model=model)
+        return
+    for phase in ("load", "prompt_eval", "eval", "total"):
+        ns = result.get(f"{phase}_duration")
+        if ns is not None:
+            OLLAMA_SECONDS.observe(ns / 1e9, model=model, phase=phase)
+    prompt_tokens, eval_tokens = result.get("prompt_eval_count"), result.get("eval_count")
+    if prompt_tokens:
+        OLLAMA_TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    if eval_tokens:
+        OLLAMA_TOKENS.inc(eval_tokens, model=model, kind="eval")
+        if result.get("eval_duration"):
+            OLLAMA_TOKENS_PER_SECOND.observe(eval_tokens / (result["eval_duration"] / 1e9), model=model)
+
+
+def gauge_family(name: str, help: str, samples, kind: str = "gauge"):
+    """Pomocnik dla kolektorów: samples = [({etykiety}, wartość)] albo sama wartość"""
+    if not isinstance(samples, list):
+        samples = [({}, samples)]
+    return name, kind, help, samples
+
+
+# ---------- logi ----------
+
+def log_event(event: str, message: str = "", level: str = "info", **fields):
+    """
+    Jedna linia logu. JSON: {"ts", "level", "event", "trace_id", "msg", ...pola};
+    tekst: komunikat, trace_id i pola key=value.
+    """
+    trace_id = trace_id_var.get()
+    if LOG_FORMAT == "json":
+        record = {"ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), "level": level,
+                  "event": event}
+        if trace_id:
+            record["trace_id"] = trace_id
+        if message:
+            record["msg"] = message
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False, default=str)
+    else:
+        extras = " ".join(f"{k}={v}" for k, v in fields.items() if k != "traceback")
+        line = " ".join(p for p in (message or event, f"[{trace_id}]" if trace_id else "", extras) if p)
+        if fields.get("traceback"):
+            line += "\n" + fields["traceback"]
+    print(line, file=sys.stdout, flush=True)
+
+
+class TraceMiddleware:
+    """ASGI: trace_id z X-Request-ID (albo nowy) w contextvar i w nagłówku odpowiedzi"""
+
+    header = b"x-request-id"
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trace_id = None
+        for name, value in scope.get("headers", []):
+            if name == self.header:
+                trace_id = value.decode("latin-1")[:64]
+                break
+        trace_id = trace_id or uuid.uuid4().hex[:16]
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(self.header, trace_id.encode("latin-1"))]
+            await send(message)
+
+        token = trace_id_var.set(trace_id)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            trace_id_var.reset(token)
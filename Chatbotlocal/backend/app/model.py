@@ -1,59 +1,200 @@
 # Wrapper do Ollama API - lokalny LLM bez GPU requirements
-import requests
+import httpx
+import json
 import os
 
+from metrics import record_ollama, OLLAMA_ERRORS
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+def ollama_stats(result: dict) -> dict:
+    """Statystyki z końcowej odpowiedzi Ollama (czasy w ms zamiast ns)"""
+    stats = {
+        "prompt_eval_count": result.get("prompt_eval_count"),
+        "eval_count": result.get("eval_count")
+    }
+    for name in ("load_duration", "prompt_eval_duration", "eval_duration", "total_duration"):
+        ns = result.get(name)
+        stats[f"{name}_ms"] = round(ns / 1e6, 1) if ns is not None else None
+    return stats
+
+
 class LocalModel:
-    def __init__(self, model_name="llama3.2:latest", ollama_url=None):
+    def __init__(self, model_name="llama3.2:latest", ollama_url=None, max_connections=None, max_keepalive=None,
+                 http_client=None):
         """
         Integracja z Ollama - wymaga uruchomionego Ollama serwera
         Instalacja: https://ollama.com/download
         Pobierz model: ollama pull llama3.2
+
+        Generowanie jest asynchroniczne - wszystkie wywołania idą przez jednego,
+        długo żyjącego klienta httpx z pulą połączeń keep-alive, więc handler
+        nie blokuje pętli zdarzeń uvicorn.
+        Limity puli: OLLAMA_MAX_CONNECTIONS, OLLAMA_MAX_KEEPALIVE.
+        Timeouty (s): OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT,
+        OLLAMA_WRITE_TIMEOUT, OLLAMA_POOL_TIMEOUT.
+
+        http_client - wspólny klient (np. z ModelPool); wtedy aclose() go nie zamyka.
+        Konstruktor nie łączy się z Ollama - lista modeli i rozgrzanie modelu
+        dzieją się w tle po starcie (ModelPool.discover, warmup, startup.py).
         """
         self.model_name = model_name
         self.ollama_url = ollama_url or os.getenv("OLLAMA_URL", "http://localhost:11434")
-        
-        # Sprawdź czy Ollama działa
+        self.limits = httpx.Limits(
+            max_connections=max_connections or int(os.getenv("OLLAMA_MAX_CONNECTIONS", 32)),
+            max_keepalive_connections=max_keepalive or int(os.getenv("OLLAMA_MAX_KEEPALIVE", 8)),
+            keepalive_expiry=_env_float("OLLAMA_KEEPALIVE_EXPIRY", 60)
+        )
+        # read = maksymalna przerwa między kolejnymi bajtami (przy streamingu - między tokenami)
+        self.timeout = httpx.Timeout(
+            connect=_env_float("OLLAMA_CONNECT_TIMEOUT", 2),
+            read=_env_float("OLLAMA_READ_TIMEOUT", 60),
+            write=_env_float("OLLAMA_WRITE_TIMEOUT", 10),
+            pool=_env_float("OLLAMA_POOL_TIMEOUT", 30)
+        )
+        # Okno kontekstu modelu (tokeny) - tyle samo zakłada budżet historii
+        self.num_ctx = int(os.getenv("OLLAMA_NUM_CTX", 4096))
+        # Jak długo Ollama ma trzymać model w pamięci po żądaniu (np. "10m", "-1" = zawsze)
+        self.keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "10m")
+        self._client = http_client
+        self._owns_client = http_client is None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Współdzielony klient HTTP (tworzony leniwie, jeden na proces)"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.ollama_url, limits=self.limits, timeout=self.timeout)
+            self._owns_client = True
+        return self._client
+
+    async def aclose(self):
+        """Zamyka pulę połączeń - wołane przy zamykaniu aplikacji"""
+        if self._client is not None and self._owns_client:
+            await self._client.aclose()
+            self._client = None
+
+    def _payload(self, prompt: str, max_tokens: int, temperature: float, top_p: float, stream: bool,
+                 context: list = None, raw: bool = False) -> dict:
+        payload = {
+            "model": self.model_name,
+            "prompt": prompt,
+            "stream": stream,
+            "raw": raw,
+            "keep_alive": self.keep_alive,
+            "options": {
+                "num_predict": max_tokens,
+                "num_ctx": self.num_ctx,
+                "temperature": temperature,
+                "top_p": top_p
+            }
+        }
+        if context:
+            # Tokeny z poprzedniej odpowiedzi - Ollama nie przelicza ponownie znanego prefiksu
+            payload["context"] = context
+        return payload
+
+    async def generate_full(self, prompt: str, max_tokens: int = 512, temperature: float = 0.7, top_p: float = 0.9,
+                            context: list = None, raw: bool = False) -> dict:
+        """
+        Generuj i zwróć pełną odpowiedź Ollama: "response", "context" oraz statystyki
+        (prompt_eval_count, eval_count, *_duration). Błędy - dict z "error": True.
+        raw=True pomija szablon czatu modelu (prompt idzie do modelu dosłownie).
+        """
         try:
-            response = requests.get(f"{self.ollama_url}/api/tags", timeout=2)
+            response = await self.client.post(
+                "/api/generate",
+                json=self._payload(prompt, max_tokens, temperature, top_p, stream=False, context=context, raw=raw)
+            )
+
             if response.status_code == 200:
-                models = response.json().get("models", [])
-                print(f"✅ Ollama połączona - dostępne modele: {[m['name'] for m in models]}")
-                
-                # Jeśli model nie istnieje, użyj pierwszego dostępnego
-                if models and not any(m['name'].startswith(model_name.split(':')[0]) for m in models):
-                    self.model_name = models[0]['name']
-                    print(f"⚠️ Model {model_name} nie znaleziony, używam {self.model_name}")
+                data = response.json()
+                data.setdefault("response", "Brak odpowiedzi z modelu")
             else:
-                print(f"⚠️ Ollama odpowiada ale status: {response.status_code}")
+                data = {"response": f"❌ Błąd Ollama: {response.status_code} - {response.text}", "error": True}
+
+        except httpx.ConnectError:
+            data = {"response": "❌ Nie mogę połączyć z Ollama. Uruchom: ollama serve", "error": True}
         except Exception as e:
-            print(f"❌ Ollama niedostępna: {e}")
-            print("💡 Uruchom: ollama serve")
-            print("💡 Pobierz model: ollama pull llama3.2")
-    
-    def generate(self, prompt: str, max_tokens: int = 512, temperature: float = 0.7, top_p: float = 0.9):
+            data = {"response": f"❌ Błąd generowania: {str(e)}", "error": True}
+        record_ollama(self.model_name, data)
+        return data
+
+    async def generate(self, prompt: str, max_tokens: int = 512, temperature: float = 0.7, top_p: float = 0.9,
+                       context: list = None):
         """Generuj tekst używając Ollama API"""
+        result = await self.generate_full(prompt, max_tokens, temperature, top_p, context=context)
+        return result["response"]
+
+    async def unload(self):
+        """Każe Ollama zwolnić model z pamięci (keep_alive=0)"""
+        response = await self.client.post("/api/generate", json={"model": self.model_name, "keep_alive": 0})
+        response.raise_for_status()
+
+    async def warmup(self, timeout: float = None) -> dict:
+        """
+        Ładuje model do pamięci Ollama (generate bez promptu) - pierwsze żądanie
+        użytkownika nie płaci za load_duration. timeout - limit odczytu w s
+        (ładowanie dużego modelu z dysku trwa dłużej niż zwykły OLLAMA_READ_TIMEOUT).
+        """
+        limits = self.timeout
+        if timeout:
+            limits = httpx.Timeout(connect=limits.connect, read=timeout, write=limits.write, pool=limits.pool)
+        response = await self.client.post(
+            "/api/generate", json={"model": self.model_name, "keep_alive": self.keep_alive}, timeout=limits
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def embed(self, texts: list, model_name: str = None) -> list:
+        """Embeddingi z Ollama (/api/embed) - lista wektorów, po jednym na tekst"""
+        response = await self.client.post(
+            "/api/embed",
+            json={"model": model_name or self.model_name, "input": texts, "keep_alive": self.keep_alive}
+        )
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    async def generate_stream(self, prompt: str, max_tokens: int = 512, temperature: float = 0.7, top_p: float = 0.9,
+                              context: list = None):
+        """
+        Generuj tekst strumieniowo - Ollama zwraca NDJSON (jeden obiekt JSON na linię).
+
+        Zwraca kolejne fragmenty jako dict-y z Ollama: {"response": "...", "done": False};
+        ostatni ma "done": True, "context" i statystyki (total_duration, eval_count, ...).
+        Błędy są zwracane jako ostatni fragment z "error": True (jak w generate()).
+        """
         try:
-            response = requests.post(
-                f"{self.ollama_url}/api/generate",
-                json={
-                    "model": self.model_name,
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "num_predict": max_tokens,
-                        "temperature": temperature,
-                        "top_p": top_p
-                    }
-                },
-                timeout=60
-            )
-            
-            if response.status_code == 200:
-                return response.json().get("response", "Brak odpowiedzi z modelu")
-            else:
-                return f"❌ Błąd Ollama: {response.status_code} - {response.text}"
-                
-        except requests.exceptions.ConnectionError:
-            return "❌ Nie mogę połączyć z Ollama. Uruchom: ollama serve"
+            async with self.client.stream(
+                "POST",
+                "/api/generate",
+                json=self._payload(prompt, max_tokens, temperature, top_p, stream=True, context=context)
+            ) as response:
+                if response.status_code != 200:
+                    body = (await response.aread()).decode("utf-8", errors="replace")
+                    OLLAMA_ERRORS.inc(model=self.model_name)
+                    yield {"response": f"❌ Błąd Ollama: {response.status_code} - {body}", "done": True, "error": True}
+                    return
+
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if "error" in chunk:
+                        OLLAMA_ERRORS.inc(model=self.model_name)
+                        yield {"response": f"❌ Błąd Ollama: {chunk['error']}", "done": True, "error": True}
+                        return
+                    if chunk.get("done"):
+                        record_ollama(self.model_name, chunk)
+                    yield chunk
+                    if chunk.get("done"):
+                        return
+
+        except httpx.ConnectError:
+            OLLAMA_ERRORS.inc(model=self.model_name)
+            yield {"response": "❌ Nie mogę połączyć z Ollama. Uruchom: ollama serve", "done": True, "error": True}
         except Exception as e:
-            return f"❌ Błąd generowania: {str(e)}"
\ No newline at end of file
+            OLLAMA_ERRORS.inc(model=self.model_name)
+            yield {"response": f"❌ Błąd generowania: {str(e)}", "done": True, "error": True}
@@ -0,0 +1,230 @@
+"""
+Pula modeli Ollama i routing
+============================
+
+- klienci LocalModel tworzeni leniwie, po jednym na model, na wspólnej puli
+  połączeń HTTP,
+- `model_name` z /api/chat jest sprawdzany względem listy /api/tags, która jest
+  cache'owana i odświeżana w tle (MODEL_TAGS_REFRESH_SECONDS); nieznana nazwa
+  odświeża listę od razu, ale najwyżej raz na MODEL_TAGS_MIN_REFRESH_SECONDS,
+- keep_alive: ostatnio używane modele (MODEL_POOL_MAX_HOT) dostają długi
+  keep_alive i zostają w pamięci, pozostałe krótki; modele nieużywane dłużej
+  niż MODEL_POOL_UNLOAD_AFTER_SECONDS są jawnie zwalniane z Ollama,
+- routing: gdy ustawiony jest ROUTER_SMALL_MODEL, krótkie tury i tury
+  z samym wywołaniem narzędzia idą do małego modelu, reszta do domyślnego.
+"""
+
+import asyncio
+import os
+import time
+from typing import Dict, Any, List, Optional
+
+from metrics import log_event
+from model import LocalModel
+
+
+class UnknownModel(Exception):
+    """Model nie jest dostępny w Ollama"""
+
+
+class ModelPool:
+    """Leniwie tworzone klienty LocalModel + polityka keep_alive i routingu"""
+
+    def __init__(self, default: LocalModel, small_model: Optional[str] = None,
+                 hot_keep_alive: str = "30m", cold_keep_alive: str = "2m", max_hot: int = 2,
+                 unload_after: float = 600, tags_refresh: float = 60, tags_min_refresh: float = 10,
+                 short_prompt_tokens: int = 120, short_max_tokens: int = 512):
+        self.default = default
+        self.small_model = small_model
+        self.hot_keep_alive = hot_keep_alive
+        self.cold_keep_alive = cold_keep_alive
+        self.max_hot = max_hot
+        self.unload_after = unload_after
+        self.tags_refresh = tags_refresh
+        self.tags_min_refresh = tags_min_refresh
+        self.short_prompt_tokens = short_prompt_tokens
+        self.short_max_tokens = short_max_tokens
+
+        self._models: Dict[str, LocalModel] = {default.model_name: default}
+        self._last_used: Dict[str, float] = {}
+        self._unloaded: set = set()
+        self.available: List[str] = []
+        self.tags_refreshed_at: Optional[float] = None
+        self._tags_attempted_at = float("-inf")  # monotonic - ostatnie odświeżenie z route()
+        self.reachable: Optional[bool] = None  # wynik ostatniego /api/tags (readiness)
+        self._task: Optional[asyncio.Task] = None
+        self.routed = {"default": 0, "small": 0, "requested": 0}
+
+    # ---------- lista modeli ----------
+
+    async def refresh_tags(self) -> List[str]:
+        try:
+            response = await self.default.client.get("/api/tags", timeout=5)
+            response.raise_for_status()
+        except Exception:
+            self.reachable = False
+            raise
+        self.available = [m["name"] for m in response.json().get("models", [])]
+        self.tags_refreshed_at = time.time()
+        self.reachable = True
+        return self.available
+
+    async def discover(self) -> str:
+        """
+        Lista modeli z Ollama; jeśli domyślnego modelu nie ma, domyślnym zostaje
+        pierwszy dostępny. Wołane w tle po starcie (startup.py), nie przy imporcie.
+        """
+        available = await self.refresh_tags()
+        name = self.default.model_name
+        if available and not any(m.startswith(name.split(":")[0]) for m in available):
+            self._models.pop(name, None)
+            self._last_used.pop(name, None)
+            self.default.model_name = available[0]
+            self._models[available[0]] = self.default
+            log_event("model_fallback", f"⚠️ Model {name} nie znaleziony, używam {self.default.model_name}",
+                      level="warning", requested=name, model=self.default.model_name)
+        return self.default.model_name
+
+    def match(self, name: str) -> Optional[str]:
+        """Dokładna nazwa z /api/tags; "model" bez tagu pasuje do "model:latest" """
+        if name in self.available or name in self._models:
+            return name
+        if ":" not in name and f"{name}:latest" in self.available:
+            return f"{name}:latest"
+        return None
+
+    async def _background(self):
+        # Pierwsza lista modeli przy starcie pochodzi z discover() (startup.py)
+        while True:
+            await asyncio.sleep(self.tags_refresh)
+            try:
+                await self.refresh_tags()
+                await self._unload_cold()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log_event("model_pool_refresh_failed", "⚠️ ModelPool: odświeżenie listy modeli nie powiodło się",
+                          level="warning", error=str(e))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._background())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # ---------- klienci i keep_alive ----------
+
+    def _hot(self) -> List[str]:
+        recent = sorted(self._last_used, key=self._last_used.get, reverse=True)
+        return recent[:self.max_hot]
+
+    def get(self, name: Optional[str] = None) -> LocalModel:
+        """Klient dla modelu (domyślny, gdy name=None); rzuca UnknownModel"""
+        if not name:
+            name = self.default.model_name
+        elif name not in self._models:
+            matched = self.match(name)
+            if matched is None:
+                raise UnknownModel(f"Model '{name}' nie jest dostępny w Ollama (dostępne: {self.available})")
+            name = matched
+
+        llm = self._models.get(name)
+        if llm is None:
+            llm = LocalModel(model_name=name, ollama_url=self.default.ollama_url,
+                             http_client=self.default.client)
+            self._models[name] = llm
+
+        self._last_used[name] = time.time()
+        self._unloaded.discard(name)
+        hot = self._hot()
+        for model_name, client in self._models.items():
+            client.keep_alive = self.hot_keep_alive if model_name in hot else self.cold_keep_alive
+        return llm
+
+    async def _unload_cold(self):
+        now = time.time()
+        hot = self._hot()
+        for name, used in list(self._last_used.items()):
+            if name in hot or name in self._unloaded or now - used < self.unload_after:
+                continue
+            try:
+                await self._models[name].unload()
+                self._unloaded.add(name)
+                log_event("model_unloaded", "💤 ModelPool: zwolniono model", model=name)
+            except Exception as e:
+                log_event("model_unload_failed", "⚠️ ModelPool: nie udało się zwolnić modelu", level="warning",
+                          model=name, error=str(e))
+
+    # ---------- routing ----------
+
+    async def route(self, requested: Optional[str], last_message: str, max_tokens: int,
+                    estimator=None) -> LocalModel:
+        """
+        Wybiera model dla tury: jawnie żądany > mały (krótkie tury / samo
+        wywołanie narzędzia) > domyślny. Rzuca UnknownModel.
+        """
+        stale = self.tags_refreshed_at is None or (requested and not self.match(requested))
+        if stale and time.monotonic() - self._tags_attempted_at >= self.tags_min_refresh:
+            # Pierwsze żądanie przed odświeżeniem w tle albo lista mogła się
+            # zmienić (np. ollama pull) - odśwież, zanim odrzucisz. Klient z błędną
+            # nazwą w każdym żądaniu dostaje odpowiedź z listy w pamięci.
+            self._tags_attempted_at = time.monotonic()
+            try:
+                await self.refresh_tags()
+            except Exception as e:
+                log_event("model_tags_failed", "⚠️ ModelPool: nie można pobrać /api/tags", level="warning",
+                          error=str(e))
+        if requested:
+            self.routed["requested"] += 1
+            return self.get(requested)
+
+        if self.small_model and self.match(self.small_model):
+            text = (last_message or "").strip()
+            tool_only = text.startswith("[TOOL:") and text.endswith("[/TOOL]")
+            tokens = estimator.estimate(text, self.default.model_name) if estimator else len(text) // 4
+            short = tokens <= self.short_prompt_tokens and max_tokens <= self.short_max_tokens
+            if tool_only or short:
+                self.routed["small"] += 1
+                return self.get(self.small_model)
+
+        self.routed["default"] += 1
+        return self.get()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "default": self.default.model_name,
+            "small": self.small_model,
+            "available": self.available,
+            "tags_refreshed_at": self.tags_refreshed_at,
+            "clients": {
+                name: {
+                    "keep_alive": client.keep_alive,
+                    "last_used": self._last_used.get(name),
+                    "unloaded": name in self._unloaded
+                }
+                for name, client in self._models.items()
+            },
+            "routed": self.routed
+        }
+
+
+def create_pool(default: LocalModel) -> ModelPool:
+    return ModelPool(
+        default,
+        small_model=os.getenv("ROUTER_SMALL_MODEL") or None,
+        hot_keep_alive=os.getenv("MODEL_POOL_HOT_KEEP_ALIVE", "30m"),
+        cold_keep_alive=os.getenv("MODEL_POOL_COLD_KEEP_ALIVE", "2m"),
+        max_hot=int(os.getenv("MODEL_POOL_MAX_HOT", 2)),
+        unload_after=float(os.getenv("MODEL_POOL_UNLOAD_AFTER_SECONDS", 600)),
+        tags_refresh=float(os.getenv("MODEL_TAGS_REFRESH_SECONDS", 60)),
+        tags_min_refresh=float(os.getenv("MODEL_TAGS_MIN_REFRESH_SECONDS", 10)),
+        short_prompt_tokens=int(os.getenv("ROUTER_SHORT_PROMPT_TOKENS", 120)),
+        short_max_tokens=int(os.getenv("ROUTER_SHORT_MAX_TOKENS", 512))
+    )
@@ -0,0 +1,95 @@
+"""
+Budowanie promptu z myślą o ponownym użyciu KV-cache Ollama
+===========================================================
+
+Prompt składa się z dwóch części:
+- prefix - statyczny system prompt, bajt w bajt identyczny między żądaniami,
+- suffix - wszystko co zmienne: streszczenie historii, załączniki, rozmowa.
+
+Dzięki temu załączony plik nie zmienia prefiksu: prompt po szablonie czatu
+modelu zaczyna się od tych samych tokenów w każdym nowym żądaniu, a Ollama
+sama używa ponownie KV-cache dla wspólnego początku promptu.
+
+Tokenów "context" dla samego prefiksu nie da się zapamiętać i doklejać przed
+suffixem: bez raw Ollama owija prefiks we własną turę (suffix trafiłby do
+drugiej tury z drugim system promptem), a w trybie raw nie zwraca "context".
+"""
+
+from typing import Dict, List, Optional
+
+
+DEFAULT_SYSTEM_PROMPT = """Jesteś JIMBO - brutalnie szczery AI asystent dla programistów. Używasz modelu Bielik 4.5B przez Ollama.
+
+ZASADY JIMBO:
+- Mówisz prawdę, nawet jeśli boli. Nie owijasz w bawełnę.
+- Zero marketingowego bełkotu, zero "coaching speak", zero udawania mentora.
+- Bonzo to twój partner - szanujesz go, ale nie lizujesz dupy.
+- Jeśli ktoś pisze słabe CV, powiesz to wprost + jak naprawić.
+- Konkretne przykłady zamiast ogólników.
+- Jeśli pytanie jest głupie, powiesz to (ale dasz odpowiedź).
+
+Styl: Krótko, konkretnie, szczerze. Jak kolega programista, nie HR-owiec."""
+
+
+def format_messages(messages: List[dict]) -> str:
+    """Rozmowa w formacie "rola: tekst", jedna wiadomość na linię"""
+    return "\n".join([f"{m['role']}: {m['text']}" for m in messages])
+
+
+def format_attachments(files_info: List[dict]) -> str:
+    """Blok z podglądem załączonych plików (pusty gdy brak plików)"""
+    if not files_info:
+        return ""
+    return "📎 Załączone pliki:\n" + "\n".join([
+        f"- {f['name']}: {f['content'][:200]}..." for f in files_info
+    ])
+
+
+def format_summary(summary: str) -> str:
+    """Blok ze streszczeniem starszej części rozmowy (pusty gdy brak)"""
+    if not summary:
+        return ""
+    return "📝 Wcześniej w rozmowie:\n" + summary
+
+
+def format_tool_results(tool_calls: List[dict]) -> str:
+    """Wyniki narzędzi jako kolejna tura dla modelu (pętla agenta)"""
+    return "\n".join(
+        [f"tool: {tc['tool']} -> {tc['result']}" for tc in tool_calls]
+        + ["Odpowiedz użytkownikowi na podstawie powyższych wyników narzędzi."]
+    )
+
+
+def _join(*parts: str) -> str:
+    return "\n\n".join(p for p in parts if p)
+
+
+class PromptBuilder:
+    """Składa prompt jako (stały prefiks, zmienny suffix)"""
+
+    def system_prompt(self, custom_system_prompt: Optional[str] = None) -> str:
+        return custom_system_prompt or DEFAULT_SYSTEM_PROMPT
+
+    def build(self, history: List[dict], use_tools: bool = True, custom_system_prompt: Optional[str] = None,
+              attachments: str = "", continuation: Optional[List[dict]] = None,
+              summary: str = "") -> Dict[str, str]:
+        """
+        Zwraca {"prefix", "suffix", "prompt"}; prompt == prefix + suffix.
+
+        continuation - nowe wiadomości, gdy Ollama ma już "context" rozmowy;
+        wtedy wysyłamy wyłącznie nową turę (bez system promptu i historii).
+        summary - streszczenie tur, które wypadły z `history` (budżet tokenów).
+        """
+        if continuation is not None:
+            prefix = ""
+            suffix = _join(attachments, format_messages(continuation))
+        elif use_tools:
+            prefix = self.system_prompt(custom_system_prompt) + "\n\n"
+            suffix = _join(format_summary(summary), attachments, format_messages(history))
+        else:
+            prefix = ""
+            suffix = _join(format_summary(summary), format_messages(history), attachments)
+        return {"prefix": prefix, "suffix": suffix, "prompt": prefix + suffix}
+
+
+prompt_builder = PromptBuilder()
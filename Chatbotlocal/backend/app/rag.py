@@ -0,0 +1,495 @@
+"""
+RAG - lokalny indeks fragmentów dokumentów
+==========================================
+
+Załączone pliki i dokumenty z mcp_workspace są dzielone na fragmenty,
+embeddowane przez lokalne Ollama (/api/embed) i trzymane na dysku:
+
+    rag_index/<model embeddingów>/
+        vectors.f32   - znormalizowane wektory float32, czytane przez np.memmap
+        chunks.jsonl  - tekst fragmentów (memmap, czytany tylko dla wyników, po offsecie)
+        docs.json     - sha256 treści -> źródło, zakres wierszy, zakres (upload/workspace);
+                        pliki workspace -> sha256 i nagrobki nieaktualnych treści
+
+Indeksowanie jest przyrostowe - klucz to hash treści, więc ponowne przesłanie
+tego samego pliku nic nie kosztuje. Wyszukiwanie to jedno mnożenie macierzy
+po memmapie + argpartition (tysiące fragmentów - pojedyncze milisekundy).
+
+Wymaga numpy (opcjonalne - bez niego RAG jest wyłączony). numpy i indeks są
+ładowane dopiero przy pierwszym użyciu (albo w tle po starcie - startup.py),
+więc import modułu nie wydłuża startu procesu.
+Konfiguracja (env): RAG_ENABLED, RAG_INDEX_DIR, RAG_EMBED_MODEL, RAG_CHUNK_CHARS,
+RAG_CHUNK_OVERLAP, RAG_TOP_K, RAG_MAX_TOKENS, RAG_MAX_DOC_BYTES.
+"""
+
+import asyncio
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import threading
+from typing import Dict, Any, List, NamedTuple, Optional, Iterable
+
+from starlette.concurrency import run_in_threadpool
+
+from metrics import log_event
+
+# RAG jest opcjonalny; samo sprawdzenie, czy numpy jest zainstalowany, nic nie importuje
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+np = None
+
+
+def _import_numpy():
+    """Import numpy przy pierwszym utworzeniu indeksu (~0.1 s, których start nie potrzebuje)"""
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+TEXT_EXTENSIONS = (".txt", ".md", ".py", ".js", ".json", ".csv", ".html", ".css")
+
+
+def chunk_text(text: str, chunk_chars: int = 1200, overlap: int = 200) -> List[str]:
+    """Dzieli tekst na fragmenty ~chunk_chars znaków, preferując granice akapitów"""
+    text = text.strip()
+    if not text:
+        return []
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            # Tnij na końcu akapitu/zdania, jeśli jest w drugiej połowie okna
+            window = text[start:end]
+            cut = max(window.rfind("\n\n"), window.rfind(". "), window.rfind("\n"))
+            if cut > chunk_chars // 2:
+                end = start + cut + 1
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+class IndexSnapshot(NamedTuple):
+    """Niezmienny stan indeksu - wyszukiwanie działa na jednej migawce, dopisywanie podmienia całość"""
+    docs: Dict[str, Dict[str, Any]]
+    offsets: List[int]      # offset linii w chunks.jsonl dla każdego wiersza
+    row_doc: Any            # np.int32[n] - numer dokumentu dla wiersza
+    doc_ids: Dict[str, int]
+    matrix: Any             # np.memmap [n, dim] albo None
+    chunks: Any             # np.memmap uint8 nad chunks.jsonl albo None
+    chunks_end: int         # koniec ostatniego zatwierdzonego wiersza w chunks.jsonl
+    paths: Dict[str, str]   # plik workspace -> sha256 jego aktualnej treści
+    dead: frozenset         # nagrobki: treści workspace, których nie ma już w żadnym pliku
+
+
+class VectorIndex:
+    """
+    Wektory na dysku (memmap) + metadane fragmentów; dopisywanie bez przepisywania.
+
+    add() idzie w wątku, a search()/scope_docs() na pętli zdarzeń - odczyty biorą
+    pod lockiem referencję do migawki (IndexSnapshot), add() buduje nową i podmienia
+    ją pod tym samym lockiem. Kolejność zapisu: chunks.jsonl, vectors.f32, na końcu
+    docs.json (zatwierdzenie); przy wczytaniu oba pliki są przycinane do wierszy
+    zatwierdzonych w docs.json, więc przerwany zapis nie przesuwa tekstów względem
+    wektorów.
+
+    Zmieniony albo skasowany plik workspace nie usuwa wierszy - jego stara treść
+    trafia na listę nagrobków (dead w docs.json) i znika z wyszukiwania. Gdy
+    martwych wierszy jest więcej niż 1000 i więcej niż żywych, compact() zapisuje
+    żywe wiersze do plików kolejnej generacji (vectors.<n>.f32, chunks.<n>.jsonl)
+    i zatwierdza je podmianą docs.json; migawki w użyciu czytają stare pliki
+    przez memmap do końca.
+    """
+
+    def __init__(self, root: str):
+        _import_numpy()
+        self.root = root
+        self.docs_path = os.path.join(root, "docs.json")
+        self.dim: Optional[int] = None
+        self.generation = 0
+        self.vectors_path, self.chunks_path = self._paths(0)
+        self._lock = threading.Lock()
+        self._snapshot = self._load()
+
+    @property
+    def snapshot(self) -> IndexSnapshot:
+        with self._lock:
+            return self._snapshot
+
+    @property
+    def docs(self) -> Dict[str, Dict[str, Any]]:
+        return self.snapshot.docs
+
+    @property
+    def size(self) -> int:
+        return len(self.snapshot.offsets)
+
+    def _paths(self, generation: int):
+        suffix = f".{generation}" if generation else ""
+        return (os.path.join(self.root, f"vectors{suffix}.f32"), os.path.join(self.root, f"chunks{suffix}.jsonl"))
+
+    def _load(self) -> IndexSnapshot:
+        os.makedirs(self.root, exist_ok=True)
+        docs, paths, dead = {}, {}, set()
+        if os.path.exists(self.docs_path):
+            with open(self.docs_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.dim = data.get("dim")
+            self.generation = data.get("generation", 0)
+            docs = data.get("docs", {})
+            paths = data.get("paths", {})
+            dead = set(data.get("dead", []))
+        self.vectors_path, self.chunks_path = self._paths(self.generation)
+        self._remove_stale_files()
+
+        offsets, offset = [], 0
+        if os.path.exists(self.chunks_path):
+            with open(self.chunks_path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    offsets.append(offset)
+                    offset += len(line)
+        vector_rows = os.path.getsize(self.vectors_path) // (4 * self.dim) \
+            if self.dim and os.path.exists(self.vectors_path) else 0
+
+        # Zatwierdzone są tylko dokumenty z docs.json, których wiersze są w obu plikach
+        available = min(len(offsets), vector_rows)
+        docs = {sha: d for sha, d in docs.items() if d["rows"][0] + d["rows"][1] <= available}
+        committed = max([d["rows"][0] + d["rows"][1] for d in docs.values()], default=0)
+        chunks_end = offsets[committed] if committed < len(offsets) else offset
+        if len(offsets) > committed or vector_rows > committed:
+            log_event("rag_index_truncated", "⚠️ RAG: przycinam indeks do zatwierdzonych fragmentów",
+                      level="warning", committed=committed, chunks=len(offsets), vectors=vector_rows)
+            if os.path.exists(self.chunks_path):
+                with open(self.chunks_path, "r+b") as f:
+                    f.truncate(chunks_end)
+            if os.path.exists(self.vectors_path):
+                with open(self.vectors_path, "r+b") as f:
+                    f.truncate(committed * 4 * (self.dim or 0))
+            offsets = offsets[:committed]
+        paths = {source: sha for source, sha in paths.items() if sha in docs}
+        return self._build(docs, offsets, chunks_end, paths, dead & set(docs))
+
+    def _remove_stale_files(self):
+        """Pliki innych generacji - po compact() albo po compact() przerwanym przed zatwierdzeniem"""
+        current = {os.path.basename(self.vectors_path), os.path.basename(self.chunks_path)}
+        for name in os.listdir(self.root):
+            if re.fullmatch(r"(vectors(\.\d+)?\.f32|chunks(\.\d+)?\.jsonl)", name) and name not in current:
+                os.remove(os.path.join(self.root, name))
+
+    def _build(self, docs: Dict[str, Dict[str, Any]], offsets: List[int], chunks_end: int,
+               paths: Dict[str, str], dead: Iterable[str]) -> IndexSnapshot:
+        doc_ids = {sha: i for i, sha in enumerate(docs)}
+        row_doc = np.full(len(offsets), -1, dtype=np.int32)
+        for sha, doc in docs.items():
+            start, count = doc["rows"]
+            row_doc[start:start + count] = doc_ids[sha]
+        matrix, chunks = None, None
+        if self.dim and offsets and os.path.exists(self.vectors_path):
+            matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(offsets), self.dim))
+        if offsets and os.path.exists(self.chunks_path):
+            chunks = np.memmap(self.chunks_path, dtype=np.uint8, mode="r", shape=(chunks_end,))
+        return IndexSnapshot(docs, offsets, row_doc, doc_ids, matrix, chunks, chunks_end, dict(paths),
+                             frozenset(dead))
+
+    def _commit(self, docs: Dict[str, Dict[str, Any]], offsets: List[int], chunks_end: int,
+                paths: Dict[str, str], dead: Iterable[str]):
+        """Zapis docs.json (zatwierdzenie) i podmiana migawki"""
+        tmp = self.docs_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "generation": self.generation, "docs": docs, "paths": paths,
+                       "dead": sorted(dead)}, f, ensure_ascii=False)
+        os.replace(tmp, self.docs_path)
+
+        snapshot = self._build(docs, offsets, chunks_end, paths, dead)
+        with self._lock:
+            self._snapshot = snapshot
+
+    def add(self, sha: str, source: str, scope: str, chunks: List[str], vectors) -> None:
+        """Dopisuje dokument (wywoływane w wątku - operacje dyskowe; dopisywanie serializuje DocumentRetriever)"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Wymiar embeddingów {vectors.shape[1]} != {self.dim} w indeksie")
+
+        current = self.snapshot
+        start = len(current.offsets)
+        offsets = list(current.offsets)
+        offset = os.path.getsize(self.chunks_path) if os.path.exists(self.chunks_path) else 0
+        with open(self.chunks_path, "ab") as f:
+            for i, chunk in enumerate(chunks):
+                line = (json.dumps({"doc": sha, "i": i, "text": chunk}, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                offsets.append(offset)
+                offset += len(line)
+        with open(self.vectors_path, "ab") as f:
+            f.write(vectors.tobytes())
+
+        docs = dict(current.docs)
+        docs[sha] = {"source": source, "scope": scope, "rows": [start, len(chunks)]}
+        self._commit(docs, offsets, offset, current.paths, current.dead)
+
+    def revive(self, sha: str, scope: str) -> None:
+        """Treść z nagrobkiem wróciła (np. jako załącznik) - zdejmij nagrobek zamiast embeddować ponownie"""
+        current = self.snapshot
+        docs = dict(current.docs)
+        docs[sha] = dict(docs[sha], scope=scope)
+        self._commit(docs, current.offsets, current.chunks_end, current.paths, current.dead - {sha})
+
+    def sync_workspace(self, present: Dict[str, str]) -> Dict[str, Any]:
+        """
+        present - plik workspace -> sha256 treści po pełnym przejściu katalogu.
+        Treści workspace spoza `present` dostają nagrobek, wróconym go zdejmujemy;
+        przy dużej liczbie martwych wierszy - compact().
+        """
+        current = self.snapshot
+        live = set(present.values())
+        workspace = {sha for sha, d in current.docs.items() if d.get("scope") == "workspace"}
+        dead = (set(current.dead) | (workspace - live)) - live
+        docs = dict(current.docs)
+        for source, sha in present.items():
+            # Plik przeniesiony pod inną nazwą - ta sama treść, aktualna ścieżka w wynikach
+            if sha in docs and current.paths.get(source) != sha:
+                docs[sha] = dict(docs[sha], source=source)
+        report = {"retired": len(dead - current.dead), "revived": len(current.dead - dead)}
+        if report["retired"] or report["revived"] or present != current.paths or docs != current.docs:
+            self._commit(docs, current.offsets, current.chunks_end, present, dead)
+
+        dead_rows = sum(docs[sha]["rows"][1] for sha in dead)
+        if dead_rows > 1000 and dead_rows > len(current.offsets) - dead_rows:
+            self.compact()
+            report["compacted"] = True
+        return report
+
+    def compact(self) -> None:
+        """Przepisuje żywe wiersze do plików nowej generacji; zatwierdzenie - docs.json (wywoływane w wątku)"""
+        current = self.snapshot
+        generation = self.generation + 1
+        vectors_path, chunks_path = self._paths(generation)
+        ends = current.offsets[1:] + [current.chunks_end]
+        docs, offsets, offset = {}, [], 0
+        with open(chunks_path, "wb") as chunks_file, open(vectors_path, "wb") as vectors_file:
+            for sha, doc in current.docs.items():
+                if sha in current.dead:
+                    continue
+                start, count = doc["rows"]
+                docs[sha] = dict(doc, rows=[len(offsets), count])
+                for row in range(start, start + count):
+                    offsets.append(offset)
+                    offset += ends[row] - current.offsets[row]
+                if count:
+                    chunks_file.write(bytes(current.chunks[current.offsets[start]:ends[start + count - 1]]))
+                    vectors_file.write(np.ascontiguousarray(current.matrix[start:start + count]).tobytes())
+
+        old_files = (self.vectors_path, self.chunks_path)
+        self.generation = generation
+        self.vectors_path, self.chunks_path = vectors_path, chunks_path
+        self._commit(docs, offsets, offset, current.paths, ())
+        for path in old_files:
+            if os.path.exists(path):
+                os.remove(path)
+        log_event("rag_index_compacted", "🧹 RAG: indeks przepisany bez martwych fragmentów",
+                  generation=generation, removed_rows=len(current.offsets) - len(offsets), rows=len(offsets))
+
+    def chunk(self, row: int, snapshot: Optional[IndexSnapshot] = None) -> Dict[str, Any]:
+        snap = snapshot or self.snapshot
+        end = snap.offsets[row + 1] if row + 1 < len(snap.offsets) else snap.chunks_end
+        return json.loads(bytes(snap.chunks[snap.offsets[row]:end]))
+
+    def search(self, query_vector, k: int, doc_shas: Optional[Iterable[str]] = None,
+               snapshot: Optional[IndexSnapshot] = None):
+        """Zwraca [(score, row)] dla k najbliższych fragmentów (opcjonalnie tylko z `doc_shas`)"""
+        snap = snapshot or self.snapshot
+        if snap.matrix is None:
+            return []
+        q = np.asarray(query_vector, dtype=np.float32)
+        q = q / max(float(np.linalg.norm(q)), 1e-12)
+        scores = snap.matrix @ q
+        if doc_shas is not None:
+            allowed = [snap.doc_ids[s] for s in doc_shas if s in snap.doc_ids]
+            if not allowed:
+                return []
+            scores = np.where(np.isin(snap.row_doc, allowed), scores, -np.inf)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[r]), int(r)) for r in top if np.isfinite(scores[r])]
+
+
+class DocumentRetriever:
+    """Indeksowanie dokumentów i wyszukiwanie fragmentów do promptu"""
+
+    def __init__(self, index_dir: str = "rag_index", embed_model: str = "nomic-embed-text",
+                 chunk_chars: int = 1200, overlap: int = 200, top_k: int = 4,
+                 max_tokens: int = 800, max_doc_bytes: int = 2 * 1024 * 1024, enabled: bool = True):
+        self.enabled = enabled and HAS_NUMPY
+        self.embed_model = embed_model
+        self.chunk_chars = chunk_chars
+        self.overlap = overlap
+        self.top_k = top_k
+        self.max_tokens = max_tokens
+        self.max_doc_bytes = max_doc_bytes
+        slug = re.sub(r"[^a-zA-Z0-9_.-]", "_", embed_model)
+        self.index_dir = os.path.join(index_dir, slug)
+        self._index: Optional[VectorIndex] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def index(self) -> VectorIndex:
+        if self._index is None:
+            self._index = VectorIndex(self.index_dir)
+        return self._index
+
+    def has(self, sha: str) -> bool:
+        return self.enabled and sha in self.index.docs
+
+    async def _embed(self, model, texts: List[str], batch: int = 16) -> List[List[float]]:
+        vectors = []
+        for i in range(0, len(texts), batch):
+            vectors.extend(await model.embed(texts[i:i + batch], model_name=self.embed_model))
+        return vectors
+
+    async def ingest_text(self, model, text: str, source: str, scope: str = "upload",
+                          sha: Optional[str] = None) -> Dict[str, Any]:
+        """Indeksuje tekst (pomija, jeśli ta treść jest już w indeksie)"""
+        if not self.enabled:
+            return {"indexed": False, "reason": "disabled"}
+        sha = sha or hashlib.sha256(text.encode("utf-8")).hexdigest()
+        snap = self.index.snapshot
+        if sha in snap.docs:
+            if sha in snap.dead and scope != "workspace":
+                # Nagrobki workspace zdejmuje reindex_directory; załącznik z tą treścią - od razu
+                async with self._lock:
+                    if sha in self.index.snapshot.dead:
+                        await run_in_threadpool(self.index.revive, sha, scope)
+            return {"indexed": False, "sha256": sha, "reason": "cached"}
+
+        chunks = chunk_text(text, self.chunk_chars, self.overlap)
+        if not chunks:
+            return {"indexed": False, "sha256": sha, "reason": "empty"}
+        vectors = await self._embed(model, chunks)
+
+        async with self._lock:
+            if sha not in self.index.docs:
+                await run_in_threadpool(self.index.add, sha, source, scope, chunks, vectors)
+        return {"indexed": True, "sha256": sha, "chunks": len(chunks)}
+
+    def _read_text(self, path: str) -> Optional[str]:
+        if os.path.getsize(path) > self.max_doc_bytes:
+            return None
+        with open(path, "rb") as f:
+            data = f.read()
+        if b"\x00" in data[:4096]:
+            return None
+        return data.decode("utf-8", errors="ignore")
+
+    async def ingest_file(self, model, path: str, source: Optional[str] = None, scope: str = "upload",
+                          sha: Optional[str] = None) -> Dict[str, Any]:
+        if not self.enabled or not path.lower().endswith(TEXT_EXTENSIONS):
+            return {"indexed": False, "reason": "skipped"}
+        if sha and sha in self.index.docs and sha not in self.index.snapshot.dead:
+            return {"indexed": False, "sha256": sha, "reason": "cached"}
+        text = await run_in_threadpool(self._read_text, path)
+        if text is None:
+            return {"indexed": False, "reason": "too_large_or_binary"}
+        return await self.ingest_text(model, text, source or os.path.basename(path), scope=scope, sha=sha)
+
+    async def reindex_directory(self, model, directory: str) -> Dict[str, Any]:
+        """
+        Przyrostowo indeksuje pliki tekstowe z katalogu (np. mcp_workspace). Po pełnym
+        przejściu stara treść zmienionych i skasowanych plików dostaje nagrobek.
+        """
+        stats = {"scanned": 0, "indexed": 0, "cached": 0, "skipped": 0}
+        if not self.enabled or not os.path.isdir(directory):
+            return stats
+        present = {}
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                source = os.path.relpath(path, directory)
+                stats["scanned"] += 1
+                result = await self.ingest_file(model, path, source=source, scope="workspace")
+                if result.get("indexed"):
+                    stats["indexed"] += 1
+                elif result.get("reason") == "cached":
+                    stats["cached"] += 1
+                else:
+                    stats["skipped"] += 1
+                if result.get("sha256") and result.get("reason") != "empty":
+                    present[source] = result["sha256"]
+        async with self._lock:
+            stats.update(await run_in_threadpool(self.index.sync_workspace, present))
+        return stats
+
+    def scope_docs(self, attachment_shas: Iterable[str]) -> List[str]:
+        """Dokumenty widoczne dla rozmowy: jej załączniki + aktualna treść workspace (bez nagrobków)"""
+        snap = self.index.snapshot
+        return [sha for sha, d in snap.docs.items() if d.get("scope") == "workspace" and sha not in snap.dead] + \
+               [sha for sha in attachment_shas if sha in snap.docs]
+
+    async def retrieve(self, model, query: str, doc_shas: Iterable[str], estimator=None,
+                       model_name: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Najlepsze fragmenty dla zapytania, łącznie nie więcej niż max_tokens"""
+        doc_shas = list(doc_shas)
+        if not self.enabled or not query or not doc_shas or not self.index.size:
+            return []
+        query_vector = (await model.embed([query], model_name=self.embed_model))[0]
+        # Jedna migawka na wyszukiwanie i odczyt tekstów - compact() może w tym czasie przenumerować wiersze
+        snap = self.index.snapshot
+        hits = self.index.search(query_vector, self.top_k, doc_shas, snapshot=snap)
+
+        results, used = [], 0
+        for score, row in hits:
+            chunk = await run_in_threadpool(self.index.chunk, row, snap)
+            cost = estimator.estimate(chunk["text"], model_name) if estimator else len(chunk["text"]) // 4
+            if used + cost > self.max_tokens:
+                break
+            used += cost
+            results.append({
+                "source": snap.docs[chunk["doc"]]["source"],
+                "score": round(score, 4),
+                "text": chunk["text"]
+            })
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {"enabled": False}
+        snap = self.index.snapshot
+        return {
+            "enabled": True,
+            "embed_model": self.embed_model,
+            "documents": len(snap.docs) - len(snap.dead),
+            "tombstones": len(snap.dead),
+            "chunks": len(snap.offsets),
+            "dim": self.index.dim
+        }
+
+
+def format_retrieved(chunks: List[Dict[str, Any]]) -> str:
+    """Blok z fragmentami dokumentów do promptu (pusty gdy brak)"""
+    if not chunks:
+        return ""
+    return "📚 Fragmenty dokumentów:\n" + "\n\n".join([f"[{c['source']}]\n{c['text']}" for c in chunks])
+
+
+retriever = DocumentRetriever(
+    index_dir=os.getenv("RAG_INDEX_DIR", "rag_index"),
+    embed_model=os.getenv("RAG_EMBED_MODEL", "nomic-embed-text"),
+    chunk_chars=int(os.getenv("RAG_CHUNK_CHARS", 1200)),
+    overlap=int(os.getenv("RAG_CHUNK_OVERLAP", 200)),
+    top_k=int(os.getenv("RAG_TOP_K", 4)),
+    max_tokens=int(os.getenv("RAG_MAX_TOKENS", 800)),
+    max_doc_bytes=int(os.getenv("RAG_MAX_DOC_BYTES", 2 * 1024 * 1024)),
+    enabled=os.getenv("RAG_ENABLED", "1") != "0"
+)
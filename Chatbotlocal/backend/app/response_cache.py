@@ -0,0 +1,173 @@
+"""
+Cache odpowiedzi modelu
+=======================
+
+Te same prompty (np. custom_system_prompt + gotowe pytanie z presetów widgetu)
+nie muszą za każdym razem kosztować pełnej generacji na CPU. Klucz to hash
+znormalizowanego (model, prompt, temperature, top_p, max_tokens).
+
+- pamięć: LRU z TTL i limitem liczby wpisów oraz bajtów,
+- opcjonalnie SQLite (RESPONSE_CACHE_DB) - cache przeżywa restart,
+- używany tylko gdy to bezpieczne: temperature == 0 albo jawne cache=true,
+  bez błędu i bez narzędzi spoza cache_ttl (mcp_registry.replay_ttl) -
+  wpis nie żyje dłużej niż wynik najkrótszego z użytych narzędzi.
+
+Konfiguracja (env): RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL_SECONDS,
+RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_DB.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Usuwa różnice bez znaczenia dla modelu: końce linii i białe znaki na końcach linii"""
+    lines = prompt.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def cache_key(model_name: str, prompt: str, temperature: float, top_p: float, max_tokens: int) -> str:
+    material = json.dumps(
+        [model_name, normalize_prompt(prompt), round(float(temperature), 4), round(float(top_p), 4), int(max_tokens)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL w pamięci, opcjonalnie z trwałą kopią w SQLite"""
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 1000, max_bytes: int = 16 * 1024 * 1024,
+                 db_path: Optional[str] = None, enabled: bool = True):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.db_path = db_path
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value, size)
+        self._bytes = 0
+        self._db_lock = threading.Lock()
+        self._db = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        if enabled and db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def should_use(self, temperature: float, requested: Optional[bool]) -> bool:
+        """Cache tylko dla deterministycznych generacji albo na wyraźne życzenie"""
+        if not self.enabled or requested is False:
+            return False
+        return bool(requested) or temperature == 0
+
+    # ---------- pamięć ----------
+
+    def _remember(self, key: str, value: dict, expires_at: float):
+        size = len(json.dumps(value, ensure_ascii=False).encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[2]
+        self._entries[key] = (expires_at, value, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, _, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    # ---------- SQLite ----------
+
+    def _db_get(self, key: str) -> Optional[tuple]:
+        with self._db_lock:
+            row = self._db.execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _db_put(self, key: str, value: dict, expires_at: float):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at)
+            )
+            # Sprzątanie: przeterminowane wpisy i nadmiar ponad max_entries
+            if self.stores % 100 == 0:
+                self._db.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+                self._db.execute(
+                    "DELETE FROM response_cache WHERE key NOT IN "
+                    "(SELECT key FROM response_cache ORDER BY expires_at DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+            self._db.commit()
+
+    # ---------- API ----------
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] >= time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._bytes -= self._entries.pop(key)[2]
+
+        if self._db is not None:
+            stored = await run_in_threadpool(self._db_get, key)
+            if stored is not None:
+                value, expires_at = stored
+                self._remember(key, value, expires_at)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: dict, ttl: Optional[float] = None):
+        """ttl - krótszy czas życia wpisu (np. TTL wyniku narzędzia, z którego korzysta odpowiedź)"""
+        expires_at = time.time() + (min(self.ttl, ttl) if ttl is not None else self.ttl)
+        self._remember(key, value, expires_at)
+        self.stores += 1
+        if self._db is not None:
+            await run_in_threadpool(self._db_put, key, value, expires_at)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "persistent": self._db is not None,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions
+        }
+
+
+response_cache = ResponseCache(
+    ttl=float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 3600)),
+    max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1000)),
+    max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024)),
+    db_path=os.getenv("RESPONSE_CACHE_DB") or None,
+    enabled=os.getenv("RESPONSE_CACHE_ENABLED", "1") != "0"
+)
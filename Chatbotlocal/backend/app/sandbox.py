@@ -0,0 +1,256 @@
+"""
+Pula procesów piaskownicy dla execute_python
+============================================
+
+Zamiast `python3 -c` przy każdym wywołaniu trzymamy kilka rozgrzanych
+procesów sandbox_worker.py (interpreter + typowe moduły już załadowane).
+Kod trafia do nich przez potok, więc krótki snippet kosztuje milisekundy.
+Każde uruchomienie to osobny fork rozgrzanego procesu (szczegóły blokad
+w sandbox_worker.py), więc stan jednego użytkownika nie przechodzi do
+następnego, a timeout czy limit pamięci kończy tylko to jedno uruchomienie.
+
+- limity (rlimit): pamięć, CPU, otwarte pliki, rozmiar zapisywanych plików,
+- brak sieci (pusta przestrzeń nazw sieci, jeśli możliwa, + zablokowane gniazda),
+- `code_execution_timeout_seconds` i `blocked_imports` z mcp_config.json,
+- proces jest wymieniany po `max_runs_per_worker` uruchomieniach albo gdy
+  przestanie odpowiadać lub padnie.
+
+Tylko POSIX (moduł resource); na Windows execute_python wraca do
+pojedynczego podprocesu.
+"""
+
+import json
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, Any, List, Optional
+
+from config import tools_config, tool_config
+from metrics import log_event
+
+try:
+    import resource  # noqa: F401 - tylko sprawdzenie, czy jesteśmy na POSIX
+    SANDBOX_SUPPORTED = True
+except ImportError:
+    SANDBOX_SUPPORTED = False
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+
+
+class SandboxTimeout(Exception):
+    """Kod wykonywał się dłużej niż timeout"""
+
+
+class SandboxCrashed(Exception):
+    """Proces piaskownicy zakończył się w trakcie wykonania (np. limit pamięci/CPU)"""
+
+
+class SandboxWorker:
+    """Jeden rozgrzany proces sandbox_worker.py"""
+
+    def __init__(self, limits: Dict[str, Any], cwd: str):
+        self.runs = 0
+        self.broken = False
+        self.process = subprocess.Popen(
+            [sys.executable, "-I", WORKER_SCRIPT, json.dumps(limits)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=cwd, close_fds=True, start_new_session=True
+        )
+        self._ready = False
+
+    def _read_line(self, deadline: float) -> bytes:
+        remaining = deadline - time.monotonic()
+        readable = select.select([self.process.stdout], [], [], remaining)[0] if remaining > 0 else []
+        if not readable:
+            self.broken = True
+            raise SandboxTimeout()
+        line = self.process.stdout.readline()
+        if not line:
+            self.broken = True
+            raise SandboxCrashed()
+        return line
+
+    def run(self, code: str, timeout: float) -> Dict[str, str]:
+        # Pierwsze wywołanie czeka też na start procesu (zwykle już gotowy)
+        deadline = time.monotonic() + timeout + 5
+        if not self._ready:
+            self._read_line(deadline)
+            self._ready = True
+
+        # Czas pilnuje sam proces (zabija forka); tu tylko zapas na wypadek, gdyby nie odpowiadał
+        deadline = time.monotonic() + timeout + 2
+        self.runs += 1
+        try:
+            self.process.stdin.write((json.dumps({"code": code, "timeout": timeout}) + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.broken = True
+            raise SandboxCrashed()
+        result = json.loads(self._read_line(deadline))
+        if result.get("timeout"):
+            raise SandboxTimeout()
+        if result.get("crashed"):
+            raise SandboxCrashed()
+        return result
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive():
+            self.process.kill()
+        try:
+            self.process.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            pass
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class SandboxPool:
+    """Rozgrzane procesy piaskownicy wydawane po jednym na wywołanie"""
+
+    def __init__(self, size: int = 2, max_runs: int = 50, timeout: float = 5,
+                 blocked_imports: Optional[List[str]] = None, memory_mb: int = 256,
+                 max_open_files: int = 32, max_file_mb: int = 10, output_limit: int = 10000,
+                 cwd: str = "."):
+        self.size = size
+        self.max_runs = max_runs
+        self.timeout = timeout
+        self.cwd = cwd
+        self.limits = {
+            "blocked_imports": list(blocked_imports or []),
+            "memory_mb": memory_mb,
+            "max_open_files": max_open_files,
+            "max_file_mb": max_file_mb,
+            "output_limit": output_limit,
+            # Twardy limit CPU na całe życie procesu; fork dostaje własny, niższy limit miękki
+            "cpu_seconds": int(timeout * max_runs) + 10
+        }
+        self.enabled = SANDBOX_SUPPORTED and size > 0
+        self._idle: List[SandboxWorker] = []
+        self._count = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.runs = 0
+        self.timeouts = 0
+        self.crashes = 0
+        self.recycled = 0
+
+    def _spawn(self) -> SandboxWorker:
+        os.makedirs(self.cwd, exist_ok=True)
+        return SandboxWorker(self.limits, self.cwd)
+
+    def start(self):
+        """Rozgrzewa `size` procesów (wywoływane przy starcie backendu)"""
+        if not self.enabled:
+            return
+        with self._cond:
+            self._closed = False
+            while self._count < self.size:
+                self._idle.append(self._spawn())
+                self._count += 1
+
+    def _acquire(self) -> SandboxWorker:
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Pula piaskownicy jest zamknięta")
+                if self._idle:
+                    return self._idle.pop()
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                self._cond.wait()
+        try:
+            return self._spawn()
+        except Exception:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, worker: SandboxWorker, healthy: bool):
+        if healthy and worker.runs < self.max_runs and worker.alive():
+            with self._cond:
+                if not self._closed:
+                    self._idle.append(worker)
+                    self._cond.notify()
+                    return
+        worker.kill()
+        replacement = None
+        if not self._closed:
+            self.recycled += 1
+            try:
+                # Od razu rozgrzewamy następcę - kolejne wywołanie go nie czeka
+                replacement = self._spawn()
+            except Exception as e:
+                log_event("sandbox_spawn_failed", "⚠️ Sandbox: nie udało się uruchomić procesu", level="error",
+                          error=str(e))
+        with self._cond:
+            if replacement is not None and not self._closed:
+                self._idle.append(replacement)
+            else:
+                self._count -= 1
+                if replacement is not None:
+                    replacement.kill()
+            self._cond.notify()
+
+    def run(self, code: str, timeout: Optional[float] = None) -> Dict[str, str]:
+        """Wykonuje kod w piaskownicy; rzuca SandboxTimeout / SandboxCrashed"""
+        timeout = timeout or self.timeout
+        worker = self._acquire()
+        self.runs += 1
+        try:
+            return worker.run(code, timeout)
+        except SandboxTimeout:
+            self.timeouts += 1
+            raise
+        except SandboxCrashed:
+            self.crashes += 1
+            raise
+        finally:
+            # Timeout/limit w forku nie psuje rozgrzanego procesu - wymieniamy go tylko, gdy sam nie odpowiada
+            self._release(worker, not worker.broken)
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+            self._cond.notify_all()
+        for worker in idle:
+            worker.kill()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "size": self.size,
+            "idle": len(self._idle),
+            "workers": self._count,
+            "runs": self.runs,
+            "timeouts": self.timeouts,
+            "crashes": self.crashes,
+            "recycled": self.recycled
+        }
+
+
+_cfg = tools_config()
+_python_cfg = tool_config("execute_python")
+sandbox_pool = SandboxPool(
+    size=int(_python_cfg.get("pool_size", 2)),
+    max_runs=int(_python_cfg.get("max_runs_per_worker", 50)),
+    timeout=float(_cfg.get("code_execution_timeout_seconds", 5)),
+    blocked_imports=_python_cfg.get("blocked_imports", ["os", "sys", "subprocess", "socket"]),
+    memory_mb=int(_python_cfg.get("memory_limit_mb", 256)),
+    max_open_files=int(_python_cfg.get("max_open_files", 32)),
+    max_file_mb=int(_python_cfg.get("max_file_size_mb", 10)),
+    cwd=os.getenv("MCP_SAFE_DIR", _cfg.get("safe_directory", "./mcp_workspace"))
+)
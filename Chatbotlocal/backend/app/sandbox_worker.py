@@ -0,0 +1,251 @@
+"""
+Proces roboczy piaskownicy execute_python (uruchamiany przez sandbox.py)
+=======================================================================
+
+Start: python3 -I sandbox_worker.py '<json z limitami>'
+
+Zaraz po starcie proces sam nakłada na siebie limity (pamięć, pliki,
+rozmiar zapisów), odcina sieć i dopiero wtedy czeka na kod. Protokół:
+jedna linia JSON na stdin ({"code", "timeout"}) -> jedna linia JSON na
+stdout ({"stdout", "stderr"} albo {"timeout": true} / {"crashed": true}).
+
+Kod użytkownika nigdy nie wykonuje się w tym procesie - każde uruchomienie
+to świeży fork rozgrzanego rodzica (moduły już załadowane, fork to ~1 ms),
+więc zmiany stanu interpretera (np. math.sqrt = ...) nie przechodzą do
+kolejnych użytkowników. W procesie potomnym przed kodem:
+- limit CPU na to jedno uruchomienie, stdin odcięty,
+- sys.meta_path zaczyna się od BlockedImportFinder, a blokowane moduły
+  (blocked_imports + importlib, ctypes, builtins, ...) wypadają z sys.modules,
+- hook audytu (sys.addaudithook, nie da się go zdjąć z Pythona) odrzuca
+  procesy, sygnały, gniazda, ctypes, operacje na plikach z modułu os
+  i otwieranie plików poza katalogiem piaskownicy (odczyt także z biblioteki
+  standardowej - importy), niezależnie od tego, jak kod dotarł do funkcji.
+"""
+
+import builtins
+import contextlib
+import ctypes
+import io
+import json
+import math
+import os
+import resource
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+# Moduły importowane zawczasu - pierwszy snippet ich nie płaci
+import random, re, datetime, collections, itertools, functools, statistics  # noqa: E401,F401
+
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+
+# Zawsze blokowane - furtki do obejścia blokady importów i do stanu interpretera
+ALWAYS_BLOCKED = {"importlib", "ctypes", "_ctypes", "builtins", "posix", "_posixsubprocess", "subprocess",
+                  "multiprocessing", "_imp", "_frozen_importlib", "_frozen_importlib_external", "signal",
+                  "resource", "socket", "_socket", "pty", "fcntl", "mmap", "shutil"}
+
+# Zdarzenia audytu odrzucane zawsze (prefiksy); os.listdir/os.scandir - patrz _audit_hook
+BLOCKED_EVENTS = ("os.", "subprocess.", "socket.", "ctypes.", "shutil.", "pty.", "fcntl.", "mmap.", "signal.",
+                  "resource.", "winreg.", "webbrowser.", "urllib.", "http.", "ftplib.", "smtplib.", "telnetlib.",
+                  "sys.addaudithook")
+WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_APPEND | os.O_TRUNC
+
+
+def limit_resources(cfg: dict):
+    mb = 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (cfg["memory_mb"] * mb, cfg["memory_mb"] * mb))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (cfg["max_file_mb"] * mb, cfg["max_file_mb"] * mb))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (cfg["max_open_files"], cfg["max_open_files"]))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    # Twardy limit CPU dziedziczony przez procesy potomne; limit per uruchomienie w _child()
+    resource.setrlimit(resource.RLIMIT_CPU, (cfg["cpu_seconds"], cfg["cpu_seconds"]))
+
+
+def disable_network():
+    # Najpierw pusta przestrzeń nazw sieci (jeśli jądro/uprawnienia pozwalają)...
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.unshare(CLONE_NEWNET) != 0:
+            libc.unshare(CLONE_NEWUSER | CLONE_NEWNET)
+    except Exception:
+        pass
+
+    # ...a niezależnie od tego gniazda w Pythonie
+    def blocked(*args, **kwargs):
+        raise OSError("Sieć jest niedostępna w piaskownicy")
+
+    class BlockedSocket(socket.socket):
+        # Klasa, nie funkcja - biblioteki (np. ssl) po niej dziedziczą
+        def __init__(self, *args, **kwargs):
+            blocked()
+
+    socket.socket = BlockedSocket
+    socket.create_connection = blocked
+    socket.getaddrinfo = blocked
+    socket.socketpair = blocked
+
+
+def _top(name) -> str:
+    return str(name).split(".")[0]
+
+
+def guarded_builtins(blocked_imports: set) -> dict:
+    """Builtins kodu użytkownika - __import__ odrzuca blokowane moduły także z cache sys.modules"""
+    real_import = builtins.__import__
+
+    def guarded_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if _top(name) in blocked_imports:
+            raise ImportError(f"Import '{name}' jest zablokowany w piaskownicy")
+        return real_import(name, globals, locals, fromlist, level)
+
+    safe = dict(vars(builtins))
+    safe["__import__"] = guarded_import
+    return safe
+
+
+class BlockedImportFinder:
+    """Pierwszy finder w sys.meta_path - odrzuca blokowane moduły przy każdym imporcie spoza cache"""
+
+    def __init__(self, blocked: set):
+        self.blocked = blocked
+
+    def find_spec(self, name, path=None, target=None):
+        if _top(name) in self.blocked:
+            raise ImportError(f"Import '{name}' jest zablokowany w piaskownicy")
+        return None
+
+
+def _audit_hook(blocked: set, sandbox_dir: str, read_roots: tuple):
+    def inside(path, roots) -> bool:
+        real = os.path.realpath(path)
+        return any(real == root or real.startswith(root + os.sep) for root in roots)
+
+    def hook(event, args):
+        if event == "open":
+            path, mode, flags = args
+            if not isinstance(path, (str, bytes, os.PathLike)):
+                raise PermissionError("Otwieranie deskryptorów jest zablokowane w piaskownicy")
+            path = os.fsdecode(path)
+            writing = any(c in (mode or "") for c in "wax+") or bool((flags or 0) & WRITE_FLAGS)
+            if inside(path, (sandbox_dir,)) or (not writing and inside(path, read_roots)):
+                return
+            raise PermissionError(f"Dostęp do '{path}' jest zablokowany w piaskownicy")
+        if event in ("os.listdir", "os.scandir"):
+            # Importy przeszukują sys.path - listowanie tylko tam i w katalogu piaskownicy
+            path = os.fsdecode(args[0]) if args and args[0] is not None else "."
+            if inside(path, (sandbox_dir,) + read_roots):
+                return
+            raise PermissionError(f"Dostęp do '{path}' jest zablokowany w piaskownicy")
+        if event == "import" and _top(args[0]) in blocked:
+            raise ImportError(f"Import '{args[0]}' jest zablokowany w piaskownicy")
+        if event.startswith(BLOCKED_EVENTS):
+            raise PermissionError(f"Operacja '{event}' jest zablokowana w piaskownicy")
+
+    return hook
+
+
+def run(code: str, safe_builtins: dict, output_limit: int) -> dict:
+    stdout, stderr = io.StringIO(), io.StringIO()
+    scope = {"__builtins__": safe_builtins, "__name__": "__main__"}
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            exec(compile(code, "<string>", "exec"), scope)
+        except SystemExit:
+            pass
+        except BaseException as e:
+            # Bez ramki samego run() - tylko to, co dotyczy kodu użytkownika
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    return {"stdout": stdout.getvalue()[:output_limit], "stderr": stderr.getvalue()[:output_limit]}
+
+
+def _child(code: str, timeout: float, cfg: dict, result_fd: int, channel_fd: int):
+    """Proces potomny: odcięcie od kanału protokołu, limity i blokady, kod, wynik do potoku"""
+    os.close(channel_fd)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (min(math.ceil(timeout) + 1, hard), hard))
+
+    blocked = set(cfg["blocked_imports"]) | ALWAYS_BLOCKED
+    safe_builtins = guarded_builtins(blocked)
+    for name in [n for n in sys.modules if _top(n) in blocked - {"builtins", "sys", "os", "posix"}]:
+        del sys.modules[name]
+    sys.meta_path.insert(0, BlockedImportFinder(blocked))
+    read_roots = tuple(sorted({os.path.realpath(p) for p in (sys.prefix, sys.base_prefix, sys.exec_prefix)
+                               + tuple(p for p in sys.path if p)}))
+    sys.addaudithook(_audit_hook(blocked, os.path.realpath(os.getcwd()), read_roots))
+
+    payload = json.dumps(run(code, safe_builtins, cfg["output_limit"]), ensure_ascii=False).encode("utf-8")
+    view = memoryview(payload)
+    while view:
+        view = view[os.write(result_fd, view):]
+
+
+def run_isolated(code: str, timeout: float, cfg: dict, channel_fd: int) -> dict:
+    """Wykonuje kod w świeżym forku; rodzic pilnuje czasu i zabija dziecko po timeoucie"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            _child(code, timeout, cfg, write_fd, channel_fd)
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    deadline = time.monotonic() + timeout
+    chunks, timed_out = [], False
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            readable = select.select([read_fd], [], [], remaining)[0] if remaining > 0 else []
+            if not readable:
+                timed_out = True
+                break
+            data = os.read(read_fd, 65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        os.close(read_fd)
+        if timed_out:
+            os.kill(pid, signal.SIGKILL)
+        _, status = os.waitpid(pid, 0)
+
+    if timed_out:
+        return {"timeout": True}
+    try:
+        return json.loads(b"".join(chunks))
+    except ValueError:
+        # Dziecko padło przed wysłaniem wyniku (limit pamięci/CPU, sygnał)
+        return {"crashed": True, "status": status}
+
+
+def main():
+    cfg = json.loads(sys.argv[1])
+    # Kanał protokołu na osobnym deskryptorze; fd 1 i 2 kodu użytkownika idą do /dev/null
+    channel = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.close(devnull)
+
+    disable_network()
+    limit_resources(cfg)
+
+    channel.write(json.dumps({"ready": True}) + "\n")
+    channel.flush()
+    for line in sys.stdin:
+        request = json.loads(line)
+        result = run_isolated(request["code"], request["timeout"], cfg, channel.fileno())
+        channel.write(json.dumps(result, ensure_ascii=False) + "\n")
+        channel.flush()
+
+
+if __name__ == "__main__":
+    main()
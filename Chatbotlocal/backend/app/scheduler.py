@@ -0,0 +1,177 @@
+"""
+Scheduler generacji - kontrola przyjęć przed LocalModel
+========================================================
+
+Ollama na CPU sensownie obsługuje tylko kilka generacji naraz. Scheduler:
+- przepuszcza maksymalnie `max_concurrency` generacji jednocześnie,
+- resztę trzyma w ograniczonej kolejce priorytetowej (FIFO w ramach priorytetu),
+- gdy kolejka jest pełna, od razu odrzuca żądanie (HTTP 429 + Retry-After),
+- gdy żądanie czeka dłużej niż `max_wait`, odrzuca je (HTTP 503 + Retry-After),
+- zbiera metryki: głębokość kolejki, czasy oczekiwania i obsługi.
+
+Konfiguracja (env): GEN_MAX_CONCURRENCY, GEN_MAX_QUEUE, GEN_MAX_WAIT_SECONDS.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any
+
+
+class SchedulerRejected(Exception):
+    """Żądanie nie zostało przyjęte do generacji"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class SlotLease:
+    """
+    Zajęty slot przekazywany dalej (np. do generatora SSE). release() działa
+    tylko raz, więc można go wołać z kilku miejsc - z finally generatora i z
+    BackgroundTask odpowiedzi, gdy klient rozłączy się przed startem strumienia.
+    """
+
+    def __init__(self, scheduler: "GenerationScheduler", started: float):
+        self.scheduler = scheduler
+        self.started = started
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release(time.perf_counter() - self.started)
+
+
+class GenerationScheduler:
+    """Ogranicza równoległe generacje i kolejkuje nadmiarowe żądania"""
+
+    def __init__(self, max_concurrency: int = 2, max_queue: int = 16, max_wait: float = 30.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+
+        self._active = 0
+        self._waiters = []  # heap: (priority, seq, future)
+        self._seq = itertools.count()
+
+        # Metryki
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_total = 0.0
+        self._service_ewma = None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    def estimate_wait(self, position: int = None) -> float:
+        """Szacowany czas oczekiwania (s) dla żądania na pozycji `position` w kolejce"""
+        if position is None:
+            position = self.queue_depth
+        service = self._service_ewma or 5.0
+        return service * (position + 1) / self.max_concurrency
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self.estimate_wait()))
+
+    async def acquire(self, priority: int = 0) -> float:
+        """
+        Czeka na wolny slot generacji. Zwraca czas oczekiwania w sekundach.
+        Mniejszy `priority` = wcześniej obsłużony.
+        """
+        started = time.perf_counter()
+
+        if self._active < self.max_concurrency and not self.queue_depth:
+            self._active += 1
+            self._record_admit(0.0)
+            return 0.0
+
+        if self.queue_depth >= self.max_queue:
+            self.rejected_full += 1
+            raise SchedulerRejected(429, "Kolejka generacji jest pełna - spróbuj ponownie później", self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Slot przyszedł w ostatniej chwili - oddaj go dalej
+                self.release(0.0, count=False)
+            future.cancel()
+            self.rejected_timeout += 1
+            raise SchedulerRejected(503, "Przekroczono czas oczekiwania w kolejce generacji", self._retry_after())
+        except asyncio.CancelledError:
+            # Klient się rozłączył - nie blokuj slotu
+            if future.done() and not future.cancelled():
+                self.release(0.0, count=False)
+            future.cancel()
+            raise
+
+        waited = time.perf_counter() - started
+        self._record_admit(waited)
+        return waited
+
+    def release(self, service_time: float, count: bool = True):
+        """Zwalnia slot; jeśli ktoś czeka, slot przechodzi bezpośrednio na niego"""
+        if count:
+            self.completed += 1
+            self.service_total += service_time
+            self._service_ewma = service_time if self._service_ewma is None else 0.8 * self._service_ewma + 0.2 * service_time
+
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(True)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0):
+        """Context manager: `async with scheduler.slot(): await model.generate(...)`"""
+        await self.acquire(priority)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - started)
+
+    def _record_admit(self, waited: float):
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "completed": self.completed,
+            "rejected_queue_full": self.rejected_full,
+            "rejected_wait_timeout": self.rejected_timeout,
+            "wait_avg_seconds": round(self.wait_total / self.admitted, 4) if self.admitted else 0.0,
+            "wait_max_seconds": round(self.wait_max, 4),
+            "service_avg_seconds": round(self.service_total / self.completed, 4) if self.completed else 0.0,
+            "estimated_wait_seconds": round(self.estimate_wait(), 2)
+        }
+
+
+scheduler = GenerationScheduler(
+    max_concurrency=int(os.getenv("GEN_MAX_CONCURRENCY", 2)),
+    max_queue=int(os.getenv("GEN_MAX_QUEUE", 16)),
+    max_wait=float(os.getenv("GEN_MAX_WAIT_SECONDS", 30))
+)
@@ -0,0 +1,186 @@
+"""
+Start backendu w tle i sondy liveness / readiness
+=================================================
+
+Import main.py nie łączy się z Ollama ani nie migruje bazy - proces od razu
+przyjmuje połączenia, a inicjalizacja idzie w tle (lifespan FastAPI; z punktem
+wejścia asgi:app w tle idzie też sam import main.py - patrz asgi.py):
+
+1. baza - create_all + migracje (init_db) w wątku,
+2. Ollama - /api/tags i wybór domyślnego modelu (ModelPool.discover),
+3. rozgrzanie - model ładowany do pamięci Ollama (STARTUP_WARMUP=1),
+4. indeks RAG (numpy + memmap) i przyrostowe odświeżenie indeksu plików
+   (search_workspace) - poza sondą, żeby pierwsze żądanie nie płaciło.
+
+Każdy krok ponawiany z rosnącą przerwą (STARTUP_RETRY_SECONDS, podwajana do
+STARTUP_RETRY_MAX_SECONDS), więc backend wystartowany przed Ollama sam dojdzie
+do gotowości. /api/health/live - proces żyje; /api/health/ready - 200 dopiero,
+gdy baza jest zmigrowana, Ollama odpowiada i model jest rozgrzany (503 do tego
+czasu - load balancer nie kieruje ruchu do repliki, która nie obsłuży żądania).
+"""
+
+import asyncio
+import os
+import time
+from typing import Dict, Any, Optional
+
+from db import init_db
+from metrics import log_event
+from rag import retriever
+from workspace_index import workspace_index
+
+
+class Startup:
+    """Inicjalizacja w tle z ponawianiem + stan dla sondy readiness"""
+
+    def __init__(self, pool, retry_seconds: float = 1, retry_max_seconds: float = 30, warmup: bool = True,
+                 warmup_timeout: float = 300, database_wait: float = 10):
+        self.pool = pool
+        self.retry_seconds = retry_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.warmup = warmup
+        self.warmup_timeout = warmup_timeout
+        self.database_wait = database_wait
+
+        self.database_ready = False
+        self.model_ready = False
+        self.attempts: Dict[str, int] = {"database": 0, "model": 0}
+        self.errors: Dict[str, str] = {}
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        self._database_event: Optional[asyncio.Event] = None
+        self._tasks: list = []
+
+    # ---------- uruchamianie ----------
+
+    async def _retry(self, name: str, step):
+        """Wykonuje krok aż do skutku, z przerwą podwajaną do retry_max_seconds"""
+        delay = self.retry_seconds
+        while True:
+            self.attempts[name] += 1
+            try:
+                await step()
+                self.errors.pop(name, None)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors[name] = str(e) or type(e).__name__
+                log_event("startup_retry", f"⚠️ Start: {name} niegotowe, ponowię za {delay:g} s", level="warning",
+                          step=name, attempt=self.attempts[name], error=self.errors[name])
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_max_seconds)
+
+    async def _database(self):
+        async def migrate():
+            await asyncio.to_thread(init_db)
+
+        await self._retry("database", migrate)
+        self.database_ready = True
+        self._database_event.set()
+        log_event("startup_database", "✅ Baza danych zmigrowana")
+        self._check_ready()
+
+        if retriever.enabled:
+            # Indeks RAG (import numpy, memmap wektorów) - nie blokuje gotowości
+            try:
+                await asyncio.to_thread(lambda: retriever.index)
+            except Exception as e:
+                log_event("startup_rag", "⚠️ Indeks RAG nie wczytał się", level="warning", error=str(e))
+        if workspace_index.enabled:
+            try:
+                await asyncio.to_thread(workspace_index.refresh)
+            except Exception as e:
+                log_event("startup_workspace_index", "⚠️ Indeks plików nie odświeżył się", level="warning",
+                          error=str(e))
+
+    async def _model(self):
+        # Klient httpx (import httpcore, kontekst SSL - ~0.2 s) tworzony w wątku,
+        # żeby nie blokować pętli zdarzeń zaraz po starcie serwera
+        await asyncio.to_thread(lambda: self.pool.default.client)
+
+        async def discover_and_warm():
+            name = await self.pool.discover()
+            if self.warmup:
+                started = time.perf_counter()
+                result = await self.pool.default.warmup(timeout=self.warmup_timeout)
+                log_event("startup_warmup", f"🔥 Model {name} rozgrzany", model=name,
+                          seconds=round(time.perf_counter() - started, 3),
+                          load_ms=round((result.get("load_duration") or 0) / 1e6, 1))
+
+        await self._retry("model", discover_and_warm)
+        self.model_ready = True
+        log_event("startup_ollama", "✅ Ollama połączona", model=self.pool.default.model_name,
+                  available=self.pool.available)
+        self._check_ready()
+
+    def _check_ready(self):
+        if self.ready_at is None and self.ready:
+            self.ready_at = time.time()
+            log_event("startup_ready", "✅ Backend gotowy!", seconds=round(self.ready_at - self.started_at, 3))
+
+    def start(self):
+        if not self._tasks:
+            self.started_at = time.time()
+            self._database_event = asyncio.Event()
+            self._tasks = [asyncio.create_task(self._database()), asyncio.create_task(self._model())]
+
+    async def stop(self):
+        workspace_index.cancel()
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    # ---------- stan ----------
+
+    async def wait_database(self) -> bool:
+        """Czeka (max database_wait s) na migrację - żądania z pierwszych chwil po starcie"""
+        if self.database_ready:
+            return True
+        if self._database_event is None:
+            return False
+        try:
+            await asyncio.wait_for(self._database_event.wait(), self.database_wait)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    @property
+    def checks(self) -> Dict[str, bool]:
+        return {
+            "database": self.database_ready,
+            "ollama": bool(self.pool.reachable),
+            "model": self.model_ready
+        }
+
+    @property
+    def ready(self) -> bool:
+        return all(self.checks.values())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "checks": self.checks,
+            "model": self.pool.default.model_name,
+            "warmup": self.warmup,
+            "attempts": self.attempts,
+            "errors": self.errors,
+            "startup_seconds": round(self.ready_at - self.started_at, 3) if self.ready_at else None,
+            "uptime_seconds": round(time.time() - self.started_at, 1)
+        }
+
+
+def create_startup(pool) -> Startup:
+    return Startup(
+        pool,
+        retry_seconds=float(os.getenv("STARTUP_RETRY_SECONDS", 1)),
+        retry_max_seconds=float(os.getenv("STARTUP_RETRY_MAX_SECONDS", 30)),
+        warmup=os.getenv("STARTUP_WARMUP", "1") != "0",
+        warmup_timeout=float(os.getenv("STARTUP_WARMUP_TIMEOUT_SECONDS", 300)),
+        database_wait=float(os.getenv("STARTUP_DB_WAIT_SECONDS", 10))
+    )
@@ -0,0 +1,134 @@
+"""
+Budżet tokenów dla historii rozmowy
+===================================
+
+Prompt nie może rosnąć bez końca - okno kontekstu modelu (OLLAMA_NUM_CTX)
+musi pomieścić system prompt, załączniki, historię i odpowiedź (max_tokens).
+HistoryBudget:
+- szacuje liczbę tokenów (lokalna aproksymacja znaki/token, kalibrowana per
+  model na podstawie tokenów "context" zwracanych przez Ollama),
+- zostawia system prompt i najnowsze tury,
+- starsze tury składa do streszczenia zapisywanego przy Conversation
+  (przyrostowo - każda wiadomość trafia do streszczenia tylko raz).
+
+Tryb streszczeń (HISTORY_SUMMARY_MODE):
+- "extractive" (domyślny) - pierwsze zdanie każdej wiadomości, bez wywołania modelu,
+- "model" - streszczenie generowane przez LocalModel.
+"""
+
+import math
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+
+class TokenEstimator:
+    """Szacuje liczbę tokenów tekstu; współczynnik znaków/token uczony per model"""
+
+    def __init__(self, chars_per_token: float = 3.5):
+        self.default_ratio = chars_per_token
+        self._ratios: Dict[str, float] = {}
+
+    def ratio(self, model_name: Optional[str] = None) -> float:
+        return self._ratios.get(model_name, self.default_ratio)
+
+    def estimate(self, text: str, model_name: Optional[str] = None) -> int:
+        if not text:
+            return 0
+        return math.ceil(len(text) / self.ratio(model_name))
+
+    def observe(self, model_name: str, chars: int, tokens: int):
+        """Kalibracja: `chars` znaków promptu dało `tokens` tokenów w Ollama"""
+        if chars < 200 or not tokens or tokens <= 0:
+            return
+        measured = chars / tokens
+        current = self._ratios.get(model_name)
+        self._ratios[model_name] = measured if current is None else 0.8 * current + 0.2 * measured
+
+
+def _first_sentence(text: str, limit: int = 160) -> str:
+    text = " ".join((text or "").split())
+    match = re.match(r"(.+?[.!?])(\s|$)", text)
+    sentence = match.group(1) if match else text
+    return sentence if len(sentence) <= limit else sentence[:limit - 1] + "…"
+
+
+class HistoryBudget:
+    """Dopasowuje historię rozmowy do okna kontekstu modelu"""
+
+    def __init__(self, estimator: TokenEstimator, num_ctx: int = 4096, reserve_tokens: int = 64,
+                 summary_max_tokens: int = 400, summary_mode: str = "extractive"):
+        self.estimator = estimator
+        self.num_ctx = num_ctx
+        self.reserve_tokens = reserve_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_mode = summary_mode
+
+    def prompt_budget(self, max_tokens: int) -> int:
+        """Ile tokenów może mieć prompt, żeby zmieściła się odpowiedź"""
+        return max(256, self.num_ctx - max_tokens - self.reserve_tokens)
+
+    def fits_context(self, context_tokens: int, new_text: str, max_tokens: int, model_name: str) -> bool:
+        """Czy kontynuacja z zapisanym context Ollama mieści się w oknie"""
+        return context_tokens + self.estimator.estimate(new_text, model_name) <= self.prompt_budget(max_tokens)
+
+    def fit(self, fixed_text: str, summary: str, history: List[dict], max_tokens: int,
+            model_name: str) -> Tuple[List[dict], List[dict]]:
+        """
+        Dzieli historię na (folded, kept): najstarsze tury do streszczenia
+        i najnowsze, które mieszczą się w budżecie razem z `fixed_text`
+        (system prompt + załączniki) i streszczeniem. Ostatnia wiadomość
+        zostaje zawsze.
+        """
+        budget = self.prompt_budget(max_tokens)
+        used = self.estimator.estimate(fixed_text, model_name)
+        # Miejsce na streszczenie rezerwujemy tylko gdy jest/będzie potrzebne
+        summary_cost = min(self.summary_max_tokens, self.estimator.estimate(summary, model_name))
+
+        costs = [self.estimator.estimate(f"{m['role']}: {m['text']}", model_name) + 1 for m in history]
+        if used + summary_cost + sum(costs) <= budget:
+            return [], history
+
+        available = budget - used - self.summary_max_tokens
+        kept_from = len(history) - 1
+        total = costs[-1] if costs else 0
+        while kept_from > 0 and total + costs[kept_from - 1] <= available:
+            kept_from -= 1
+            total += costs[kept_from]
+        return history[:kept_from], history[kept_from:]
+
+    def _trim_summary(self, lines: List[str], model_name: str) -> str:
+        # Streszczenie też ma limit - najstarsze linie wypadają pierwsze
+        while len(lines) > 1 and self.estimator.estimate("\n".join(lines), model_name) > self.summary_max_tokens:
+            lines.pop(0)
+        return "\n".join(lines)
+
+    async def summarize(self, summary: str, folded: List[dict], model_name: str, model=None) -> str:
+        """Dokłada `folded` do istniejącego streszczenia (przyrostowo)"""
+        if not folded:
+            return summary or ""
+
+        if self.summary_mode == "model" and model is not None:
+            transcript = "\n".join([f"{m['role']}: {m['text']}" for m in folded])
+            prompt = (
+                "Streść zwięźle (maks. kilka zdań, po polsku) rozmowę, zachowując fakty, "
+                "decyzje i otwarte pytania.\n\n"
+                f"Dotychczasowe streszczenie:\n{summary or '(brak)'}\n\nNowy fragment:\n{transcript}\n\nStreszczenie:"
+            )
+            result = await model.generate_full(prompt, max_tokens=self.summary_max_tokens, temperature=0.2)
+            if not result.get("error"):
+                return self._trim_summary([result["response"].strip()], model_name)
+
+        lines = summary.split("\n") if summary else []
+        lines += [f"{m['role']}: {_first_sentence(m['text'])}" for m in folded]
+        return self._trim_summary(lines, model_name)
+
+
+token_estimator = TokenEstimator(chars_per_token=float(os.getenv("TOKEN_CHARS_PER_TOKEN", 3.5)))
+history_budget = HistoryBudget(
+    token_estimator,
+    num_ctx=int(os.getenv("OLLAMA_NUM_CTX", 4096)),
+    reserve_tokens=int(os.getenv("HISTORY_RESERVE_TOKENS", 64)),
+    summary_max_tokens=int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", 400)),
+    summary_mode=os.getenv("HISTORY_SUMMARY_MODE", "extractive")
+)
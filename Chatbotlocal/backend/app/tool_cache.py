@@ -0,0 +1,88 @@
+"""
+Cache wyników narzędzi MCP
+==========================
+
+Dla narzędzi idempotentnych (web_search, calculator, system_info, read_file)
+ten sam zestaw argumentów daje ten sam wynik - nie ma sensu płacić za niego
+ponownie, zwłaszcza za zapytanie do wyszukiwarki.
+
+- LRU z TTL per narzędzie (cache_ttl_seconds w mcp_config.json),
+- łączenie identycznych wywołań w locie: drugi użytkownik z tym samym
+  zapytaniem czeka na wynik pierwszego zamiast wysyłać własne,
+- wyniki z błędem ("❌ ...") nie są zapamiętywane.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Awaitable, Callable, Hashable
+
+
+class ToolResultCache:
+    """LRU + TTL z łączeniem równoległych wywołań o tym samym kluczu"""
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key: Hashable, value: str, ttl: float):
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_run(self, key: Hashable, ttl: float, runner: Callable[[], Awaitable[str]]) -> str:
+        cached = self._get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._run(key, ttl, runner))
+            self._inflight[key] = task
+        # shield - rozłączenie jednego klienta nie przerywa wywołania, na które czekają inni
+        return await asyncio.shield(task)
+
+    async def _run(self, key: Hashable, ttl: float, runner: Callable[[], Awaitable[str]]) -> str:
+        try:
+            result = await runner()
+            if not str(result).startswith("❌"):
+                self._put(key, result, ttl)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions
+        }
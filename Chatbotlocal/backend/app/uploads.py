@@ -0,0 +1,171 @@
+"""
+Przesyłanie plików - magazyn adresowany treścią
+===============================================
+
+Pliki z /api/chat są zapisywane jako uploads/<sha256[:2]>/<sha256><ext>:
+- kopiowanie idzie fragmentami (CHUNK_SIZE), a operacje dyskowe poza pętlą zdarzeń,
+- limit `max_file_size_mb` z mcp_config.json jest sprawdzany w trakcie kopiowania,
+- podgląd tekstu dla modelu powstaje w tym samym przebiegu (bez ponownego czytania),
+- małe pliki (do SPOOL_SIZE) trzymane są w pamięci, dopóki nie znamy hasha -
+  ponowne przesłanie tego samego pliku w ogóle nie dotyka dysku,
+- ta sama treść pod różnymi nazwami = jeden plik na dysku.
+"""
+
+import hashlib
+import io
+import os
+import re
+import tempfile
+from typing import Dict, Any, Set
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from config import tools_config
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Plik przekracza max_file_size_mb"""
+
+
+class UploadStore:
+    """Zapisuje przesłane pliki pod nazwą z hasha treści (deduplikacja)"""
+
+    def __init__(self, root: str = "uploads", max_file_size: int = 10 * 1024 * 1024,
+                 spool_size: int = 1024 * 1024, preview_bytes: int = 10000, text_extensions=None):
+        self.root = root
+        self.max_file_size = max_file_size
+        self.spool_size = spool_size
+        self.preview_bytes = preview_bytes
+        self.text_extensions = tuple(text_extensions or (".txt", ".py", ".js", ".md", ".json"))
+        self._known: Set[str] = set()  # ścieżki, o których wiemy, że istnieją
+
+    def path_for(self, digest: str, filename: str) -> str:
+        ext = os.path.splitext(filename or "")[1].lower()
+        if not re.fullmatch(r"\.[a-z0-9]{1,10}", ext):
+            ext = ""
+        return os.path.join(self.root, digest[:2], digest + ext)
+
+    def _exists(self, path: str) -> bool:
+        if path in self._known:
+            return True
+        if os.path.exists(path):
+            self._known.add(path)
+            return True
+        return False
+
+    def forget(self, path: str):
+        """Plik usunięty z dysku (konserwacja) - nie uznawaj go dalej za istniejący"""
+        self._known.discard(path)
+
+    def _open_spill(self, buffer: io.BytesIO):
+        """Plik przekroczył SPOOL_SIZE - przenieś bufor do pliku tymczasowego w katalogu docelowym"""
+        tmp_dir = os.path.join(self.root, ".tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        spill = tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+        spill.write(buffer.getvalue())
+        return spill
+
+    def _commit_buffer(self, data: bytes, dest: str):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = dest + ".part"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dest)
+
+    def _commit_spill(self, spill, dest: str):
+        spill.close()
+        if os.path.exists(dest):
+            os.unlink(spill.name)
+            return
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(spill.name, dest)
+
+    def _discard_spill(self, spill):
+        spill.close()
+        try:
+            os.unlink(spill.name)
+        except FileNotFoundError:
+            pass
+
+    def _preview(self, head: bytes, filename: str) -> str:
+        if not (filename or "").lower().endswith(self.text_extensions):
+            return ""
+        # errors="ignore" - ucięty w połowie znak UTF-8 na końcu fragmentu
+        text = head.decode("utf-8", errors="ignore")
+        if "\x00" in text:
+            return "[nie można odczytać pliku]"
+        return text
+
+    async def save(self, upload: UploadFile) -> Dict[str, Any]:
+        """
+        Zapisuje plik i zwraca {"name", "sha256", "path", "size", "content", "deduplicated"}.
+        Rzuca UploadTooLarge, gdy plik przekracza limit (nic nie zostaje na dysku).
+        """
+        hasher = hashlib.sha256()
+        buffer = io.BytesIO()
+        spill = None
+        head = b""
+        size = 0
+
+        try:
+            while True:
+                chunk = await upload.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > self.max_file_size:
+                    raise UploadTooLarge(
+                        f"Plik '{upload.filename}' przekracza limit {self.max_file_size // (1024 * 1024)} MB"
+                    )
+                hasher.update(chunk)
+                if len(head) < self.preview_bytes:
+                    head += chunk[:self.preview_bytes - len(head)]
+
+                if spill is not None:
+                    await run_in_threadpool(spill.write, chunk)
+                else:
+                    buffer.write(chunk)
+                    if buffer.tell() > self.spool_size:
+                        spill = await run_in_threadpool(self._open_spill, buffer)
+                        buffer = io.BytesIO()
+        except BaseException:
+            if spill is not None:
+                await run_in_threadpool(self._discard_spill, spill)
+            raise
+
+        digest = hasher.hexdigest()
+        dest = self.path_for(digest, upload.filename)
+        deduplicated = self._exists(dest)
+        if spill is not None:
+            if deduplicated:
+                await run_in_threadpool(self._discard_spill, spill)
+            else:
+                await run_in_threadpool(self._commit_spill, spill, dest)
+        elif not deduplicated:
+            await run_in_threadpool(self._commit_buffer, buffer.getvalue(), dest)
+        if deduplicated:
+            # Świeży mtime - sprzątanie osieroconych plików nie usunie go, zanim
+            # zapisze się wiersz attachments
+            await run_in_threadpool(os.utime, dest)
+        self._known.add(dest)
+
+        return {
+            "name": upload.filename,
+            "sha256": digest,
+            "path": dest,
+            "size": size,
+            "content": self._preview(head, upload.filename),
+            "deduplicated": deduplicated
+        }
+
+
+_cfg = tools_config()
+upload_store = UploadStore(
+    root=os.getenv("UPLOAD_DIR", "uploads"),
+    max_file_size=int(_cfg.get("max_file_size_mb", 10)) * 1024 * 1024,
+    spool_size=int(os.getenv("UPLOAD_SPOOL_BYTES", 1024 * 1024)),
+    text_extensions=_cfg.get("allowed_file_extensions")
+)
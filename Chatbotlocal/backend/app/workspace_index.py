@@ -0,0 +1,362 @@
+"""
+Indeks wyszukiwania w plikach workspace (narzędzie search_workspace)
+====================================================================
+
+Pliki tekstowe z katalogów z mcp_config.json ("search_workspace" -> "roots",
+domyślnie mcp_workspace, data, uploads) są dzielone na fragmenty po
+chunk_bytes (całe linie) i trafiają do odwróconego indeksu SQLite FTS5:
+
+    workspace_index.db
+        files          - ścieżka, mtime_ns, rozmiar (klucz przyrostowej aktualizacji)
+        chunks         - plik, numer pierwszej linii, offset i długość w bajtach
+        workspace_fts  - FTS5 bez treści (content='') - same listy wystąpień słów
+
+Tekst nie jest kopiowany do bazy ani trzymany w pamięci: plik czytany jest
+strumieniowo przy indeksowaniu, a fragment do podglądu wyniku - zakresem
+bajtów z dysku (read_range, mmap dla dużych plików). Dzięki temu można
+przeszukiwać gigabajty plików kosztem rozmiaru indeksu, nie RAM.
+
+Aktualizacja jest przyrostowa: przejście os.scandir porównuje (mtime_ns,
+rozmiar) z tabelą files i indeksuje tylko nowe i zmienione pliki (najdłużej
+refresh_budget s na jedno wyszukiwanie - reszta przy kolejnym). FTS5 bez
+treści nie pozwala usuwać wierszy, więc fragmenty zmienionych plików
+zostają w indeksie jako martwe (brak wiersza w chunks - JOIN je pomija);
+gdy martwych jest więcej niż żywych, indeks jest przebudowywany.
+"""
+
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, Any, List, Optional, Tuple
+
+from config import tool_config, tools_config, parse_size
+from history import fts_query
+from metrics import log_event
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS files ("
+    "id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, mtime_ns INTEGER, size INTEGER, chunks INTEGER)",
+    "CREATE TABLE IF NOT EXISTS chunks ("
+    "id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, line INTEGER NOT NULL, "
+    "offset INTEGER NOT NULL, length INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_chunks_file ON chunks (file_id)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS workspace_fts USING fts5("
+    "text, content='', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+)
+SNIPPET_CHARS = 200
+
+
+def read_range(path: str, offset: int, length: int, mmap_threshold: int = 1024 * 1024) -> Tuple[bytes, int]:
+    """
+    Bajty [offset, offset+length) pliku i jego rozmiar. Pliki od mmap_threshold
+    czytane przez mmap (system doczytuje tylko potrzebne strony), mniejsze - seek+read.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        offset = max(0, min(offset, size))
+        end = min(size, offset + max(0, length))
+        if end <= offset:
+            return b"", size
+        if size >= mmap_threshold:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[offset:end], size
+        f.seek(offset)
+        return f.read(end - offset), size
+
+
+def _fold(text: str) -> str:
+    """Małe litery bez znaków diakrytycznych - jak tokenizer unicode61 remove_diacritics"""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+class WorkspaceIndex:
+    """Przyrostowy indeks FTS5 plików tekstowych; tekst zostaje na dysku"""
+
+    def __init__(self, db_path: str, roots: List[str], extensions=None, chunk_bytes: int = 4096,
+                 max_file_size: int = 512 * 1024 * 1024, refresh_interval: float = 30,
+                 refresh_budget: float = 5, mmap_threshold: int = 1024 * 1024, enabled: bool = True):
+        self.db_path = db_path
+        self.roots = roots
+        self.extensions = tuple(e.lower() for e in extensions) if extensions else None
+        self.chunk_bytes = chunk_bytes
+        self.max_file_size = max_file_size
+        self.refresh_interval = refresh_interval
+        self.refresh_budget = refresh_budget
+        self.mmap_threshold = mmap_threshold
+        self.enabled = enabled
+
+        self._refresh_lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._schema_ready = False
+        self.last_refresh: Optional[float] = None
+        self.last_report: Dict[str, Any] = {}
+
+    # ---------- baza ----------
+
+    def _connect(self) -> sqlite3.Connection:
+        """Osobne połączenie na operację - WAL pozwala czytać w trakcie indeksowania"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        if not self._schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._schema_ready = True
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @staticmethod
+    def _meta(conn: sqlite3.Connection, key: str) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _add_meta(conn: sqlite3.Connection, key: str, amount: int):
+        conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value", (key, amount))
+
+    # ---------- skanowanie ----------
+
+    def _walk(self, directory: str):
+        """(ścieżka, mtime_ns, rozmiar) plików do indeksu; pomija ukryte, .part i .tmp"""
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.name.startswith(".") or entry.name.endswith((".part", ".tmp")):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from self._walk(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        if self.extensions and not entry.name.lower().endswith(self.extensions):
+                            continue
+                        stat = entry.stat(follow_symlinks=False)
+                        if stat.st_size <= self.max_file_size:
+                            yield entry.path, stat.st_mtime_ns, stat.st_size
+                except OSError:
+                    continue
+
+    def _drop_chunks(self, conn: sqlite3.Connection, file_id: int):
+        dropped = conn.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,)).rowcount
+        if dropped:
+            self._add_meta(conn, "dead_chunks", dropped)
+
+    def _index_file(self, conn: sqlite3.Connection, path: str, mtime_ns: int, size: int,
+                    file_id: Optional[int]) -> int:
+        """Indeksuje plik strumieniowo (fragmentami z całych linii); zwraca liczbę fragmentów"""
+        if file_id is None:
+            file_id = conn.execute("INSERT INTO files (path) VALUES (?)", (path,)).lastrowid
+        else:
+            self._drop_chunks(conn, file_id)
+
+        count = 0
+        try:
+            with open(path, "rb") as f:
+                if b"\x00" in f.read(4096):
+                    raise ValueError("plik binarny")
+                f.seek(0)
+                offset, line_no = 0, 1
+                buffer, buffer_offset, buffer_line = [], 0, 1
+                buffered = 0
+                # readline z limitem - bardzo długa linia (np. JSON w jednej linii) nie trafia cała do RAM
+                for line in iter(lambda: f.readline(self.chunk_bytes), b""):
+                    if not buffer:
+                        buffer_offset, buffer_line = offset, line_no
+                    buffer.append(line)
+                    buffered += len(line)
+                    offset += len(line)
+                    if line.endswith(b"\n"):
+                        line_no += 1
+                    if buffered >= self.chunk_bytes:
+                        self._add_chunk(conn, file_id, buffer_line, buffer_offset, b"".join(buffer))
+                        count += 1
+                        buffer, buffered = [], 0
+                if buffer:
+                    self._add_chunk(conn, file_id, buffer_line, buffer_offset, b"".join(buffer))
+                    count += 1
+        except (OSError, ValueError):
+            pass  # nieczytelny albo binarny - zapamiętaj stempel, żeby nie próbować co chwilę
+        conn.execute("UPDATE files SET mtime_ns = ?, size = ?, chunks = ? WHERE id = ?",
+                     (mtime_ns, size, count, file_id))
+        return count
+
+    def _add_chunk(self, conn: sqlite3.Connection, file_id: int, line: int, offset: int, data: bytes):
+        chunk_id = conn.execute("INSERT INTO chunks (file_id, line, offset, length) VALUES (?, ?, ?, ?)",
+                                (file_id, line, offset, len(data))).lastrowid
+        conn.execute("INSERT INTO workspace_fts (rowid, text) VALUES (?, ?)",
+                     (chunk_id, data.decode("utf-8", errors="ignore")))
+
+    def _rebuild(self, conn: sqlite3.Connection):
+        """Martwych fragmentów więcej niż żywych - od nowa (pliki zindeksują się przy odświeżeniu)"""
+        conn.execute("INSERT INTO workspace_fts (workspace_fts) VALUES ('delete-all')")
+        conn.execute("DELETE FROM chunks")
+        conn.execute("UPDATE files SET mtime_ns = NULL")
+        conn.execute("DELETE FROM meta WHERE key = 'dead_chunks'")
+        conn.commit()
+
+    def refresh(self, budget: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Indeksuje nowe i zmienione pliki, usuwa z indeksu skasowane. budget - limit
+        czasu w s (None = bez limitu); przerwane przejście dokończy kolejne wywołanie.
+        Równoległe wywołanie w trakcie odświeżania od razu wraca.
+        """
+        if not self.enabled:
+            return {"enabled": False}
+        if not self._refresh_lock.acquire(blocking=False):
+            return {"skipped": "refresh_in_progress"}
+        started = time.perf_counter()
+        report = {"scanned": 0, "indexed": 0, "removed": 0, "chunks": 0, "complete": True}
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute("SELECT id, path, mtime_ns, size FROM files")
+                known = {path: (file_id, mtime_ns, size) for file_id, path, mtime_ns, size in rows}
+                seen = set()
+                for root in self.roots:
+                    for path, mtime_ns, size in self._walk(root):
+                        report["scanned"] += 1
+                        seen.add(path)
+                        file_id, known_mtime, known_size = known.get(path, (None, None, None))
+                        if known_mtime == mtime_ns and known_size == size:
+                            continue
+                        report["chunks"] += self._index_file(conn, path, mtime_ns, size, file_id)
+                        report["indexed"] += 1
+                        if report["indexed"] % 50 == 0:
+                            conn.commit()
+                        over_budget = budget is not None and time.perf_counter() - started > budget
+                        if over_budget or self._cancelled.is_set():
+                            report["complete"] = False
+                            break
+                    if not report["complete"]:
+                        break
+
+                if report["complete"]:
+                    for path in set(known) - seen:
+                        self._drop_chunks(conn, known[path][0])
+                        conn.execute("DELETE FROM files WHERE id = ?", (known[path][0],))
+                        report["removed"] += 1
+                    self.last_refresh = time.time()
+                conn.commit()
+
+                dead = self._meta(conn, "dead_chunks")
+                if dead > 1000 and dead > conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]:
+                    self._rebuild(conn)
+                    report["rebuilt"] = True
+                    self.last_refresh = None
+            finally:
+                conn.close()
+        finally:
+            self._refresh_lock.release()
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        self.last_report = report
+        if report["indexed"] or report["removed"]:
+            log_event("workspace_index_refresh", "🗂️ Indeks workspace odświeżony", indexed=report["indexed"],
+                      removed=report["removed"], chunks=report["chunks"], complete=report["complete"],
+                      seconds=report["seconds"])
+        return report
+
+    def cancel(self):
+        """Przerywa trwające odświeżanie (zamykanie backendu) - wątek nie trzyma procesu"""
+        self._cancelled.set()
+
+    # ---------- wyszukiwanie ----------
+
+    def _snippet(self, path: str, offset: int, length: int, line: int, terms: List[str]) -> Optional[Tuple[int, str]]:
+        """Linia fragmentu z pierwszym trafieniem (czytana zakresem bajtów z pliku)"""
+        data, _ = read_range(path, offset, length, self.mmap_threshold)
+        lines = data.decode("utf-8", errors="ignore").splitlines()
+        for i, text in enumerate(lines):
+            text = text.strip()
+            folded = _fold(text)
+            positions = [folded.find(term) for term in terms if term in folded]
+            if positions:
+                if len(text) > SNIPPET_CHARS:
+                    start = max(0, min(positions) - SNIPPET_CHARS // 4)
+                    text = ("…" if start else "") + text[start:start + SNIPPET_CHARS] + "…"
+                return line + i, text
+        return None
+
+    def search(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Trafienia {path, line, snippet} od najlepszego (bm25); najpierw przyrostowe odświeżenie"""
+        if not self.enabled:
+            return []
+        if self.last_refresh is None or time.time() - self.last_refresh > self.refresh_interval:
+            self.refresh(budget=self.refresh_budget)
+
+        match = fts_query(query)
+        if not match:
+            return []
+        terms = [_fold(t.strip('"*')) for t in match.split()]
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT f.path, f.mtime_ns, f.size, c.line, c.offset, c.length "
+                "FROM workspace_fts JOIN chunks c ON c.id = workspace_fts.rowid JOIN files f ON f.id = c.file_id "
+                "WHERE workspace_fts MATCH ? ORDER BY rank LIMIT ?",
+                (match, limit * 3)
+            ).fetchall()
+        finally:
+            conn.close()
+
+        hits = []
+        for path, mtime_ns, size, line, offset, length in rows:
+            try:
+                stat = os.stat(path)
+                if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+                    continue  # plik zmieniony po indeksowaniu - offsety są nieaktualne
+                found = self._snippet(path, offset, length, line, terms)
+            except OSError:
+                continue
+            if found:
+                hits.append({"path": path, "line": found[0], "snippet": found[1]})
+            if len(hits) >= limit:
+                break
+        return hits
+
+    def stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {"enabled": False}
+        conn = self._connect()
+        try:
+            files = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            chunks = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            dead = self._meta(conn, "dead_chunks")
+        finally:
+            conn.close()
+        return {
+            "enabled": True,
+            "roots": self.roots,
+            "files": files,
+            "chunks": chunks,
+            "dead_chunks": dead,
+            "db_bytes": os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0,
+            "last_refresh": self.last_refresh,
+            "last_report": self.last_report
+        }
+
+
+def create_workspace_index() -> WorkspaceIndex:
+    cfg = tool_config("search_workspace")
+    return WorkspaceIndex(
+        db_path=os.getenv("WORKSPACE_INDEX_DB", cfg.get("index_db", "workspace_index.db")),
+        roots=cfg.get("roots") or tool_config("read_file").get("allowed_paths")
+        or [tools_config().get("safe_directory", "./mcp_workspace")],
+        extensions=cfg.get("extensions") or tools_config().get("allowed_file_extensions"),
+        chunk_bytes=int(cfg.get("chunk_bytes", 4096)),
+        max_file_size=parse_size(cfg.get("max_file_size"), 512 * 1024 * 1024),
+        refresh_interval=float(cfg.get("refresh_seconds", 30)),
+        refresh_budget=float(cfg.get("refresh_budget_seconds", 5)),
+        mmap_threshold=parse_size(tool_config("read_file").get("mmap_threshold"), 1024 * 1024),
+        enabled=cfg.get("enabled", True)
+    )
+
+
+workspace_index = create_workspace_index()
@@ -0,0 +1,445 @@
+"""
+Benchmark /api/chat na atrapie Ollama
+=====================================
+
+Uruchamia stub_ollama.py i backend (uvicorn) w katalogu tymczasowym, puszcza
+scenariusze i zapisuje wyniki do bench/results/<czas>.json. Jeśli istnieje
+bench/baseline.json, drukuje porównanie z nim.
+
+Scenariusze:
+- concurrent_users - wielu użytkowników naraz, krótkie tury (stream),
+- long_history - długa historia w pierwszym żądaniu, potem kontynuacja po conversation_id,
+- uploads - żądania z załącznikiem (nowa treść i powtórzona),
+- tools - odpowiedź z wywołaniem narzędzia (pętla agenta: 2 kroki).
+
+Mierzone: przepustowość (żądania/s, tokeny/s), opóźnienie p50/p95/p99,
+czas do pierwszego tokenu, RSS procesu backendu (bieżący i szczytowy),
+średni czas etapów z /api/metrics oraz czas startu backendu (do pierwszej
+odpowiedzi /api/health/live i do 200 z /api/health/ready).
+
+    python bench/run_bench.py                      # wszystkie scenariusze
+    python bench/run_bench.py --scenarios tools --users 4
+    python bench/run_bench.py --save-baseline      # nowy punkt odniesienia
+    python bench/run_bench.py --max-regression 25  # kod 1 przy pogorszeniu > 25%
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "app")
+sys.path.insert(0, BENCH_DIR)
+
+from stub_ollama import TOOL_MARKER, build_parser as stub_parser  # noqa: E402
+
+SCENARIOS = ["concurrent_users", "long_history", "uploads", "tools"]
+# Metryki porównywane z baseline: (ścieżka, True = większa wartość jest lepsza)
+COMPARED = [
+    ("throughput_rps", True),
+    ("tokens_per_second", True),
+    ("latency_ms.p50", False),
+    ("latency_ms.p95", False),
+    ("latency_ms.p99", False),
+    ("ttft_ms.p50", False),
+    ("ttft_ms.p95", False),
+    ("rss_mb", False),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    """p50/p95/p99 metodą najbliższej rangi"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))], 1)
+
+    return {"p50": rank(50), "p95": rank(95), "p99": rank(99), "max": round(ordered[-1], 1)}
+
+
+def process_memory_mb(pid: int) -> Dict[str, Optional[float]]:
+    """VmRSS / VmHWM z /proc (Linux); None, gdy niedostępne"""
+    memory = {"rss_mb": None, "peak_rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_mb"] = round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return memory
+
+
+STAGE_LINE = re.compile(r'^(chat_stage_seconds|ollama_duration_seconds)_(sum|count)\{(.*)\} (\S+)$')
+
+
+def parse_stage_metrics(text: str) -> Dict[str, List[float]]:
+    """{"chat:db_read": [suma, liczba], "ollama:eval": [...]} z tekstu /api/metrics"""
+    stages: Dict[str, List[float]] = {}
+    for line in text.splitlines():
+        match = STAGE_LINE.match(line)
+        if not match:
+            continue
+        name, kind, labels, value = match.groups()
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', labels))
+        key = f"chat:{labels['stage']}" if name == "chat_stage_seconds" else f"ollama:{labels['phase']}"
+        entry = stages.setdefault(key, [0.0, 0.0])
+        entry[0 if kind == "sum" else 1] += float(value)
+    return stages
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="jimbo-bench-")
+        self.stub_port = free_port()
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.processes: List[subprocess.Popen] = []
+        self.backend: Optional[subprocess.Popen] = None
+        self.startup: Dict[str, float] = {}
+
+    # ---------- procesy ----------
+
+    def start(self):
+        stub_cmd = [sys.executable, os.path.join(BENCH_DIR, "stub_ollama.py"), "--port", str(self.stub_port),
+                    "--token-rate", str(self.args.token_rate), "--prompt-rate", str(self.args.prompt_rate),
+                    "--latency-ms", str(self.args.latency_ms), "--load-ms", str(self.args.load_ms),
+                    "--tokens", str(self.args.tokens), "--parallel", str(self.args.parallel)]
+        self.processes.append(subprocess.Popen(stub_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        self._wait_for(f"http://127.0.0.1:{self.stub_port}/api/tags")
+
+        env = dict(os.environ)
+        env.update({
+            "OLLAMA_URL": f"http://127.0.0.1:{self.stub_port}",
+            "MAINTENANCE_INTERVAL_MINUTES": "0",
+            "LOG_FORMAT": "json",
+            "PYTHONUNBUFFERED": "1",
+        })
+        log = open(os.path.join(self.workdir, "backend.log"), "w")
+        started = time.perf_counter()
+        self.backend = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "asgi:app", "--app-dir", APP_DIR, "--host", "127.0.0.1",
+             "--port", str(self.port), "--log-level", "warning"],
+            cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        self.processes.append(self.backend)
+        self._wait_for(f"{self.base_url}/api/health/live", timeout=120, interval=0.02)
+        self.startup["live_seconds"] = round(time.perf_counter() - started, 3)
+        self._wait_for(f"{self.base_url}/api/health/ready", timeout=120, interval=0.02)
+        self.startup["ready_seconds"] = round(time.perf_counter() - started, 3)
+
+    def _wait_for(self, url: str, timeout: float = 30, interval: float = 0.2):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for process in self.processes:
+                if process.poll() is not None:
+                    raise RuntimeError(f"Proces zakończył się przy starcie (log: {self.workdir}/backend.log)")
+            try:
+                if httpx.get(url, timeout=2).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(interval)
+        raise RuntimeError(f"{url} nie odpowiada po {timeout:g}s")
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.args.keep:
+            print(f"📁 Katalog roboczy: {self.workdir}")
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # ---------- żądania ----------
+
+    async def chat(self, client: httpx.AsyncClient, messages: List[dict], conversation_id: Optional[int] = None,
+                   stream: bool = True, files=None) -> Dict[str, Any]:
+        data = {"messages": json.dumps(messages, ensure_ascii=False), "max_tokens": str(self.args.tokens),
+                "stream": "true" if stream else "false"}
+        if conversation_id is not None:
+            data["conversation_id"] = str(conversation_id)
+        started = time.perf_counter()
+        record = {"ok": False, "ttft_ms": None, "eval_count": 0, "conversation_id": conversation_id}
+
+        if not stream:
+            response = await client.post("/api/chat", data=data, files=files)
+            record["latency_ms"] = (time.perf_counter() - started) * 1000
+            if response.status_code == 200:
+                body = response.json()
+                record.update(ok=True, conversation_id=body["conversation_id"],
+                              eval_count=body["stats"].get("agent", {}).get("eval_count")
+                              or body["stats"].get("eval_count") or 0)
+            return record
+
+        event = None
+        async with client.stream("POST", "/api/chat", data=data, files=files) as response:
+            if response.status_code != 200:
+                await response.aread()
+                record["latency_ms"] = (time.perf_counter() - started) * 1000
+                return record
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[7:]
+                    if event == "token" and record["ttft_ms"] is None:
+                        record["ttft_ms"] = (time.perf_counter() - started) * 1000
+                elif line.startswith("data: ") and event == "done":
+                    body = json.loads(line[6:])
+                    record.update(ok=True, conversation_id=body["conversation_id"],
+                                  eval_count=body["stats"].get("agent", {}).get("eval_count")
+                                  or body["stats"].get("eval_count") or 0)
+                elif line.startswith("data: ") and event == "error":
+                    break
+        record["latency_ms"] = (time.perf_counter() - started) * 1000
+        return record
+
+    # ---------- scenariusze ----------
+
+    async def _user(self, client, user: int, first: List[dict], follow_up, stream: bool = True,
+                    files_for=None) -> List[Dict[str, Any]]:
+        records = []
+        conversation_id = None
+        for i in range(self.args.requests):
+            messages = first if i == 0 else [{"role": "user", "text": follow_up(user, i)}]
+            record = await self.chat(client, messages, conversation_id, stream=stream,
+                                     files=files_for(user, i) if files_for else None)
+            conversation_id = record["conversation_id"]
+            records.append(record)
+        return records
+
+    async def concurrent_users(self, client):
+        return await asyncio.gather(*[
+            self._user(client, u, [{"role": "user", "text": f"Cześć, jestem użytkownikiem {u}. Co słychać?"}],
+                       lambda u, i: f"Pytanie {i} od użytkownika {u}: opowiedz coś krótkiego.")
+            for u in range(self.args.users)
+        ])
+
+    async def long_history(self, client):
+        def history(u: int) -> List[dict]:
+            turns = []
+            for t in range(self.args.history_turns):
+                turns.append({"role": "user", "text": f"[{u}/{t}] " + "Długie pytanie o szczegóły projektu. " * 12})
+                turns.append({"role": "assistant", "text": f"[{u}/{t}] " + "Obszerna odpowiedź z detalami. " * 12})
+            return turns + [{"role": "user", "text": "Podsumuj proszę naszą rozmowę."}]
+
+        return await asyncio.gather(*[
+            self._user(client, u, history(u), lambda u, i: f"Dopytanie {i}: a co dalej?")
+            for u in range(max(1, self.args.users // 2))
+        ])
+
+    async def uploads(self, client):
+        size = self.args.upload_kb * 1024
+        shared = ("wspólny załącznik\n" * (size // 18 + 1))[:size].encode("utf-8")
+
+        def files_for(u: int, i: int):
+            # Co drugi plik ma tę samą treść - deduplikacja w uploads/
+            content = shared if i % 2 else (f"plik {u}-{i}\n" * (size // 10 + 1))[:size].encode("utf-8")
+            return [("files", (f"dane_{u}_{i}.txt", content, "text/plain"))]
+
+        return await asyncio.gather(*[
+            self._user(client, u, [{"role": "user", "text": "Co jest w załączniku?"}],
+                       lambda u, i: "A w tym pliku?", stream=False, files_for=files_for)
+            for u in range(self.args.users)
+        ])
+
+    async def tools(self, client):
+        return await asyncio.gather(*[
+            self._user(client, u, [{"role": "user", "text": f"{TOOL_MARKER} policz 2+2 (użytkownik {u})"}],
+                       lambda u, i: f"{TOOL_MARKER} policz jeszcze raz ({i})")
+            for u in range(self.args.users)
+        ])
+
+    async def run_scenario(self, name: str) -> Dict[str, Any]:
+        limits = httpx.Limits(max_connections=self.args.users * 2 + 4)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=self.args.timeout, limits=limits) as client:
+            before = parse_stage_metrics((await client.get("/api/metrics")).text)
+            started = time.perf_counter()
+            per_user = await getattr(self, name)(client)
+            wall = time.perf_counter() - started
+            after = parse_stage_metrics((await client.get("/api/metrics")).text)
+
+        records = [r for user in per_user for r in user]
+        ok = [r for r in records if r["ok"]]
+        stages = {}
+        for key, (total, count) in sorted(after.items()):
+            prev_total, prev_count = before.get(key, (0.0, 0.0))
+            if count > prev_count:
+                stages[key] = round((total - prev_total) / (count - prev_count) * 1000, 2)
+
+        result = {
+            "requests": len(records),
+            "errors": len(records) - len(ok),
+            "wall_seconds": round(wall, 2),
+            "throughput_rps": round(len(ok) / wall, 2) if wall else 0.0,
+            "tokens_per_second": round(sum(r["eval_count"] for r in ok) / wall, 1) if wall else 0.0,
+            "latency_ms": percentiles([r["latency_ms"] for r in ok]),
+            "ttft_ms": percentiles([r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]),
+            "stage_avg_ms": stages,
+        }
+        result.update(process_memory_mb(self.backend.pid))
+        return result
+
+
+# ---------- raport ----------
+
+def _get(data: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+def compare(results: dict, baseline: dict, max_regression: Optional[float]) -> List[str]:
+    """Drukuje porównanie; zwraca listę metryk pogorszonych ponad max_regression %"""
+    regressions = []
+    print(f"\n{'scenariusz / metryka':<38}{'baseline':>12}{'teraz':>12}{'zmiana':>10}")
+    for scenario, current in results["scenarios"].items():
+        reference = baseline.get("scenarios", {}).get(scenario)
+        if not reference:
+            continue
+        for path, higher_is_better in COMPARED:
+            old, new = _get(reference, path), _get(current, path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_is_better else change
+            flag = ""
+            if max_regression is not None and worse > max_regression:
+                flag = " ⚠️"
+                regressions.append(f"{scenario}.{path} ({change:+.1f}%)")
+            print(f"{scenario + ' / ' + path:<38}{old:>12}{new:>12}{change:>+9.1f}%{flag}")
+    return regressions
+
+
+def print_summary(results: dict):
+    print(f"\n{'scenariusz':<18}{'req':>6}{'err':>5}{'req/s':>8}{'tok/s':>8}"
+          f"{'p50':>9}{'p95':>9}{'p99':>9}{'ttft50':>9}{'ttft95':>9}{'rss MB':>8}")
+    for name, r in results["scenarios"].items():
+        lat, ttft = r["latency_ms"] or {}, r["ttft_ms"] or {}
+        print(f"{name:<18}{r['requests']:>6}{r['errors']:>5}{r['throughput_rps']:>8}{r['tokens_per_second']:>8}"
+              f"{lat.get('p50', '-'):>9}{lat.get('p95', '-'):>9}{lat.get('p99', '-'):>9}"
+              f"{ttft.get('p50', '-'):>9}{ttft.get('p95', '-'):>9}{r['rss_mb'] or '-':>8}")
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark /api/chat na atrapie Ollama")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"lista po przecinku: {SCENARIOS}")
+    parser.add_argument("--users", type=int, default=8, help="użytkownicy równolegle")
+    parser.add_argument("--requests", type=int, default=4, help="tury na użytkownika")
+    parser.add_argument("--history-turns", type=int, default=30, help="tury historii w long_history")
+    parser.add_argument("--upload-kb", type=int, default=256, help="rozmiar załącznika w uploads")
+    parser.add_argument("--timeout", type=float, default=120, help="timeout żądania (s)")
+    defaults = stub_parser().parse_args([])
+    parser.add_argument("--token-rate", type=float, default=defaults.token_rate)
+    parser.add_argument("--prompt-rate", type=float, default=defaults.prompt_rate)
+    parser.add_argument("--latency-ms", type=float, default=defaults.latency_ms)
+    parser.add_argument("--load-ms", type=float, default=defaults.load_ms)
+    parser.add_argument("--tokens", type=int, default=defaults.tokens)
+    parser.add_argument("--parallel", type=int, default=defaults.parallel)
+    parser.add_argument("--baseline", default=os.path.join(BENCH_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="zapisz wyniki jako baseline")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="kod wyjścia 1, gdy metryka pogorszy się o więcej niż tyle procent")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results"))
+    parser.add_argument("--keep", action="store_true", help="nie usuwaj katalogu roboczego (chat.db, log)")
+    return parser
+
+
+async def run(bench: Bench, scenarios: List[str]) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    for name in scenarios:
+        print(f"⏱️  {name}...", flush=True)
+        results[name] = await bench.run_scenario(name)
+    return results
+
+
+def main():
+    args = build_parser().parse_args()
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Nieznane scenariusze: {sorted(unknown)}")
+
+    bench = Bench(args)
+    try:
+        bench.start()
+        scenario_results = asyncio.run(run(bench, scenarios))
+    finally:
+        bench.stop()
+
+    results = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "settings": {k: v for k, v in vars(args).items()
+                         if k not in ("baseline", "save_baseline", "max_regression", "output", "keep")}
+        },
+        "startup": bench.startup,
+        "scenarios": scenario_results
+    }
+    print_summary(results)
+    print(f"\n🚀 Start backendu: live {bench.startup.get('live_seconds')} s, "
+          f"ready {bench.startup.get('ready_seconds')} s")
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Wyniki: {path}")
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"📌 Baseline zapisany: {args.baseline}")
+
+    if regressions:
+        print(f"\n❌ Pogorszenie ponad {args.max_regression:g}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Atrapa serwera Ollama do benchmarków (bez GPU i bez sieci)
+==========================================================
+
+Odpowiada na endpointy, których używa backend: /api/tags, /api/generate
+(strumieniowo i nie), /api/embed. Czasy są symulowane i zwracane w tych
+samych polach co prawdziwa Ollama (load_duration, prompt_eval_duration,
+eval_duration w ns), więc statystyki i /api/metrics backendu działają.
+
+- --token-rate: tokeny/s generacji (eval),
+- --prompt-rate: tokeny/s przetwarzania promptu (prompt_eval); tokeny
+  z "context" nie są liczone ponownie - jak w Ollama,
+- --latency-ms: stałe opóźnienie przed odpowiedzią,
+- --load-ms: pierwsze wywołanie modelu (i po keep_alive=0) ładuje model;
+  generate bez promptu tylko ładuje (rozgrzanie przy starcie backendu),
+- --tokens: długość odpowiedzi (ograniczona przez num_predict),
+- --parallel: ile generacji naraz na model (OLLAMA_NUM_PARALLEL),
+- prompt z TOOL_MARKER -> odpowiedź zaczyna się od wywołania calculator,
+- "context" to deterministyczne tokeny (po CHARS_PER_TOKEN znaków) promptu
+  po szablonie czatu i odpowiedzi; jak w Ollama: bez raw prompt jest owijany
+  w turę CHAT_TEMPLATE i doklejany za tokenami "context", z raw=True idzie
+  dosłownie, "context" z żądania jest pomijany i nie wraca w odpowiedzi.
+
+Start: python stub_ollama.py --port 11434 --token-rate 40
+"""
+
+import argparse
+import hashlib
+import json
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TOOL_MARKER = "BENCH_TOOL"
+CHARS_PER_TOKEN = 4
+CHAT_TEMPLATE = "<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
+DEFAULT_MODELS = ["SpeakLeash/bielik-4.5b-v3.0-instruct:Q8_0", "llama3.2:1b", "nomic-embed-text"]
+
+
+class StubState:
+    def __init__(self, args):
+        self.args = args
+        self.loaded = set()
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.requests = 0
+
+    def slot(self, model: str) -> threading.Semaphore:
+        with self.lock:
+            if model not in self.slots:
+                self.slots[model] = threading.Semaphore(self.args.parallel)
+            return self.slots[model]
+
+    def load(self, model: str) -> int:
+        """Symulowane ładowanie modelu; zwraca load_duration w ns"""
+        with self.lock:
+            if model in self.loaded:
+                return 100_000
+            self.loaded.add(model)
+        time.sleep(self.args.load_ms / 1000)
+        return int(self.args.load_ms * 1e6)
+
+
+def tokenize(text: str) -> list:
+    return [zlib.crc32(text[i:i + CHARS_PER_TOKEN].encode("utf-8")) % 32000
+            for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+def response_tokens(prompt: str, limit: int) -> list:
+    words = [f"słowo{i}" for i in range(limit)]
+    if TOOL_MARKER in prompt:
+        words = ["[TOOL:calculator]expression=2+2[/TOOL]"] + words[:max(0, limit - 1)]
+    return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: StubState = None
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, payload: dict):
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._json({"models": [{"name": name} for name in self.state.args.models]})
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/api/embed":
+            return self._embed(body)
+        if self.path == "/api/generate":
+            return self._generate(body)
+        self._json({"error": "not found"}, 404)
+
+    def _embed(self, body: dict):
+        texts = body.get("input") or []
+        if isinstance(texts, str):
+            texts = [texts]
+        vectors = []
+        for text in texts:
+            digest = hashlib.sha256(text.encode("utf-8")).digest()
+            vectors.append([b / 255 for b in digest[:16]])
+        self._json({"embeddings": vectors})
+
+    def _generate(self, body: dict):
+        args = self.state.args
+        model = body.get("model", "")
+        if "prompt" not in body:
+            # {"model", "keep_alive": 0} - zwolnienie modelu; bez keep_alive=0 - załadowanie (rozgrzanie)
+            if body.get("keep_alive") in (0, "0", "0s"):
+                with self.state.lock:
+                    self.state.loaded.discard(model)
+                return self._json({"model": model, "done": True, "response": ""})
+            return self._json({"model": model, "done": True, "response": "", "load_duration": self.state.load(model)})
+
+        with self.state.lock:
+            self.state.requests += 1
+        prompt = body.get("prompt", "")
+        raw = bool(body.get("raw"))
+        context = [] if raw else list(body.get("context") or [])
+        limit = min(args.tokens, int((body.get("options") or {}).get("num_predict") or args.tokens))
+        tokens = response_tokens(prompt, max(1, limit))
+        prompt_ids = tokenize(prompt if raw else CHAT_TEMPLATE.format(prompt=prompt))
+        prompt_tokens = max(1, len(prompt_ids))
+
+        time.sleep(args.latency_ms / 1000)
+        with self.state.slot(model):
+            started = time.perf_counter()
+            load_ns = self.state.load(model)
+            prompt_eval_s = prompt_tokens / args.prompt_rate
+            time.sleep(prompt_eval_s)
+            eval_s = len(tokens) / args.token_rate
+            final = {
+                "model": model,
+                "done": True,
+                "context": context + prompt_ids + [zlib.crc32(t.encode("utf-8")) % 32000 for t in tokens],
+                "prompt_eval_count": prompt_tokens,
+                "prompt_eval_duration": int(prompt_eval_s * 1e9),
+                "eval_count": len(tokens),
+                "eval_duration": int(eval_s * 1e9),
+                "load_duration": load_ns,
+            }
+            if raw:
+                del final["context"]
+
+            if not body.get("stream", True):
+                time.sleep(eval_s)
+                final["total_duration"] = int((time.perf_counter() - started) * 1e9)
+                return self._json(dict(final, response="".join(tokens)))
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            delay = 1 / args.token_rate
+            for token in tokens:
+                time.sleep(delay)
+                self._chunk({"model": model, "response": token, "done": False})
+            final["total_duration"] = int((time.perf_counter() - started) * 1e9)
+            self._chunk(dict(final, response=""))
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Atrapa Ollama do benchmarków")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--token-rate", type=float, default=40, help="tokeny/s generacji")
+    parser.add_argument("--prompt-rate", type=float, default=2000, help="tokeny/s prompt_eval")
+    parser.add_argument("--latency-ms", type=float, default=5, help="opóźnienie przed odpowiedzią")
+    parser.add_argument("--load-ms", type=float, default=500, help="czas ładowania modelu")
+    parser.add_argument("--tokens", type=int, default=48, help="długość odpowiedzi w tokenach")
+    parser.add_argument("--parallel", type=int, default=2, help="generacje naraz na model")
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    Handler.state = StubState(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"🧪 Atrapa Ollama na http://{args.host}:{args.port} ({args.token_rate:g} tok/s)", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()